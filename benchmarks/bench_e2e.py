@@ -0,0 +1,184 @@
+"""End-to-end benchmark for SnapTrack against local stand-ins for Rekognition, OpenAI and Notion
+
+Generated receipts go through the real code paths (ReceiptParser.parse, cli.add_receipt or the batch
+pipeline behind cli.add_receipts) with the real SDKs, which are pointed at the fake services in
+fake_services.py. Latency, error rate and throttling of every service are configurable, so changes can
+be measured under realistic conditions without API keys or cost. Each scenario (receipt size x
+number of selection columns) reports receipts/s, p50/p95 per receipt, API calls and tokens per
+receipt, retries, failures and peak memory.
+
+    python benchmarks/bench_e2e.py --mode add_receipt --receipts 20 --items 5,20 --select-columns 0,4 --openai-latency 0.4
+"""
+import argparse
+import contextlib
+import io
+import os
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_services import FakeServices, ServiceBehavior, build_schema, generate_receipts
+
+def parse_counts(value):
+    return [int(count) for count in value.split(',') if count.strip()]
+
+def percentile(timings, fraction):
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+def write_receipts(directory, receipts):
+    filepaths = []
+    for receipt in receipts:
+        filepath = os.path.join(directory, f"{receipt.receipt_id}.jpg")
+        with open(filepath, 'wb') as receipt_file:
+            receipt_file.write(receipt.to_bytes())
+        filepaths.append(filepath)
+    return filepaths
+
+def run_scenario(args, items, select_columns):
+    schema = build_schema(select_columns)
+    behaviors = {
+        'rekognition': ServiceBehavior(args.rekognition_latency, error_rate=args.error_rate, throttle_rate=args.throttle_rate, seed=args.seed),
+        'openai': ServiceBehavior(args.openai_latency, error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                                  retry_after=args.retry_after, seed=args.seed + 1),
+        'notion': ServiceBehavior(args.notion_latency, error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                                  requests_per_second=args.notion_rps, retry_after=args.retry_after, seed=args.seed + 2)
+    }
+    services = FakeServices(schema, **behaviors)
+    directory = tempfile.mkdtemp(prefix='snaptrack-bench-')
+
+    # every scenario starts cold: its own caches, classifier and credentials
+    environment = services.environment(os.path.join(directory, 'aws-config'), os.path.join(directory, 'aws-credentials'))
+    environment.update(SNAPTRACK_CACHE_DIR=os.path.join(directory, 'cache'), SNAPTRACK_CONFIG_DIR=os.path.join(directory, 'config'))
+    previous = {key: os.environ.get(key) for key in environment}
+    os.environ.update(environment)
+
+    from snaptrack import cli
+    from snaptrack.metrics import Metrics
+    from yaspin import yaspin
+    cli._credentials = None
+
+    receipts = generate_receipts(args.receipts, items, seed=args.seed)
+    filepaths = write_receipts(directory, receipts)
+    metrics = Metrics()
+    parser_options = {'preprocess': False, 'local': args.local, 'batch_select': not args.no_batch_select, 'structured': args.structured}
+
+    timings = []
+    failures = 0
+    if args.trace_memory:
+        tracemalloc.start()
+
+    # the spinner and the CLI's messages would drown out the report
+    output = io.StringIO()
+    spinner = None
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            spinner = yaspin(text="Processing...", color="yellow")
+
+            if args.mode == 'parse':
+                receipt_parser = cli.create_receipt_parser(spinner, False, metrics=metrics, **parser_options)
+                database = cli.create_database(spinner, metrics=metrics)
+                for filepath in filepaths:
+                    receipt_start = time.perf_counter()
+                    try:
+                        receipt_parser.parse(filepath, database.columns, database.select_options)
+                    except Exception:
+                        failures += 1
+                    timings.append(time.perf_counter() - receipt_start)
+
+            elif args.mode == 'add_receipt':
+                for filepath in filepaths:
+                    receipt_start = time.perf_counter()
+                    try:
+                        cli.add_receipt(filepath, spinner, False, local_classifier=args.local, stream=args.stream, metrics=metrics, **parser_options)
+                    except Exception:
+                        failures += 1
+                    timings.append(time.perf_counter() - receipt_start)
+
+            else:
+                try:
+                    cli.add_receipts(filepaths, spinner, False, local_classifier=args.local, ocr_workers=args.workers,
+                                     llm_workers=args.workers, notion_workers=args.notion_workers, metrics=metrics, **parser_options)
+                except SystemExit:
+                    pass
+                # receipts share the pipeline, so per-receipt latencies come from its spans
+                stats = metrics.span_stats.get('stage.insert') or metrics.span_stats.get('stage.extract')
+                timings = list(stats.recent) if stats is not None else []
+                failures = metrics.counter('receipts', result='failed')
+    finally:
+        elapsed = time.perf_counter() - start
+        # ReceiptParser.parse starts the spinner and leaves it to the caller, whose thread would keep the benchmark alive
+        if spinner is not None:
+            spinner.stop()
+        peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+        if args.trace_memory:
+            tracemalloc.stop()
+
+        calls = services.calls()
+        pages = len(services.notion.pages)
+        services.close()
+        for key, value in previous.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        shutil.rmtree(directory, ignore_errors=True)
+
+    count = len(filepaths)
+    return {
+        'items': items, 'select_columns': select_columns, 'receipts': count, 'failures': failures, 'pages': pages,
+        'throughput': count / elapsed if elapsed > 0 else 0.0,
+        'p50': statistics.median(timings) if timings else 0.0, 'p95': percentile(timings, 0.95) if timings else 0.0,
+        'calls': {service: sum(counter.values()) / count for service, counter in calls.items()},
+        'tokens': metrics.counter('tokens') / count, 'retries': metrics.counter('retries'),
+        'peak_memory': peak
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=['parse', 'add_receipt', 'pipeline'], default='add_receipt', help='code path the receipts go through')
+    parser.add_argument('--receipts', type=int, default=10, help='receipts per scenario')
+    parser.add_argument('--items', type=parse_counts, default=[5, 20, 60], help='comma separated items per receipt, one scenario each')
+    parser.add_argument('--select-columns', type=parse_counts, default=[0, 2, 5], help='comma separated selection columns in the schema, one scenario each')
+    parser.add_argument('--local', action=argparse.BooleanOptionalAction, default=True, help='allow local extraction and classification')
+    parser.add_argument('--structured', action='store_true', help='use structured outputs for extraction')
+    parser.add_argument('--no-batch-select', action='store_true', help='classify selection columns with one prompt per entry')
+    parser.add_argument('--stream', action='store_true', help='stream GPT replies in add_receipt mode')
+    parser.add_argument('--workers', type=int, default=4, help='OCR and GPT workers in pipeline mode')
+    parser.add_argument('--notion-workers', type=int, default=2, help='Notion workers in pipeline mode')
+    parser.add_argument('--rekognition-latency', type=float, default=0.3, help='seconds per Rekognition call')
+    parser.add_argument('--openai-latency', type=float, default=0.8, help='seconds per chat completion')
+    parser.add_argument('--notion-latency', type=float, default=0.15, help='seconds per Notion call')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls failing with a server error')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of calls rejected with a rate limit (429 / ThrottlingException)')
+    parser.add_argument('--retry-after', type=float, default=0.5, help='Retry-After seconds sent with rate limits')
+    parser.add_argument('--notion-rps', type=float, default=None, help="requests per second Notion accepts before rate limiting (3 like the real API)")
+    parser.add_argument('--trace-memory', action='store_true', help='report peak traced Python memory (slower); otherwise the peak RSS of the process')
+    parser.add_argument('--seed', type=int, default=0, help='seed for generated receipts and injected failures')
+    args = parser.parse_args()
+
+    print(f"mode: {args.mode}, {args.receipts} receipt(s) per scenario")
+    print(f"{'items':>5} {'select':>6} {'rcpt/s':>7} {'p50 s':>7} {'p95 s':>7} {'ocr/r':>6} {'gpt/r':>6} {'notion/r':>8} {'tok/r':>7} {'retries':>7} {'failed':>6} {'peak MB':>8}")
+
+    for items in args.items:
+        for select_columns in args.select_columns:
+            result = run_scenario(args, items, select_columns)
+            # ru_maxrss is in kilobytes on Linux and bytes on macOS
+            peak = result['peak_memory']
+            if peak is None:
+                peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+            print(f"{items:>5} {select_columns:>6} {result['throughput']:>7.2f} {result['p50']:>7.3f} {result['p95']:>7.3f} "
+                  f"{result['calls']['rekognition']:>6.1f} {result['calls']['openai']:>6.1f} {result['calls']['notion']:>8.1f} "
+                  f"{result['tokens']:>7.0f} {result['retries']:>7g} {result['failures']:>6} {peak / (1024 * 1024):>8.1f}")
+
+if __name__ == '__main__':
+    main()
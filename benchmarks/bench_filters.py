@@ -0,0 +1,120 @@
+"""Micro-benchmark for filtering extracted entries
+
+Compares FilterEngine against the original per-call filtering (reproduced below) on synthetic receipts,
+checks both keep the same entries, and prints per-rule hit counts.
+
+    python benchmarks/bench_filters.py --entries 5000 --repeat 5
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from snaptrack.filters import FilterEngine
+
+COLUMNS = [
+    {'name': 'Name', 'type': 'title'},
+    {'name': 'Notes', 'type': 'text'},
+    {'name': 'Price', 'type': 'number'},
+    {'name': 'Date', 'type': 'date'},
+    {'name': 'Category', 'type': 'select'},
+    {'name': 'Tags', 'type': 'multi_select'}
+]
+
+PRODUCTS = ['Milk 2L', 'Sourdough Bread', 'Bananas', 'Chicken Thighs', 'Olive Oil', 'Dish Soap', 'Shampoo', 'Coffee Beans', 'Greek Yogurt', 'Paper Towels']
+NOISE = ['SUBTOTAL', 'HST 13%', 'VISA ****1234', 'Thank you for shopping', '12/01/2023', '14:32:10', '4165550123', 'www.store.ca', '9.99', 'Ab']
+
+def synthetic_entries(count, seed=0):
+    generator = random.Random(seed)
+    entries = []
+    for _ in range(count):
+        name = generator.choice(PRODUCTS) if generator.random() < 0.7 else generator.choice(NOISE)
+        entries.append({
+            'Name': name,
+            'Notes': '' if generator.random() < 0.8 else generator.choice(PRODUCTS),
+            'Price': '' if generator.random() < 0.1 else '{:.2f}'.format(generator.uniform(0.5, 40)),
+            'Date': '' if generator.random() < 0.3 else '2023/12/01',
+            'Category': 'Groceries',
+            'Tags': []
+        })
+    return entries
+
+def legacy_filter(entries, columns):
+    # the filtering ReceiptParser did before FilterEngine, kept as the baseline
+    def contains_unwanted_content(entry_column):
+        lower_input = entry_column.lower()
+
+        unwanted = ['tax', 'change', 'cash', 'card', 'amount', 'total', 'subtotal', 'discount', 'hst', 'gst', 'invoice', 'purchase', 'customer', 'receipt', 'round', 'balance', '.com', '.ca', 'feedback', 'swipe', 'sale', 'pay', 'shop', '*', 'approved', 'auth', 'record', 'important', 'you', 'copy']
+        for word in unwanted:
+            if word in lower_input:
+                return True
+
+        unwanted_patterns = [r'\d{1,2}/\d{1,2}/\d{2,4}', r'^\d+(\.\d{2})?$', r'\b\d{1,2}:\d{2}(?::\d{2})?\b', r'\d{10}', r'https?://\S+', r'\b(?:\d[ -]*?){13,16}\b', r'\b(?:\d[ -]x?){13,16}\b']
+        for pattern in unwanted_patterns:
+            if re.search(pattern, entry_column):
+                return True
+
+        return False
+
+    non_select_columns = [column['name'] for column in columns if column['type'] not in ['select', 'multi_select']]
+    kept = []
+    for entry in entries:
+        num_empty = len([column for column in non_select_columns if entry[column] == ''])
+        if num_empty <= int(len(columns) / 2):
+            kept.append(entry)
+
+    textual_columns = [column['name'] for column in columns if column['type'] in ['title', 'text']]
+    modified_entries = []
+    for entry in kept:
+        keep_entry = True
+        for column_name in textual_columns:
+            if len(entry[column_name]) != 0 and len(entry[column_name]) <= 2:
+                keep_entry = False
+            if contains_unwanted_content(entry[column_name]):
+                keep_entry = False
+        if keep_entry:
+            modified_entries.append(entry)
+    return modified_entries
+
+def best_of(function, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--entries', type=int, default=5000, help='number of synthetic entries')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per implementation (best is reported)')
+    args = parser.parse_args()
+
+    entries = synthetic_entries(args.entries)
+
+    build_start = time.perf_counter()
+    engine = FilterEngine(COLUMNS)
+    build_time = time.perf_counter() - build_start
+
+    legacy_time, legacy_kept = best_of(lambda: legacy_filter(entries, COLUMNS), args.repeat)
+    engine_time, engine_kept = best_of(lambda: engine.filter(entries), args.repeat)
+
+    if legacy_kept != engine_kept:
+        raise SystemExit("FilterEngine kept different entries than the original filtering")
+
+    print(f"entries: {len(entries)}, kept: {len(engine_kept)}")
+    print(f"original filtering: {legacy_time * 1000:.2f} ms ({legacy_time / len(entries) * 1e6:.2f} us/entry)")
+    print(f"FilterEngine:       {engine_time * 1000:.2f} ms ({engine_time / len(entries) * 1e6:.2f} us/entry), built in {build_time * 1000:.2f} ms")
+    print(f"speedup: {legacy_time / engine_time:.1f}x")
+
+    print("hits per rule (all runs):")
+    for rule, hits in sorted(engine.hits.items(), key=lambda item: -item[1]):
+        print(f"  {rule}: {hits}")
+
+if __name__ == '__main__':
+    main()
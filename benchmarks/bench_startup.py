@@ -0,0 +1,86 @@
+"""Benchmark for SnapTrack's import time and CLI cold start
+
+Reports `python -X importtime` for snaptrack.cli (total, slowest top-level packages, and whether any of the
+heavy SDKs were imported) and the wall time of fresh interpreters running `--help` and a `--dry-run`.
+
+    python benchmarks/bench_startup.py --repeat 10
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+# packages that should only be imported once the stage needing them runs
+HEAVY_PACKAGES = ['boto3', 'botocore', 'openai', 'notion_client', 'httpx', 'keyring', 'PIL', 'spacy']
+
+def run_snaptrack(*args, importtime=False):
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + list(args)
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [SRC, os.environ.get('PYTHONPATH')])))
+    return subprocess.run(command, env=environment, capture_output=True, text=True)
+
+def import_times():
+    # each line of -X importtime output is "import time: self [us] | cumulative | imported package"
+    result = run_snaptrack('-c', 'import snaptrack.cli', importtime=True)
+    if result.returncode != 0:
+        raise SystemExit(result.stderr)
+
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, total_time, name = line.rsplit('|', 2)
+        # nested imports are indented further; only top-level entries carry a module's full cost
+        if name.startswith('  '):
+            continue
+        package = name.strip().split('.')[0]
+        cumulative[package] = cumulative.get(package, 0) + int(total_time)
+
+    return cumulative
+
+def cold_start(args, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = run_snaptrack(*args)
+        timings.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            raise SystemExit(f"{' '.join(args)} failed:\n{result.stderr}")
+    return min(timings), statistics.median(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=10, help='fresh interpreters started per command')
+    parser.add_argument('--top', type=int, default=10, help='number of slowest packages to list')
+    args = parser.parse_args()
+
+    cumulative = import_times()
+    print(f"import snaptrack.cli: {cumulative.get('snaptrack', 0) / 1000:.1f} ms")
+    print("slowest top-level imports:")
+    for package, total in sorted(cumulative.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"  {package}: {total / 1000:.1f} ms")
+
+    loaded = [package for package in HEAVY_PACKAGES if package in cumulative]
+    print(f"heavy packages imported: {', '.join(loaded) if loaded else 'none'}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        receipt = os.path.join(directory, 'receipt.jpg')
+        with open(receipt, 'wb') as receipt_file:
+            receipt_file.write(b'\xff\xd8\xff\xd9')
+
+        # a bare interpreter is the floor the CLI's own start up cost sits on top of
+        commands = [
+            ('python (baseline)', ['-c', 'pass']),
+            ('snaptrack --help', ['-m', 'snaptrack.cli', '--help']),
+            ('snaptrack --dry-run', ['-m', 'snaptrack.cli', '--dry-run', receipt])
+        ]
+        for label, command in commands:
+            best, median = cold_start(command, args.repeat)
+            print(f"{label}: best {best * 1000:.1f} ms, median {median * 1000:.1f} ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,449 @@
+"""Local stand-ins for Amazon Rekognition, the OpenAI chat API and the Notion API, used by the benchmarks
+
+Each service is a small threaded HTTP server speaking just enough of the real wire protocol for the
+official SDKs (boto3, openai, notion_client) to talk to it unchanged, with configurable latency,
+error rate and throttling. Receipts are generated as small files whose bytes carry their own lines,
+so the fake Rekognition can "read" them and the fake GPT can answer from the prompt it is sent.
+"""
+import base64
+from collections import Counter
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+
+# marks a generated receipt file, after a JPEG start-of-image marker so it still looks like an image
+RECEIPT_MAGIC = b'\xff\xd8\xff\xe0SNAPTRACK-FAKE-RECEIPT\n'
+
+PRODUCTS = [
+    'Bananas', 'Whole Milk', 'Sourdough Bread', 'Chicken Thighs', 'Olive Oil', 'Dish Soap', 'Shampoo', 'Coffee Beans',
+    'Greek Yogurt', 'Paper Towels', 'Cheddar Cheese', 'Baby Spinach', 'Pasta Sauce', 'Brown Rice', 'Orange Juice',
+    'Toothpaste', 'Ground Beef', 'Frozen Peas', 'Apples', 'Granola Bars', 'Laundry Detergent', 'Butter', 'Eggs', 'Tortillas'
+]
+STORES = ['FRESHCO', 'METRO', 'NO FRILLS', 'LOBLAWS', 'SHOPPERS DRUG MART']
+OPTION_WORDS = ['Groceries', 'Household', 'Personal', 'Dining', 'Health', 'Snacks', 'Produce', 'Dairy', 'Meat', 'Frozen', 'Bakery', 'Pantry']
+
+# lines that are payment or summary details rather than purchases
+NON_PRODUCT = re.compile(r'subtotal|total|tax|hst|gst|visa|mastercard|change|cash|balance', re.IGNORECASE)
+PRICED_LINE = re.compile(r'^(.*[A-Za-z].*?)\s+\$?(\d+\.\d{2})$')
+DATE = re.compile(r'\d{4}/\d{2}/\d{2}')
+
+class FakeReceipt:
+    """A generated receipt, stored in the bytes of its image file
+    """
+
+    def __init__(self, receipt_id, store, purchased, items):
+        self.receipt_id = receipt_id
+        self.store = store
+        self.purchased = purchased
+        self.items = items
+
+    def lines(self):
+        subtotal = round(sum(price for _, price in self.items), 2)
+        tax = round(subtotal * 0.13, 2)
+        lines = [[self.store], [self.purchased.strftime('%Y/%m/%d')]]
+        lines += [[name.upper(), f"{price:.2f}"] for name, price in self.items]
+        lines += [['SUBTOTAL', f"{subtotal:.2f}"], ['HST 13%', f"{tax:.2f}"], ['TOTAL', f"{subtotal + tax:.2f}"], ['VISA ****1234']]
+        return lines
+
+    def to_bytes(self):
+        return RECEIPT_MAGIC + json.dumps({'id': self.receipt_id, 'lines': self.lines()}).encode('utf-8')
+
+    @staticmethod
+    def lines_from_bytes(data):
+        if not data.startswith(RECEIPT_MAGIC):
+            return None
+        return json.loads(data[len(RECEIPT_MAGIC):].decode('utf-8'))['lines']
+
+def generate_receipts(count, items, seed=0):
+    """Generates receipts with the given number of items each
+
+    :param count: number of receipts
+    :type count: int
+    :param items: number of purchased items per receipt
+    :type items: int
+    :param seed: seed for the random generator, defaults to 0
+    :type seed: int, optional
+
+    :return: the receipts
+    :rtype: list of FakeReceipt
+    """
+    generator = random.Random(seed)
+    receipts = []
+    for _ in range(count):
+        names = [f"{generator.choice(['', 'Organic ', 'Large ', 'Family Size '])}{generator.choice(PRODUCTS)}" for _ in range(items)]
+        receipt_items = [(name.strip(), round(generator.uniform(0.99, 39.99), 2)) for name in names]
+        purchased = date(2023, 1, 1) + timedelta(days=generator.randrange(365))
+        receipts.append(FakeReceipt(uuid.UUID(int=generator.getrandbits(128)).hex, generator.choice(STORES), purchased, receipt_items))
+    return receipts
+
+def build_schema(select_columns, options_per_column=6):
+    """Builds a Notion database schema with the usual columns plus a number of selection columns
+
+    :param select_columns: number of select/multi-select columns (alternating)
+    :type select_columns: int
+    :param options_per_column: number of options each selection column has, defaults to 6
+    :type options_per_column: int, optional
+
+    :return: Notion database properties keyed by column name
+    :rtype: dictionary
+    """
+    properties = {
+        'Name': {'type': 'title', 'title': {}},
+        'Price': {'type': 'number', 'number': {'format': 'dollar'}},
+        'Date': {'type': 'date', 'date': {}}
+    }
+    for index in range(select_columns):
+        column_type = 'select' if index % 2 == 0 else 'multi_select'
+        options = [{'name': OPTION_WORDS[(index + offset) % len(OPTION_WORDS)], 'color': 'default'} for offset in range(options_per_column)]
+        properties[f"Category {index + 1}"] = {'type': column_type, column_type: {'options': options}}
+
+    for position, (name, column) in enumerate(properties.items()):
+        column.update({'id': f"p{position}", 'name': name})
+    return properties
+
+class ServiceBehavior:
+    """How a fake service responds: latency (with jitter), random errors, throttling and a request rate limit
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.25, error_rate: float = 0.0, throttle_rate: float = 0.0,
+                 requests_per_second: float = None, retry_after: float = 1.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.requests_per_second = requests_per_second
+        self.retry_after = retry_after
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window = []
+
+    def outcome(self):
+        """Sleeps for the request's latency, then decides whether it is 'ok', an 'error' or 'throttled'"""
+        with self._lock:
+            roll = self._random.random()
+            delay = self.latency * (1 + self._random.uniform(-self.jitter, self.jitter))
+
+            throttled = False
+            if self.requests_per_second is not None:
+                # requests over the limit within the last second are rejected, like Notion's rate limit
+                now = time.monotonic()
+                self._window = [moment for moment in self._window if now - moment < 1.0]
+                throttled = len(self._window) >= self.requests_per_second
+                if not throttled:
+                    self._window.append(now)
+
+        time.sleep(max(0.0, delay))
+        if throttled or roll < self.throttle_rate:
+            return 'throttled'
+        if roll < self.throttle_rate + self.error_rate:
+            return 'error'
+        return 'ok'
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    service = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', self.service.content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        self.service.handle(self, 'GET')
+
+    def do_POST(self):
+        self.service.handle(self, 'POST')
+
+    def do_PATCH(self):
+        self.service.handle(self, 'PATCH')
+
+class FakeService:
+    """A fake API on its own local port, counting every request by operation
+    """
+
+    content_type = 'application/json'
+
+    def __init__(self, behavior: ServiceBehavior = None):
+        self.behavior = behavior or ServiceBehavior()
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+        handler = type(f"{type(self).__name__}Handler", (_FakeHandler,), {'service': self})
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def count(self, operation):
+        with self._lock:
+            self.calls[operation] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return Counter(self.calls)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def handle(self, request, method):
+        raise NotImplementedError
+
+class FakeRekognition(FakeService):
+    """Answers DetectText (JSON 1.1 protocol) with LINE and WORD detections laid out like a real receipt
+    """
+
+    content_type = 'application/x-amz-json-1.1'
+
+    def handle(self, request, method):
+        operation = request.headers.get('X-Amz-Target', '').split('.')[-1]
+        body = request.read_json()
+        self.count(operation)
+
+        outcome = self.behavior.outcome()
+        if outcome == 'throttled':
+            return request.send_json(400, {'__type': 'ThrottlingException', 'message': 'Rate exceeded'})
+        if outcome == 'error':
+            return request.send_json(500, {'__type': 'InternalServerError', 'message': 'Internal server error'})
+        if operation != 'DetectText':
+            return request.send_json(400, {'__type': 'InvalidParameterException', 'message': f"unsupported operation {operation}"})
+
+        lines = FakeReceipt.lines_from_bytes(base64.b64decode(body.get('Image', {}).get('Bytes', '')))
+        if lines is None:
+            return request.send_json(400, {'__type': 'InvalidImageFormatException', 'message': 'Request has invalid image format'})
+
+        request.send_json(200, {'TextDetections': self.detections(lines), 'TextModelVersion': '3.0'})
+
+    def detections(self, lines):
+        detections = []
+        words = []
+        line_id = 0
+        for row, parts in enumerate(lines):
+            top = 0.04 + row * (0.9 / max(len(lines), 1))
+            # names and prices are separate LINE detections on the same row, as Rekognition usually returns them
+            for part_index, text in enumerate(parts):
+                left = 0.08 if part_index == 0 else 0.72
+                box = {'Width': 0.012 * len(text), 'Height': 0.02, 'Left': left, 'Top': top}
+                detections.append({'DetectedText': text, 'Type': 'LINE', 'Id': line_id, 'Confidence': 99.1, 'Geometry': {'BoundingBox': box}})
+
+                word_left = left
+                for word in text.split():
+                    word_box = {'Width': 0.012 * len(word), 'Height': 0.02, 'Left': word_left, 'Top': top}
+                    words.append({'DetectedText': word, 'Type': 'WORD', 'ParentId': line_id, 'Confidence': 98.7, 'Geometry': {'BoundingBox': word_box}})
+                    word_left += 0.012 * (len(word) + 1)
+                line_id += 1
+
+        for word_id, word in enumerate(words):
+            word['Id'] = line_id + word_id
+        return detections + words
+
+class FakeOpenAI(FakeService):
+    """Answers chat completions (plain, JSON mode, json_schema and streamed) the way SnapTrack's prompts expect
+    """
+
+    def __init__(self, schema, behavior: ServiceBehavior = None):
+        self.schema = schema
+        super().__init__(behavior)
+
+    def handle(self, request, method):
+        body = request.read_json()
+        self.count('chat.completions' + ('.stream' if body.get('stream') else ''))
+
+        outcome = self.behavior.outcome()
+        if outcome == 'throttled':
+            return request.send_json(429, {'error': {'message': 'Rate limit reached', 'type': 'rate_limit_error'}}, {'Retry-After': str(self.behavior.retry_after)})
+        if outcome == 'error':
+            return request.send_json(500, {'error': {'message': 'The server had an error', 'type': 'server_error'}})
+
+        prompt = body['messages'][0]['content']
+        content = self.reply(prompt, body.get('response_format'))
+        usage = {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(content) // 4, 'total_tokens': (len(prompt) + len(content)) // 4}
+        completion = {'id': f"chatcmpl-{uuid.uuid4().hex}", 'created': int(time.time()), 'model': body.get('model', 'gpt-3.5-turbo'), 'system_fingerprint': None}
+
+        if not body.get('stream'):
+            return request.send_json(200, dict(completion, object='chat.completion', usage=usage, choices=[
+                {'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop', 'logprobs': None}
+            ]))
+
+        request.send_response(200)
+        request.send_header('Content-Type', 'text/event-stream')
+        request.send_header('Transfer-Encoding', 'chunked')
+        request.end_headers()
+
+        def event(choices, **extra):
+            chunk = dict(completion, object='chat.completion.chunk', choices=choices, **extra)
+            request.send_chunk(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+
+        for start in range(0, len(content), 24):
+            event([{'index': 0, 'delta': {'content': content[start:start + 24]}, 'finish_reason': None}])
+        event([{'index': 0, 'delta': {}, 'finish_reason': 'stop'}])
+        if (body.get('stream_options') or {}).get('include_usage'):
+            event([], usage=usage)
+        request.send_chunk(b"data: [DONE]\n\n")
+        request.send_chunk(b"")
+
+    def reply(self, prompt, response_format):
+        rows, purchased = self.read_receipt(prompt)
+
+        if response_format is not None and response_format.get('type') == 'json_schema':
+            entry_schema = response_format['json_schema']['schema']['properties']['entries']['items']
+            return json.dumps({'entries': [{name: self.fake_value(name, prop, row, purchased) for name, prop in entry_schema['properties'].items()} for row in rows]})
+
+        if 'The entries are:' in prompt:
+            # batched classification: every entry gets an answer for every listed column
+            columns = re.findall(r'^- (.+?) \((Select|Multi-select)\), options: (\[.*\])$', prompt, re.MULTILINE)
+            entries = re.findall(r'^(\d+): \{', prompt, re.MULTILINE)
+            answer = {}
+            for index in entries:
+                answer[index] = {}
+                for name, kind, options in columns:
+                    options = json.loads(options)
+                    choice = options[int(index) % len(options)] if len(options) != 0 else ''
+                    answer[index][name] = choice if kind == 'Select' else [choice]
+            return json.dumps(answer)
+
+        if 'Your options are: ' in prompt:
+            options = prompt.split('Your options are: ', 1)[1].split('\n')[0].split(', ')
+            return f"['{options[0]}']" if 'PYTHON LIST' in prompt else options[0]
+
+        # extraction of the non-selection columns
+        columns = re.findall(r'^- (.+?) ?$', prompt.split('This list is text extracted from a paper receipt: ', 1)[-1], re.MULTILINE)
+        entries = [{name: self.fake_value(name, {'type': self.schema.get(name, {}).get('type')}, row, purchased) for name in columns} for row in rows]
+        return json.dumps(entries)
+
+    def read_receipt(self, prompt):
+        text = prompt.split('This list is text extracted from a paper receipt: ', 1)[-1]
+        purchased = DATE.search(text)
+        rows = []
+        for line in text.split('\n'):
+            match = PRICED_LINE.match(line.strip().strip('[],'))
+            if match is not None and NON_PRODUCT.search(match.group(1)) is None:
+                rows.append((match.group(1).title(), float(match.group(2))))
+        return rows, purchased.group(0) if purchased is not None else ''
+
+    def fake_value(self, name, prop, row, purchased):
+        column = self.schema.get(name, {})
+        column_type = column.get('type') or prop.get('type')
+        if column_type == 'title':
+            return row[0]
+        if column_type == 'number' or 'number' in str(prop.get('type')):
+            return row[1]
+        if column_type == 'date':
+            return purchased
+        if column_type in ['select', 'multi_select']:
+            options = [option['name'] for option in column[column_type]['options']]
+            choice = options[zlib.crc32(row[0].encode('utf-8')) % len(options)] if len(options) != 0 else ''
+            return choice if column_type == 'select' else [choice]
+        return ''
+
+class FakeNotion(FakeService):
+    """Serves a single database: retrieve, query (empty) and page creation, with Notion-style errors
+    """
+
+    def __init__(self, database_id, schema, behavior: ServiceBehavior = None):
+        self.database_id = database_id
+        self.schema = schema
+        self.pages = []
+        super().__init__(behavior)
+
+    def handle(self, request, method):
+        path = request.path.split('?')[0].rstrip('/')
+        body = request.read_json() if method != 'GET' else {}
+
+        if method == 'GET' and path.startswith('/v1/databases/'):
+            operation = 'databases.retrieve'
+        elif method == 'POST' and path.endswith('/query'):
+            operation = 'databases.query'
+        elif method == 'POST' and path == '/v1/pages':
+            operation = 'pages.create'
+        else:
+            return request.send_json(404, {'object': 'error', 'status': 404, 'code': 'object_not_found', 'message': f"{method} {path}"})
+        self.count(operation)
+
+        outcome = self.behavior.outcome()
+        if outcome == 'throttled':
+            return request.send_json(429, {'object': 'error', 'status': 429, 'code': 'rate_limited', 'message': 'You have been rate limited.'},
+                                     {'Retry-After': str(self.behavior.retry_after)})
+        if outcome == 'error':
+            return request.send_json(503, {'object': 'error', 'status': 503, 'code': 'service_unavailable', 'message': 'Notion is unavailable.'})
+
+        if operation == 'databases.retrieve':
+            return request.send_json(200, {
+                'object': 'database', 'id': self.database_id, 'last_edited_time': '2024-01-01T00:00:00.000Z',
+                'title': [{'plain_text': 'Finances'}], 'properties': self.schema
+            })
+
+        if operation == 'databases.query':
+            return request.send_json(200, {'object': 'list', 'results': [], 'has_more': False, 'next_cursor': None})
+
+        unknown = [name for name in body.get('properties', {}) if name not in self.schema]
+        if unknown:
+            return request.send_json(400, {'object': 'error', 'status': 400, 'code': 'validation_error', 'message': f"{unknown[0]} is not a property that exists."})
+
+        page_id = str(uuid.uuid4())
+        with self._lock:
+            self.pages.append(page_id)
+        request.send_json(200, {'object': 'page', 'id': page_id, 'properties': body.get('properties', {})})
+
+class FakeServices:
+    """Starts the three fakes against a shared database schema and gives the environment that points SnapTrack at them
+    """
+
+    def __init__(self, schema, rekognition: ServiceBehavior = None, openai: ServiceBehavior = None, notion: ServiceBehavior = None):
+        self.database_id = str(uuid.uuid4())
+        self.rekognition = FakeRekognition(rekognition)
+        self.openai = FakeOpenAI(schema, openai)
+        self.notion = FakeNotion(self.database_id, schema, notion)
+
+    def set_schema(self, schema):
+        self.openai.schema = schema
+        self.notion.schema = schema
+
+    def environment(self, aws_config_path, aws_credentials_path):
+        # a 'default' profile has to exist, since the parser opens its boto3 session with it
+        with open(aws_config_path, 'w', encoding='utf-8') as config_file:
+            config_file.write("[default]\nregion = us-east-1\n")
+        with open(aws_credentials_path, 'w', encoding='utf-8') as credentials_file:
+            credentials_file.write("[default]\naws_access_key_id = fake\naws_secret_access_key = fake\n")
+
+        return {
+            'AWS_CONFIG_FILE': aws_config_path,
+            'AWS_SHARED_CREDENTIALS_FILE': aws_credentials_path,
+            'AWS_ENDPOINT_URL_REKOGNITION': self.rekognition.url,
+            'OPENAI_BASE_URL': f"{self.openai.url}/v1",
+            'SNAPTRACK_NOTION_BASE_URL': self.notion.url,
+            'SNAPTRACK_OPENAI_API_KEY': 'fake',
+            'SNAPTRACK_NOTION_TOKEN': 'fake',
+            'SNAPTRACK_DATABASE_ID': self.database_id
+        }
+
+    def calls(self):
+        return {'rekognition': self.rekognition.snapshot(), 'openai': self.openai.snapshot(), 'notion': self.notion.snapshot()}
+
+    def close(self):
+        for service in [self.rekognition, self.openai, self.notion]:
+            service.close()
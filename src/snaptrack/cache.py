@@ -0,0 +1,152 @@
+import hashlib
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+def get_cache_dir(*subdirectories):
+    """Gets (and creates) the directory SnapTrack keeps its local caches in
+
+    Uses $SNAPTRACK_CACHE_DIR if set, otherwise $XDG_CACHE_HOME/snaptrack (~/.cache/snaptrack by default)
+
+    :param subdirectories: optional path components to append to the cache directory
+    :type subdirectories: str
+
+    :return: path of the directory
+    :rtype: Path
+    """
+    base = os.environ.get('SNAPTRACK_CACHE_DIR')
+    if base is None:
+        base = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'snaptrack')
+
+    path = Path(base, *subdirectories)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+def get_config_dir():
+    """Gets (and creates) the directory SnapTrack reads optional config files from
+
+    Uses $SNAPTRACK_CONFIG_DIR if set, otherwise $XDG_CONFIG_HOME/snaptrack (~/.config/snaptrack by default)
+
+    :return: path of the directory
+    :rtype: Path
+    """
+    base = os.environ.get('SNAPTRACK_CONFIG_DIR')
+    if base is None:
+        base = os.path.join(os.environ.get('XDG_CONFIG_HOME', os.path.join(os.path.expanduser('~'), '.config')), 'snaptrack')
+
+    path = Path(base)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+class DiskCache:
+    """Size-bounded key/value store kept in SQLite, evicting least recently used entries first
+    """
+
+    def __init__(self, path, max_bytes: int, max_age: float = None):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        # counters for reporting how useful the cache was
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # a single connection shared between threads, guarded by a lock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+        self._connection.commit()
+
+    @staticmethod
+    def make_key(*parts):
+        """Hashes the given parts (str or bytes) into a cache key
+
+        :return: hex digest identifying the parts
+        :rtype: str
+        """
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode('utf-8')
+            # length prefix keeps ('ab', 'c') and ('a', 'bc') apart
+            digest.update(len(part).to_bytes(8, 'big'))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Gets a value from the cache
+
+        :param key: key of the entry
+        :type key: str
+
+        :return: the stored value, or None if it isn't cached (or has expired)
+        :rtype: str
+        """
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT value, created_at FROM entries WHERE key = ?", (key,)).fetchone()
+
+            if row is not None and self.max_age is not None and now - row[1] > self.max_age:
+                self._connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._connection.commit()
+                self.evictions += 1
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self._connection.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+            self._connection.commit()
+            self.hits += 1
+
+        value = row[0]
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def set(self, key, value: str):
+        """Stores a value in the cache, evicting the least recently used entries if over the size limit
+
+        :param key: key of the entry
+        :type key: str
+        :param value: value to store
+        :type value: str
+        """
+        encoded = value.encode('utf-8')
+        now = time.time()
+
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, encoded, len(encoded), now, now)
+            )
+
+            total_size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            while total_size > self.max_bytes:
+                oldest = self._connection.execute("SELECT key, size FROM entries ORDER BY accessed_at ASC LIMIT 1").fetchone()
+                if oldest is None:
+                    break
+                self._connection.execute("DELETE FROM entries WHERE key = ?", (oldest[0],))
+                total_size -= oldest[1]
+                self.evictions += 1
+
+            self._connection.commit()
+
+    def stats(self):
+        """Gets statistics about the cache
+
+        :return: hits, misses, evictions, number of entries and their total size in bytes
+        :rtype: dictionary
+        """
+        with self._lock:
+            entries, size = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': entries, 'bytes': size}
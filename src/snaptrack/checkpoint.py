@@ -0,0 +1,106 @@
+import json
+import threading
+import time
+from snaptrack.cache import DiskCache, get_cache_dir
+
+# stages a receipt goes through, in order ('streamed' holds the entries of a streamed reply that isn't finished yet)
+STAGES = ['ocr', 'streamed', 'entries', 'classified', 'inserted']
+
+class ReceiptCheckpoint:
+    """Progress of a single receipt, persisted after every stage so an interrupted run can resume where it failed
+    """
+
+    def __init__(self, path=None, receipt_id=None):
+        # without a path the checkpoint is only kept in memory
+        self.path = path
+        self.receipt_id = receipt_id
+        self._lock = threading.Lock()
+
+        self.state = {}
+        if self.path is not None:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as checkpoint_file:
+                    self.state = json.load(checkpoint_file)
+            except (OSError, ValueError):
+                self.state = {}
+
+        self.state.setdefault('inserted', {})
+
+    @classmethod
+    def for_receipt(cls, filepath, database_id):
+        """Gets the checkpoint for a receipt image going into a database
+
+        Checkpoints are keyed by the image's contents, so a renamed or copied file still resumes.
+
+        :param filepath: path of the receipt image
+        :type filepath: str
+        :param database_id: ID of the Notion database the receipt is sent to
+        :type database_id: str
+
+        :return: the receipt's checkpoint (empty if it hasn't been processed before)
+        :rtype: ReceiptCheckpoint
+        """
+        with open(filepath, 'rb') as image_file:
+            receipt_id = DiskCache.make_key(database_id, image_file.read())
+
+        return cls(get_cache_dir('checkpoints') / f"{receipt_id}.json", receipt_id)
+
+    def has(self, stage):
+        return stage in self.state and stage != 'inserted'
+
+    def get(self, stage):
+        return self.state.get(stage)
+
+    def save(self, stage, value):
+        """Records the output of a stage
+
+        :param stage: one of STAGES
+        :type stage: str
+        :param value: JSON serializable output of the stage
+        """
+        with self._lock:
+            self.state[stage] = value
+            self.__write()
+
+    def inserted_rows(self):
+        """Gets the rows already written to Notion
+
+        :return: page ID of every inserted row, keyed by the row's index
+        :rtype: dictionary where int -> str
+        """
+        with self._lock:
+            return {int(index): page_id for index, page_id in self.state['inserted'].items()}
+
+    def mark_inserted(self, index, page_id):
+        """Records that a row was written to Notion, as soon as it happens
+
+        :param index: index of the row in the receipt's products
+        :type index: int
+        :param page_id: ID of the page created for the row
+        :type page_id: str
+        """
+        with self._lock:
+            self.state['inserted'][str(index)] = page_id
+            self.__write()
+
+    def clear(self):
+        """Deletes the checkpoint once the receipt has been fully processed
+        """
+        with self._lock:
+            self.state = {'inserted': {}}
+            if self.path is not None:
+                try:
+                    self.path.unlink()
+                except OSError:
+                    pass
+
+    def __write(self):
+        self.state['updated_at'] = time.time()
+        if self.path is None:
+            return
+
+        # write to a temporary file first so an interrupted run can't leave a corrupt checkpoint
+        temporary_path = self.path.with_suffix('.tmp')
+        with open(temporary_path, 'w', encoding='utf-8') as checkpoint_file:
+            json.dump(self.state, checkpoint_file)
+        temporary_path.replace(self.path)
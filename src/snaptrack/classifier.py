@@ -0,0 +1,370 @@
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+from snaptrack.cache import get_cache_dir
+
+# posterior probability a prediction needs before GPT is skipped for it
+CONFIDENCE_THRESHOLD = 0.9
+
+# number of examples an option needs before the model predicts it
+MIN_EXAMPLES = 5
+
+# the n-grams of a name overlap heavily, so together they only count as this many independent observations
+EVIDENCE_WEIGHT = 4
+
+class CategoryClassifier:
+    """Local classifier for select and multi_select columns, learned from rows already in the database
+
+    Items seen before are answered from an exact-match memory; other items use a multinomial naive
+    Bayes model over character n-grams of the item's name. The model is persisted to disk and
+    updated incrementally after every accepted receipt.
+    """
+
+    def __init__(self, path=None, threshold: float = CONFIDENCE_THRESHOLD):
+        # without a path the model is only kept in memory
+        self.path = path
+        self.threshold = threshold
+        self._lock = threading.Lock()
+
+        self.columns = {}
+        self.synced_at = None
+
+        # what was learned from each page, so pages seen again aren't counted twice
+        self.pages = {}
+        # rows learned before their page existed (queued in the outbox), keyed by their record
+        self.unmatched = {}
+
+        # number of distinct features per column, used for smoothing
+        self._vocabularies = {}
+
+        if self.path is not None:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as model_file:
+                    state = json.load(model_file)
+                self.columns = state['columns']
+                self.synced_at = state.get('synced_at')
+                self.pages = state.get('pages', {})
+                self.unmatched = state.get('unmatched', {})
+            except (OSError, ValueError, KeyError):
+                self.columns = {}
+
+        for column_name, model in self.columns.items():
+            self._vocabularies[column_name] = set(feature for counts in model['feature_counts'].values() for feature in counts)
+
+    @classmethod
+    def for_database(cls, database_id, threshold: float = CONFIDENCE_THRESHOLD):
+        """Loads the classifier kept for a database
+
+        :param database_id: ID of the Notion database
+        :type database_id: str
+        :param threshold: posterior probability needed to skip GPT, defaults to CONFIDENCE_THRESHOLD
+        :type threshold: float, optional
+
+        :return: the database's classifier (empty if it hasn't been trained yet)
+        :rtype: CategoryClassifier
+        """
+        return cls(get_cache_dir('classifier') / f"{database_id}.json", threshold)
+
+    @staticmethod
+    def normalize(text):
+        """Normalizes an item's name so trivially different spellings are treated the same
+
+        :param text: name of the item
+        :type text: str
+
+        :return: lowercased name with punctuation removed and whitespace collapsed
+        :rtype: str
+        """
+        return ' '.join(re.sub(r'[^a-z0-9 ]', ' ', str(text).lower()).split())
+
+    def features(self, text):
+        """Gets the character n-grams and words of a normalized name
+
+        :param text: normalized name of the item
+        :type text: str
+
+        :return: feature counts
+        :rtype: dictionary where str -> int
+        """
+        counts = {}
+        for word in text.split():
+            # digits say more about sizes than categories
+            if not word.isdigit():
+                counts['w:' + word] = counts.get('w:' + word, 0) + 1
+
+            padded = f" {word} "
+            for size in [3, 4, 5]:
+                for start in range(len(padded) - size + 1):
+                    gram = padded[start:start + size]
+                    counts[gram] = counts.get(gram, 0) + 1
+        return counts
+
+    def learn(self, text, column_name, column_type, value):
+        """Adds an example for a column
+
+        :param text: name of the item
+        :type text: str
+        :param column_name: name of the select or multi_select column
+        :type column_name: str
+        :param column_type: 'select' or 'multi_select'
+        :type column_type: str
+        :param value: option chosen for the item (a list of options for multi_select)
+        :type value: str or list of str
+        """
+        normalized = self.normalize(text)
+        labels = [label for label in (value if isinstance(value, list) else [value]) if label]
+        if normalized == '' or len(labels) == 0:
+            return
+
+        features = self.features(normalized)
+
+        with self._lock:
+            model = self.columns.setdefault(column_name, {'type': column_type, 'doc_counts': {}, 'feature_counts': {}, 'feature_totals': {}, 'memory': {}})
+            vocabulary = self._vocabularies.setdefault(column_name, set())
+
+            model['memory'][normalized] = value
+            for label in labels:
+                model['doc_counts'][label] = model['doc_counts'].get(label, 0) + 1
+                label_counts = model['feature_counts'].setdefault(label, {})
+                for feature, count in features.items():
+                    label_counts[feature] = label_counts.get(feature, 0) + count
+                    vocabulary.add(feature)
+                model['feature_totals'][label] = model['feature_totals'].get(label, 0) + sum(features.values())
+
+    def forget(self, text, column_name, value):
+        """Removes an example added by learn(), e.g. once its row was recategorized
+
+        :param text: name of the item
+        :type text: str
+        :param column_name: name of the select or multi_select column
+        :type column_name: str
+        :param value: option the item was learned with (a list of options for multi_select)
+        :type value: str or list of str
+        """
+        normalized = self.normalize(text)
+        labels = [label for label in (value if isinstance(value, list) else [value]) if label]
+        if normalized == '' or len(labels) == 0:
+            return
+
+        features = self.features(normalized)
+
+        with self._lock:
+            model = self.columns.get(column_name)
+            if model is None:
+                return
+
+            if model['memory'].get(normalized) == value:
+                del model['memory'][normalized]
+            for label in labels:
+                if label not in model['doc_counts']:
+                    continue
+
+                model['doc_counts'][label] -= 1
+                label_counts = model['feature_counts'][label]
+                for feature, count in features.items():
+                    remaining = label_counts.get(feature, 0) - count
+                    if remaining > 0:
+                        label_counts[feature] = remaining
+                    else:
+                        label_counts.pop(feature, None)
+                model['feature_totals'][label] -= sum(features.values())
+
+                if model['doc_counts'][label] <= 0:
+                    del model['doc_counts'][label]
+                    del model['feature_counts'][label]
+                    del model['feature_totals'][label]
+
+    def predict(self, text, column_name, options):
+        """Predicts the value of a column for an item
+
+        :param text: name of the item
+        :type text: str
+        :param column_name: name of the select or multi_select column
+        :type column_name: str
+        :param options: options the column currently has
+        :type options: list of str
+
+        :return: the predicted value (a list for multi_select) and its confidence, or (None, 0.0)
+        :rtype: tuple
+        """
+        normalized = self.normalize(text)
+        if normalized == '':
+            return None, 0.0
+
+        # learn() updates the counts from the insert threads while others are still predicting
+        with self._lock:
+            return self.__predict(normalized, column_name, options)
+
+    def __predict(self, normalized, column_name, options):
+        model = self.columns.get(column_name)
+        if model is None:
+            return None, 0.0
+
+        multi = model['type'] == 'multi_select'
+
+        # items seen before get the value they were given last time, as long as the options still exist
+        remembered = model['memory'].get(normalized)
+        if remembered is not None:
+            remembered_labels = remembered if isinstance(remembered, list) else [remembered]
+            if all(label in options for label in remembered_labels):
+                return remembered, 1.0
+
+        labels = [label for label in model['doc_counts'] if label in options and model['doc_counts'][label] >= MIN_EXAMPLES]
+        if len(labels) == 0:
+            return None, 0.0
+
+        features = self.features(normalized)
+        vocabulary_size = max(1, len(self._vocabularies.get(column_name, ())))
+        total_docs = sum(model['doc_counts'][label] for label in labels)
+
+        feature_total = sum(features.values())
+
+        scores = {}
+        for label in labels:
+            label_counts = model['feature_counts'][label]
+            denominator = model['feature_totals'][label] + vocabulary_size
+            likelihood = 0.0
+            for feature, count in features.items():
+                likelihood += count * math.log((label_counts.get(feature, 0) + 1) / denominator)
+            # naive Bayes treats every n-gram as independent evidence, which pushes the posterior to ~1.0
+            # even for items that mix categories, so the likelihood is scaled down to EVIDENCE_WEIGHT features
+            scores[label] = math.log(model['doc_counts'][label] / total_docs) + likelihood * EVIDENCE_WEIGHT / feature_total
+
+        # softmax over the log scores
+        best = max(scores, key=scores.get)
+        normalizer = sum(math.exp(score - scores[best]) for score in scores.values())
+        confidence = 1 / normalizer
+
+        return ([best] if multi else best), confidence
+
+    def classify(self, entries, text_column, select_columns):
+        """Fills in the selection columns the model is confident about
+
+        :param entries: entries keyed by column name, updated in place
+        :type entries: list of dictionaries
+        :param text_column: name of the column holding the item's name
+        :type text_column: str
+        :param select_columns: (name, type, options) of every selection column
+        :type select_columns: list of tuples
+
+        :return: the entries that still need at least one selection column classified
+        :rtype: list of dictionaries
+        """
+        remaining = []
+        for entry in entries:
+            complete = True
+            for column_name, _, options in select_columns:
+                value, confidence = self.predict(entry.get(text_column, ''), column_name, options)
+                if value is not None and confidence >= self.threshold:
+                    entry[column_name] = value
+                else:
+                    complete = False
+            if not complete:
+                remaining.append(entry)
+        return remaining
+
+    def learn_entries(self, entries, text_column, columns, page_ids=None):
+        """Learns from entries whose classifications were accepted
+
+        Entries whose page was already learned with the same values are skipped; a page whose values
+        changed replaces what was learned from it before.
+
+        :param entries: entries keyed by column name
+        :type entries: list of dictionaries
+        :param text_column: name of the column holding the item's name
+        :type text_column: str
+        :param columns: columns of the database, structured as {'name': column_name, 'type': column_type}
+        :type columns: list of dictionaries
+        :param page_ids: ID of each entry's page (None for rows not created yet), defaults to None
+        :type page_ids: list of str, optional
+
+        :return: number of entries learned from
+        :rtype: int
+        """
+        types = {column['name']: column['type'] for column in columns if column['type'] in ['select', 'multi_select']}
+
+        learned = 0
+        for entry, page_id in zip(entries, page_ids or [None] * len(entries)):
+            record = self.__record(entry, text_column, types)
+            key = json.dumps(record, sort_keys=True)
+
+            with self._lock:
+                previous = None
+                if page_id is None:
+                    self.unmatched[key] = self.unmatched.get(key, 0) + 1
+                else:
+                    previous = self.pages.get(page_id)
+                    if previous == record:
+                        continue
+                    self.pages[page_id] = record
+
+                    # the row was learned when it was queued, this is its page showing up
+                    if previous is None and self.unmatched.get(key, 0) > 0:
+                        self.unmatched[key] -= 1
+                        if self.unmatched[key] == 0:
+                            del self.unmatched[key]
+                        continue
+
+            if previous is not None:
+                for column_name, value in previous['values'].items():
+                    self.forget(previous['text'], column_name, value)
+            for column_name, value in record['values'].items():
+                self.learn(record['text'], column_name, types[column_name], value)
+            learned += 1
+
+        return learned
+
+    def __record(self, entry, text_column, types):
+        values = {}
+        for column_name in types:
+            value = entry.get(column_name)
+            if isinstance(value, list):
+                value = sorted(label for label in value if label)
+            if value:
+                values[column_name] = value
+        return {'text': self.normalize(entry.get(text_column, '')), 'values': values}
+
+    def train_from_database(self, database):
+        """Learns from the database's rows, only fetching pages edited since the last sync
+
+        :param database: the database to learn from
+        :type database: NotionDB
+
+        :return: number of pages learned from (pages already learned are skipped)
+        :rtype: int
+        """
+        text_column = next((column['name'] for column in database.columns if column['type'] == 'title'), None)
+        if text_column is None:
+            return 0
+
+        learned = 0
+        latest = self.synced_at
+        for page in database.iter_pages(edited_after=self.synced_at):
+            learned += self.learn_entries([database.page_values(page)], text_column, database.columns, [page['id']])
+            if latest is None or page['last_edited_time'] > latest:
+                latest = page['last_edited_time']
+
+        self.synced_at = latest
+        return learned
+
+    def save(self):
+        """Writes the model to disk
+        """
+        if self.path is None:
+            return
+
+        with self._lock:
+            state = json.dumps({'columns': self.columns, 'synced_at': self.synced_at, 'pages': self.pages, 'unmatched': self.unmatched})
+
+        # write to a temporary file of its own first, so an interrupted run can't leave a corrupt model
+        # and concurrent saves can't rename each other's file away
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(self.path), suffix='.tmp', delete=False) as model_file:
+            model_file.write(state)
+        try:
+            os.replace(model_file.name, self.path)
+        except OSError:
+            os.unlink(model_file.name)
+            raise
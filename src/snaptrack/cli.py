@@ -1,17 +1,55 @@
 import click
 from colorama import Fore
-from dotenv import load_dotenv
-import keyring
+import glob
 import os
 from snaptrack.receipt_parser import ReceiptParser
-from snaptrack.notion import NotionDB
+from snaptrack.classifier import CategoryClassifier
+from snaptrack.duplicates import DuplicateIndex
+from snaptrack.local_extractor import CONFIDENCE_THRESHOLD, LocalExtractor
+from snaptrack.metrics import JSONLinesExporter, Metrics
+from snaptrack.notion import NotionDB, NotionDBError
+from snaptrack.pipeline import ReceiptPipeline
+from snaptrack.preprocess import ImagePreprocessor, MAX_IMAGE_BYTES, TARGET_LONG_EDGE
 import time
 from yaspin import yaspin
 
-# load environment variables
-load_dotenv()
+# file types picked up when a directory or glob is given
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.heic', '.webp', '.tif', '.tiff', '.bmp']
+
+# credentials read from keyring, looked up once per process
+_credentials = None
+
+def load_environment():
+    # load environment variables (only once a command actually runs, so --help stays fast)
+    from dotenv import load_dotenv
+    load_dotenv()
+
+def get_credentials():
+    """Reads SnapTrack's credentials, only the first time it is called
+
+    $SNAPTRACK_OPENAI_API_KEY, $SNAPTRACK_NOTION_TOKEN and $SNAPTRACK_DATABASE_ID take precedence over
+    keyring, for scripted runs and benchmarks that shouldn't touch the user's keyring.
+
+    :return: the OpenAI API key, Notion API token and Notion database ID (None for any not set yet)
+    :rtype: dictionary
+    """
+    global _credentials
+    if _credentials is None:
+        names = ['openai_api_key', 'notion_token', 'database_id']
+        _credentials = {name: os.environ.get(f"SNAPTRACK_{name.upper()}") for name in names}
+
+        if any(value is None for value in _credentials.values()):
+            # keyring discovers its backends on import, which is slow enough to matter for short commands
+            import keyring
+            for name in names:
+                if _credentials[name] is None:
+                    _credentials[name] = keyring.get_password("snaptrack", name)
+
+    return _credentials
 
 def load_credentials():
+    import keyring
+
     # getting user's input to set credentials
     openai_api_key = click.prompt("Enter your OpenAI API key", hide_input=True)
     notion_token = click.prompt("Enter your Notion API token", hide_input=True)
@@ -22,60 +60,254 @@ def load_credentials():
     keyring.set_password("snaptrack", "notion_token", notion_token)
     keyring.set_password("snaptrack", "database_id", database_id)
 
+    get_credentials().update(openai_api_key=openai_api_key, notion_token=notion_token, database_id=database_id)
+
 # TODO: add option to reset credentials to new details
 
-@click.command()
-@click.argument('filepath', type=click.Path(exists=True), nargs=1)
-@click.option('--verbose', '-v', is_flag=True, help='Show time elapsed for each operation')
-def send_receipt(filepath, verbose):
-    """Send receipt to Notion database"""
-    spinner = yaspin(text="Processing...", color="yellow")
+def expand_paths(paths):
+    """Expands files, directories and glob patterns into a list of receipt images
+
+    :param paths: paths given on the command line
+    :type paths: list of str
+
+    :return: paths of the images, without duplicates
+    :rtype: list of str
+    """
+    def is_image(path):
+        return os.path.isfile(path) and os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+    filepaths = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = sorted(os.path.join(path, name) for name in os.listdir(path))
+            filepaths += [match for match in matches if is_image(match)]
+        elif os.path.isfile(path):
+            filepaths.append(path)
+        elif any(character in path for character in '*?['):
+            filepaths += [match for match in sorted(glob.glob(path, recursive=True)) if is_image(match)]
+        else:
+            raise click.BadParameter(f"Path '{path}' does not exist.", param_hint="'PATHS...'")
 
+    return list(dict.fromkeys(filepaths))
+
+class DefaultCommandGroup(click.Group):
+    """Group that runs its default command when the first argument isn't one of its commands, so `snaptrack FILE` keeps working
+    """
+
+    def __init__(self, *args, default_command=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default_command = default_command
+
+    def parse_args(self, ctx, args):
+        if len(args) != 0 and args[0] not in self.commands and args[0] not in ctx.help_option_names:
+            args = [self.default_command] + list(args)
+        return super().parse_args(ctx, args)
+
+@click.group(cls=DefaultCommandGroup, default_command='send')
+def cli():
+    """Send receipts to a Notion database (`snaptrack PATHS...` is short for `snaptrack send PATHS...`)"""
+
+def parser_options(function):
+    """Adds the options that configure the ReceiptParser, passed on to create_receipt_parser"""
+    options = [
+        click.option('--batch-select/--no-batch-select', default=True, help='Classify all selection columns in a single GPT call (default) or one call per entry'),
+        click.option('--structured', is_flag=True, help='Extract every column in a single schema-constrained GPT call'),
+        click.option('--llm-cache', is_flag=True, help='Reuse cached GPT replies for identical prompts'),
+        click.option('--llm-cache-size', default=50, show_default=True, help='Maximum size of the GPT reply cache in MB'),
+        click.option('--llm-cache-age', default=30.0, show_default=True, help='Maximum age of cached GPT replies in days'),
+        click.option('--bypass-llm-cache', is_flag=True, help='Ignore cached GPT replies (fresh replies are still cached)'),
+        click.option('--compact-ocr/--no-compact-ocr', default=True, help='Rebuild receipt rows from OCR geometry before prompting GPT (default) or send every detection'),
+        click.option('--preprocess/--no-preprocess', default=True, help='Straighten, grayscale, crop, downscale and recompress images before OCR (default) or upload them as-is'),
+        click.option('--max-edge', default=TARGET_LONG_EDGE, show_default=True, help='Long edge in pixels images are downscaled to before OCR (the width, with --tile)'),
+        click.option('--tile', is_flag=True, help='OCR long receipts as overlapping strips so text past Rekognition\'s word limit isn\'t lost'),
+        click.option('--local/--no-local', default=True, help='Read simple receipts with local rules and only use GPT when they aren\'t confident (default) or always use GPT'),
+        click.option('--local-threshold', default=CONFIDENCE_THRESHOLD, show_default=True, help='Confidence local extraction needs to skip GPT')
+    ]
+    for option in reversed(options):
+        function = option(function)
+    return function
+
+def metrics_options(function):
+    """Adds the options that export spans and counters, passed on to create_metrics and report_metrics"""
+    options = [
+        click.option('--profile', is_flag=True, help='Print a breakdown of where time, API calls and tokens went'),
+        click.option('--metrics-jsonl', type=click.Path(dir_okay=False), default=None, help='Append every span and counter to this JSON-lines file'),
+        click.option('--metrics-prom', type=click.Path(dir_okay=False), default=None, help='Write counters and span summaries to this Prometheus textfile')
+    ]
+    for option in reversed(options):
+        function = option(function)
+    return function
+
+def create_metrics(metrics_jsonl: str = None):
+    metrics = Metrics()
+    exporter = JSONLinesExporter(metrics_jsonl, metrics) if metrics_jsonl is not None else None
+    return metrics, exporter
+
+def report_metrics(metrics: Metrics, exporter: JSONLinesExporter, spinner: yaspin, profile: bool = False, metrics_prom: str = None):
+    if exporter is not None:
+        exporter.close()
+    if metrics_prom is not None:
+        metrics.write_prometheus(metrics_prom)
+    if profile:
+        spinner.write(metrics.format_breakdown())
+
+def ensure_credentials(spinner: yaspin):
     # if details don't exist already, prompt user to set them
-    if keyring.get_password("snaptrack", "openai_api_key") is None:
+    if get_credentials()['openai_api_key'] is None:
         spinner.write("Thank you for using SnapTrack. First time setup detected. To get started, please enter your OpenAI API token, Notion API token and specific Notion database ID.")
         load_credentials()
-    
-    if verbose:
-        add_receipt(filepath, spinner, verbose=True)
-    else:
-        add_receipt(filepath, spinner, verbose=False)
 
-def add_receipt(filepath: str, spinner: yaspin, verbose: bool):
+@cli.command(name='send')
+@click.argument('paths', type=click.Path(), nargs=-1, required=True)
+@click.option('--verbose', '-v', is_flag=True, help='Show time elapsed for each operation')
+@click.option('--dry-run', is_flag=True, help='List the receipts that would be processed without calling any service')
+@click.option('--refresh-schema', is_flag=True, help='Ignore the cached database schema and fetch it from Notion again')
+@click.option('--local-classifier/--no-local-classifier', default=True, help='Answer selection columns for familiar items with a local model learned from the database (default) or always use GPT')
+@click.option('--train-classifier', is_flag=True, help='Teach the local classifier rows added or edited in Notion since it was last trained')
+@click.option('--stream', is_flag=True, help='Stream GPT\'s reply so rows are classified and inserted while later ones are still being generated')
+@click.option('--ocr-workers', default=4, show_default=True, help='Receipts sent for OCR at once when processing several receipts')
+@click.option('--llm-workers', default=4, show_default=True, help='Receipts sent to GPT at once when processing several receipts')
+@click.option('--notion-workers', default=2, show_default=True, help='Receipts written to Notion at once when processing several receipts')
+@click.option('--outbox', is_flag=True, help='Journal rows to a local outbox and send them to Notion in the background, so Notion outages delay rows instead of failing receipts')
+@click.option('--allow-duplicates', is_flag=True, help='Send receipts even if they match one sent before')
+@metrics_options
+@parser_options
+def send_receipt(paths, verbose, dry_run, refresh_schema, local_classifier, train_classifier, stream, ocr_workers, llm_workers, notion_workers, outbox,
+                 allow_duplicates, profile, metrics_jsonl, metrics_prom, **parser_options):
+    """Send receipts (files, directories or glob patterns) to Notion database"""
+    spinner = yaspin(text="Processing...", color="yellow")
+
+    filepaths = expand_paths(paths)
+    if len(filepaths) == 0:
+        raise click.BadParameter("No receipt images found.", param_hint="'PATHS...'")
+
+    if dry_run:
+        for filepath in filepaths:
+            spinner.write(filepath)
+        spinner.write(Fore.YELLOW + f"[Dry run: {len(filepaths)} receipt(s) would be processed]" + Fore.RESET)
+        return
+
+    load_environment()
+    ensure_credentials(spinner)
+
+    metrics, exporter = create_metrics(metrics_jsonl)
+    try:
+        if len(filepaths) == 1:
+            add_receipt(
+                filepaths[0], spinner, verbose=verbose, refresh_schema=refresh_schema,
+                local_classifier=local_classifier, train_classifier=train_classifier, stream=stream, outbox=outbox, allow_duplicates=allow_duplicates, metrics=metrics, **parser_options
+            )
+        else:
+            add_receipts(
+                filepaths, spinner, verbose=verbose, refresh_schema=refresh_schema,
+                local_classifier=local_classifier, train_classifier=train_classifier,
+                ocr_workers=ocr_workers, llm_workers=llm_workers, notion_workers=notion_workers, outbox=outbox, allow_duplicates=allow_duplicates, metrics=metrics, **parser_options
+            )
+    finally:
+        # failed runs are the ones most worth profiling
+        report_metrics(metrics, exporter, spinner, profile, metrics_prom)
+
+def create_receipt_parser(spinner: yaspin, verbose: bool, batch_select: bool = True, structured: bool = False,
+                          llm_cache: bool = False, llm_cache_size: int = 50, llm_cache_age: float = 30.0, bypass_llm_cache: bool = False,
+                          compact_ocr: bool = True, preprocess: bool = True, max_edge: int = TARGET_LONG_EDGE, tile: bool = False,
+                          local: bool = True, local_threshold: float = CONFIDENCE_THRESHOLD, metrics: Metrics = None):
+    # loading credentials from keyring
+    openai_api_key = get_credentials()['openai_api_key']
+
+    return ReceiptParser(
+        openai_api_key, spinner, verbose, batch_select=batch_select, structured=structured,
+        llm_cache=llm_cache, llm_cache_max_bytes=llm_cache_size * 1024 * 1024,
+        llm_cache_max_age=llm_cache_age * 24 * 60 * 60, bypass_llm_cache=bypass_llm_cache,
+        compact_ocr=compact_ocr,
+        preprocessor=ImagePreprocessor(target_long_edge=max_edge, max_bytes=MAX_IMAGE_BYTES) if preprocess else None,
+        tile_ocr=tile,
+        local_extractor=LocalExtractor(threshold=local_threshold) if local else None,
+        metrics=metrics
+    )
+
+def create_database(spinner: yaspin, refresh_schema: bool = False, metrics: Metrics = None):
+    # loading credentials from keyring
+    notion_token = get_credentials()['notion_token']
+    database_id = get_credentials()['database_id']
+
+    return NotionDB(notion_token, database_id, spinner, refresh_schema=refresh_schema, metrics=metrics)
+
+def load_classifier(database: NotionDB, spinner: yaspin, verbose: bool, train: bool = False):
+    classifier = CategoryClassifier.for_database(database.database_id)
+
+    # an untrained model learns from every existing row first; later runs only learn on request
+    if train or classifier.synced_at is None:
+        spinner.text = "Training local classifier on existing rows..."
+        learned = classifier.train_from_database(database)
+        classifier.save()
+        if verbose:
+            spinner.write(Fore.YELLOW + f"[Local classifier learned from {learned} row(s)]" + Fore.RESET)
+
+    return classifier
+
+def start_flusher(database: NotionDB, workers: int = 2):
+    from snaptrack.outbox import Outbox, OutboxFlusher
+
+    # rows journaled by earlier runs that never reached Notion are sent first
+    flusher = OutboxFlusher(database, Outbox.default(), workers=workers)
+    flusher.start()
+    return flusher
+
+def stop_flusher(flusher, spinner: yaspin):
+    spinner.text = "Sending queued rows to Notion..."
+    spinner.start()
+    try:
+        flusher.stop(drain=True)
+    except KeyboardInterrupt:
+        # whatever is left stays in the outbox for `snaptrack flush`
+        flusher.stop(drain=False)
+    spinner.stop()
+    spinner.text = ''
+
+    stats = flusher.outbox.stats(flusher.database.database_id)
+    if stats['pending'] + stats['failed'] != 0:
+        spinner.write(Fore.YELLOW + f"[{stats['pending'] + stats['failed']} row(s) are still in the outbox, run `snaptrack flush` to send them]" + Fore.RESET)
+
+def add_receipt(filepath: str, spinner: yaspin, verbose: bool, refresh_schema: bool = False, local_classifier: bool = True, train_classifier: bool = False,
+                stream: bool = False, outbox: bool = False, allow_duplicates: bool = False, metrics: Metrics = None, **parser_options):
     start = time.time()
 
-    # loading credentials from keyring    
-    openai_api_key = keyring.get_password("snaptrack", "openai_api_key")
-    notion_token = keyring.get_password("snaptrack", "notion_token")
-    database_id = keyring.get_password("snaptrack", "database_id")
-
-    receipt_parser = ReceiptParser(openai_api_key, spinner, verbose)
-    database = NotionDB(notion_token, database_id, spinner)
-
-    products_valid = False
-    products = None
-
-    attempt_number = 1
-    while not products_valid:
-        if attempt_number == 5:
-            raise Exception("Unable to parse receipt")
-        
-        products = receipt_parser.parse(
-            filepath = filepath, 
-            columns = database.columns, 
-            select_options = database.select_options
-        )
-
-        if len(products) != 0:
-            products_valid = True
-
-        attempt_number += 1
-        time.sleep(1)
-
-    spinner.text = "Adding entries to database..."
-    for product in products:
-        database.add_row(product)
+    receipt_parser = create_receipt_parser(spinner, verbose, metrics=metrics, **parser_options)
+    database = create_database(spinner, refresh_schema, metrics=metrics)
+    if local_classifier:
+        receipt_parser.classifier = load_classifier(database, spinner, verbose, train_classifier)
+
+    # each stage is checkpointed and retried on its own, so a failed run picks up where it stopped
+    flusher = start_flusher(database) if outbox else None
+    pipeline = ReceiptPipeline(receipt_parser, database, spinner, flusher=flusher, duplicates=DuplicateIndex.default(), allow_duplicates=allow_duplicates)
+
+    spinner.start()
+    try:
+        result = pipeline.stream(filepath) if stream else pipeline.process(filepath)
+    finally:
+        if flusher is not None:
+            spinner.stop()
+            stop_flusher(flusher, spinner)
     end = time.time()
+
+    if result.skipped:
+        spinner.stop()
+        spinner.write(Fore.YELLOW + f"[Receipt is a {result.duplicate.describe()}, use --allow-duplicates to send it anyway]" + Fore.RESET)
+        spinner.text = ''
+        spinner.ok(Fore.YELLOW + "↷ Duplicate receipt skipped" + Fore.RESET)
+        return
+
+    if result.error is not None:
+        spinner.fail(Fore.RED + f"❌ unable to process receipt during {result.stage} stage" + Fore.RESET)
+        raise result.error
+
+    failed = [row for row in result.rows if not row.ok]
+    if len(failed) != 0:
+        for row in failed:
+            spinner.write(Fore.RED + f"[Row {row.index + 1} not added: {row.error}]" + Fore.RESET)
+        spinner.fail(Fore.RED + f"❌ unable to add {len(failed)} of {len(result.rows)} row(s) to database" + Fore.RESET)
+        raise NotionDBError(error_msg=f"Unable to add {len(failed)} of {len(result.rows)} rows to database")
+
     spinner.stop()
 
     if verbose:
@@ -84,5 +316,285 @@ def add_receipt(filepath: str, spinner: yaspin, verbose: bool):
     spinner.text = ''
     spinner.ok(Fore.GREEN + "🎉 Receipt details sent to database" + Fore.RESET)
 
+def add_receipts(filepaths, spinner: yaspin, verbose: bool, refresh_schema: bool = False, local_classifier: bool = True, train_classifier: bool = False,
+                 ocr_workers: int = 4, llm_workers: int = 4, notion_workers: int = 2, outbox: bool = False, allow_duplicates: bool = False, metrics: Metrics = None, **parser_options):
+    start = time.time()
+
+    # one set of clients and one schema fetch shared by every receipt
+    receipt_parser = create_receipt_parser(spinner, verbose, metrics=metrics, **parser_options)
+    database = create_database(spinner, refresh_schema, metrics=metrics)
+    if local_classifier:
+        receipt_parser.classifier = load_classifier(database, spinner, verbose, train_classifier)
+
+    # rows journaled by finished receipts are sent while later receipts are still being read
+    flusher = start_flusher(database, notion_workers) if outbox else None
+    pipeline = ReceiptPipeline(receipt_parser, database, spinner, ocr_workers=ocr_workers, llm_workers=llm_workers, notion_workers=notion_workers, flusher=flusher,
+                               duplicates=DuplicateIndex.default(), allow_duplicates=allow_duplicates)
+
+    spinner.text = f"Processing receipts (0/{len(filepaths)} done)..."
+    spinner.start()
+    try:
+        results = pipeline.run(filepaths)
+    finally:
+        spinner.stop()
+        if flusher is not None:
+            stop_flusher(flusher, spinner)
+    end = time.time()
+
+    pipeline.print_summary(results)
+
+    if verbose:
+        spinner.write(Fore.BLUE + f"[Total time elapsed: {'{:.3f}'.format(end - start)}" + " seconds]" + Fore.RESET)
+
+    spinner.text = ''
+    if all(result.ok for result in results):
+        spinner.ok(Fore.GREEN + "🎉 Receipt details sent to database" + Fore.RESET)
+    else:
+        spinner.fail(Fore.RED + "❌ some receipts could not be sent to database" + Fore.RESET)
+        raise SystemExit(1)
+
+@cli.command()
+@click.option('--socket', 'socket_path', type=click.Path(), default=None, help='Unix socket to listen on [default: snaptrack.sock in the cache directory]')
+@click.option('--port', type=int, default=None, help='Listen for receipts over HTTP on this localhost port instead of a Unix socket')
+@click.option('--workers', default=4, show_default=True, help='Receipts processed at once')
+@click.option('--verbose', '-v', is_flag=True, help='Log every request')
+@click.option('--refresh-schema', is_flag=True, help='Ignore the cached database schema and fetch it from Notion again')
+@click.option('--local-classifier/--no-local-classifier', default=True, help='Answer selection columns for familiar items with a local model learned from the database (default) or always use GPT')
+@click.option('--metrics-jsonl', type=click.Path(dir_okay=False), default=None, help='Append every span to this JSON-lines file (counters are also served at /metrics)')
+@click.option('--outbox', is_flag=True, help='Reply as soon as rows are journaled to a local outbox, and send them to Notion in the background')
+@click.option('--allow-duplicates', is_flag=True, help='Send receipts even if they match one sent before')
+@parser_options
+def serve(socket_path, port, workers, verbose, refresh_schema, local_classifier, metrics_jsonl, outbox, allow_duplicates, **parser_options):
+    """Run a daemon that keeps API clients and the database schema warm for `snaptrack submit`"""
+    from snaptrack.server import ReceiptServer, ReceiptServerError
+
+    # never started, so writes go straight to the terminal instead of fighting with an animation
+    spinner = yaspin(text="Processing...", color="yellow")
+
+    load_environment()
+    ensure_credentials(spinner)
+
+    metrics, exporter = create_metrics(metrics_jsonl)
+    receipt_parser = create_receipt_parser(spinner, verbose, metrics=metrics, **parser_options)
+    database = create_database(spinner, refresh_schema, metrics=metrics)
+    if local_classifier:
+        receipt_parser.classifier = load_classifier(database, spinner, verbose)
+
+    flusher = start_flusher(database) if outbox else None
+    pipeline = ReceiptPipeline(receipt_parser, database, spinner, llm_workers=workers, notion_workers=workers, flusher=flusher,
+                               duplicates=DuplicateIndex.default(), allow_duplicates=allow_duplicates)
+
+    try:
+        server = ReceiptServer(pipeline, socket_path=socket_path, port=port, max_concurrent=workers)
+    except (OSError, ReceiptServerError) as ex:
+        if flusher is not None:
+            flusher.stop(drain=False)
+        raise click.ClickException(str(ex))
+
+    spinner.write(Fore.GREEN + f"SnapTrack is listening on {server.address} (Ctrl+C to stop)" + Fore.RESET)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if flusher is not None:
+            stop_flusher(flusher, spinner)
+        report_metrics(metrics, exporter, spinner)
+
+@cli.command()
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--workers', default=2, show_default=True, help='Receipts processed at once')
+@click.option('--queue-size', default=16, show_default=True, help='Settled receipts waiting for a worker before new ones are held back')
+@click.option('--settle', default=2.0, show_default=True, help='Seconds a file must stay unchanged before it is treated as fully written')
+@click.option('--poll-interval', default=1.0, show_default=True, help='Seconds between folder scans when inotify isn\'t used')
+@click.option('--polling', is_flag=True, help='Scan the folder periodically instead of using inotify')
+@click.option('--verbose', '-v', is_flag=True, help='Show time elapsed for each operation')
+@click.option('--refresh-schema', is_flag=True, help='Ignore the cached database schema and fetch it from Notion again')
+@click.option('--local-classifier/--no-local-classifier', default=True, help='Answer selection columns for familiar items with a local model learned from the database (default) or always use GPT')
+@click.option('--outbox', is_flag=True, help='Journal rows to a local outbox and send them to Notion in the background, so Notion outages don\'t send receipts to failed/')
+@click.option('--allow-duplicates', is_flag=True, help='Send receipts even if they match one sent before')
+@metrics_options
+@parser_options
+def watch(directory, workers, queue_size, settle, poll_interval, polling, verbose, refresh_schema, local_classifier, outbox, allow_duplicates,
+          profile, metrics_jsonl, metrics_prom, **parser_options):
+    """Send receipts to Notion as they are dropped into DIRECTORY, moving them to its done/ and failed/ subfolders"""
+    from snaptrack.watcher import FolderWatcher
+
+    # never started, so each receipt's line goes straight to the terminal
+    spinner = yaspin(text="Processing...", color="yellow")
+
+    load_environment()
+    ensure_credentials(spinner)
+
+    # one parser and database (and their clients) shared by every worker
+    metrics, exporter = create_metrics(metrics_jsonl)
+    receipt_parser = create_receipt_parser(spinner, verbose, metrics=metrics, **parser_options)
+    database = create_database(spinner, refresh_schema, metrics=metrics)
+    if local_classifier:
+        receipt_parser.classifier = load_classifier(database, spinner, verbose)
+
+    flusher = start_flusher(database, workers) if outbox else None
+    pipeline = ReceiptPipeline(receipt_parser, database, spinner, llm_workers=workers, notion_workers=workers, flusher=flusher,
+                               duplicates=DuplicateIndex.default(), allow_duplicates=allow_duplicates)
+
+    def on_result(result, new_path):
+        pipeline.print_result(result, new_path)
+        # kept current so a textfile collector always sees up-to-date totals
+        if metrics_prom is not None:
+            metrics.write_prometheus(metrics_prom)
+
+    watcher = FolderWatcher(
+        directory, pipeline, workers=workers, queue_size=queue_size, settle=settle, poll_interval=poll_interval,
+        use_inotify=not polling, extensions=IMAGE_EXTENSIONS, on_result=on_result
+    )
+
+    spinner.write(Fore.GREEN + f"SnapTrack is watching {watcher.directory} (Ctrl+C to stop)" + Fore.RESET)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        # run finishes the receipts that were already queued before returning
+        watcher.stop()
+
+    if flusher is not None:
+        stop_flusher(flusher, spinner)
+
+    spinner.write(f"{watcher.processed} receipt(s) sent to database, {watcher.failed} failed")
+    report_metrics(metrics, exporter, spinner, profile, metrics_prom)
+
+@cli.command()
+@click.argument('paths', type=click.Path(), nargs=-1, required=True)
+@click.option('--socket', 'socket_path', type=click.Path(), default=None, help='Unix socket the daemon listens on [default: snaptrack.sock in the cache directory]')
+@click.option('--port', type=int, default=None, help='Localhost port the daemon listens on, if it was started with --port')
+@click.option('--stream', is_flag=True, help='Have the daemon stream GPT\'s reply so rows are inserted while later ones are still being generated')
+def submit(paths, socket_path, port, stream):
+    """Send receipts (files, directories or glob patterns) to a running `snaptrack serve` daemon"""
+    from snaptrack.server import ReceiptServerError, submit_receipt
+
+    spinner = yaspin(text="Processing...", color="yellow")
+    filepaths = expand_paths(paths)
+    if len(filepaths) == 0:
+        raise click.BadParameter("No receipt images found.", param_hint="'PATHS...'")
+
+    succeeded = 0
+    for filepath in filepaths:
+        spinner.text = f"Sending {filepath}..."
+        spinner.start()
+        try:
+            events = list(submit_receipt(filepath, socket_path=socket_path, port=port, stream=stream))
+        except ReceiptServerError as ex:
+            spinner.stop()
+            raise click.ClickException(str(ex))
+        spinner.stop()
+
+        done = events[-1] if len(events) != 0 and events[-1]['event'] == 'done' else {'ok': False, 'stage': None, 'error': 'daemon closed the connection'}
+        failed = [event for event in events if event['event'] == 'row' and event['error'] is not None]
+        if done.get('duplicate') is not None:
+            succeeded += 1
+            spinner.write(Fore.YELLOW + f"↷ {filepath}: skipped, {done['duplicate']}" + Fore.RESET)
+        elif done['ok']:
+            succeeded += 1
+            spinner.write(Fore.GREEN + f"✔ {filepath}: {done['rows']} row(s) added in {'{:.3f}'.format(done['seconds'])} seconds" + Fore.RESET)
+        elif done['error'] is not None:
+            spinner.write(Fore.RED + f"✘ {filepath}: failed during {done['stage']} ({done['error']})" + Fore.RESET)
+        else:
+            spinner.write(Fore.RED + f"✘ {filepath}: {len(failed)} of {done['rows']} row(s) not added ({failed[0]['error']})" + Fore.RESET)
+
+    spinner.write(f"{succeeded} of {len(filepaths)} receipt(s) sent to database")
+    if succeeded != len(filepaths):
+        raise SystemExit(1)
+
+@cli.command()
+@click.option('--rate', default=3.0, show_default=True, help='Pages created per second at most')
+@click.option('--workers', default=2, show_default=True, help='Pages created at once')
+@click.option('--retry-failed', is_flag=True, help='Also retry rows that were set aside after failing too many times or being rejected')
+@click.option('--keep-days', default=30.0, show_default=True, help='Days sent rows are remembered, so re-sent receipts aren\'t written twice')
+def flush(rate, workers, retry_failed, keep_days):
+    """Send rows waiting in the local outbox to Notion"""
+    from snaptrack.outbox import Outbox, OutboxFlusher
+    from snaptrack.retry import TokenBucket
+
+    spinner = yaspin(text="Sending queued rows to Notion...", color="yellow")
+    load_environment()
+    ensure_credentials(spinner)
+
+    database = create_database(spinner)
+    database.rate_limiter = TokenBucket(rate)
+    outbox = Outbox.default()
+
+    if retry_failed:
+        revived = outbox.retry_failed(database.database_id)
+        if revived != 0:
+            spinner.write(Fore.YELLOW + f"[Retrying {revived} row(s) that failed before]" + Fore.RESET)
+
+    def on_sent(key, page_id, error):
+        if error is not None:
+            spinner.write(Fore.RED + f"[Row {key} not sent: {error}]" + Fore.RESET)
+        spinner.text = f"Sending queued rows to Notion ({flusher.sent} sent)..."
+
+    flusher = OutboxFlusher(database, outbox, workers=workers, on_sent=on_sent)
+    start = time.time()
+    spinner.start()
+    try:
+        flusher.flush()
+    except KeyboardInterrupt:
+        flusher.stop_event.set()
+    spinner.stop()
+
+    outbox.prune(keep_days * 24 * 60 * 60)
+    stats = outbox.stats(database.database_id)
+    spinner.text = ''
+    message = f"{flusher.sent} row(s) sent in {'{:.3f}'.format(time.time() - start)} seconds"
+    if stats['pending'] + stats['failed'] == 0:
+        spinner.ok(Fore.GREEN + f"🎉 {message}" + Fore.RESET)
+    else:
+        spinner.fail(Fore.RED + f"❌ {message}, {stats['pending']} waiting to be retried and {stats['failed']} set aside (retry them with --retry-failed)" + Fore.RESET)
+        raise SystemExit(1)
+
+@cli.command()
+@click.option('--format', 'output_format', type=click.Choice(['sqlite', 'csv', 'jsonl']), default='sqlite', show_default=True, help='Local SQLite mirror, CSV or JSON lines')
+@click.option('--output', '-o', type=click.Path(dir_okay=False, allow_dash=True), default=None, help='File to write [default: the mirror in the cache directory for sqlite, standard output otherwise]')
+@click.option('--since', default=None, help='Only export rows edited at or after this ISO 8601 time (e.g. 2024-01-01)')
+@click.option('--full', is_flag=True, help='Sync every row into the mirror again and drop rows deleted in Notion, instead of only rows edited since the last sync')
+@click.option('--refresh-schema', is_flag=True, help='Ignore the cached database schema and fetch it from Notion again')
+def export(output_format, output, since, full, refresh_schema):
+    """Export the Notion database page by page, or keep a local SQLite mirror of it up to date"""
+    from snaptrack.export import ExportError, export_rows, open_writer
+
+    spinner = yaspin(text="Exporting...", color="yellow")
+    load_environment()
+    ensure_credentials(spinner)
+
+    if output is None and output_format != 'sqlite':
+        output = '-'
+    # the spinner would end up in the exported rows
+    to_stdout = output == '-'
+
+    database = create_database(spinner, refresh_schema)
+    try:
+        writer = open_writer(output_format, output, database)
+    except ExportError as ex:
+        raise click.ClickException(str(ex))
+
+    def on_row(count):
+        if not to_stdout and count % 100 == 0:
+            spinner.text = f"Exporting ({count} row(s) so far)..."
+
+    start = time.time()
+    if not to_stdout:
+        spinner.start()
+    try:
+        count = export_rows(database, writer, edited_after=since, full=full, on_row=on_row)
+    finally:
+        writer.close()
+        spinner.stop()
+
+    destination = getattr(writer, 'path', None) or output
+    message = f"{count} row(s) exported in {'{:.3f}'.format(time.time() - start)} seconds" + (f" to {destination}" if not to_stdout else '')
+    if to_stdout:
+        click.echo(message, err=True)
+    else:
+        spinner.ok(Fore.GREEN + f"🎉 {message}" + Fore.RESET)
+
 if __name__ == '__main__':
-    send_receipt()
+    cli()
@@ -0,0 +1,277 @@
+from datetime import datetime
+import hashlib
+import io
+import re
+import sqlite3
+import threading
+import time
+from snaptrack.cache import get_cache_dir
+
+# width and height of the difference hash; images are compared on HASH_SIZE * HASH_SIZE bits
+HASH_SIZE = 16
+
+# bits two difference hashes may differ in and still be treated as the same photo
+MAX_HASH_DISTANCE = 10
+
+# the hash is indexed in bands of this many bits; two hashes within MAX_HASH_DISTANCE always share a band,
+# but blank bands are skipped and busy bands capped, so near-identical matches are best-effort
+BAND_BITS = 16
+
+# candidates compared per band (the most recent receipts), so bands shared by many receipts can't make lookups slow
+MAX_BAND_CANDIDATES = 200
+
+class DuplicateReceiptError(Exception):
+    """Raised when a receipt matches one already sent to the database
+    """
+
+    def __init__(self, error_msg, match):
+        self.message = error_msg
+        self.match = match
+        super().__init__(self.message)
+
+class DuplicateMatch:
+    """An earlier receipt a new one matched, and how
+    """
+
+    def __init__(self, kind, filepath, added_at, distance=None):
+        # 'image' (same file contents), 'similar image' (same photo re-encoded or resized) or 'contents'
+        self.kind = kind
+        self.filepath = filepath
+        self.added_at = added_at
+        self.distance = distance
+
+    def describe(self):
+        added = datetime.fromtimestamp(self.added_at).strftime('%Y/%m/%d %H:%M') if self.added_at is not None else 'earlier in this run'
+        how = {'image': 'identical image', 'similar image': f"near-identical image, {self.distance} bit(s) apart", 'contents': 'same date, total and items'}[self.kind]
+        return f"duplicate of {self.filepath} ({how}, added {added})"
+
+class DuplicateIndex:
+    """Fingerprints of every receipt sent to a database, for skipping receipts that were sent before
+
+    Images are checked before OCR by their SHA-256 and by a difference hash (dHash) that survives
+    re-encoding and resizing, so a re-synced or re-exported photo is caught before any API is called.
+    After extraction, entries are checked by a signature of the receipt's date, total and set of items,
+    which catches the same receipt photographed twice. Difference hashes are indexed in bands, so
+    lookups only compare against a handful of candidates even with tens of thousands of receipts.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+
+        # receipts being processed right now, so two copies in the same batch don't both get through
+        self.in_flight = {}
+
+        # a single connection shared between threads, guarded by a lock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS receipts ("
+            "id INTEGER PRIMARY KEY, database_id TEXT NOT NULL, filepath TEXT, sha256 TEXT NOT NULL, "
+            "image_hash TEXT, signature TEXT, added_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS receipts_sha256 ON receipts (database_id, sha256)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS receipts_signature ON receipts (database_id, signature)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS image_bands (band INTEGER NOT NULL, value INTEGER NOT NULL, receipt INTEGER NOT NULL)")
+        # includes the receipt, so the most recent candidates of a band are read straight from the index
+        self._connection.execute("DROP INDEX IF EXISTS image_bands_value")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS image_bands_receipt ON image_bands (band, value, receipt)")
+        self._connection.commit()
+
+    @classmethod
+    def default(cls):
+        """Opens the index in SnapTrack's cache directory
+
+        :return: the index
+        :rtype: DuplicateIndex
+        """
+        return cls(get_cache_dir() / 'duplicates.sqlite3')
+
+    @staticmethod
+    def fingerprint_image(image_data):
+        """Hashes an image's bytes and, when it can be decoded, its appearance
+
+        :param image_data: contents of the image file
+        :type image_data: bytes
+
+        :return: hex SHA-256 of the bytes, and the hex difference hash (None if the image can't be read)
+        :rtype: tuple of str
+        """
+        sha256 = hashlib.sha256(image_data).hexdigest()
+
+        try:
+            from PIL import Image, ImageOps
+            image = ImageOps.exif_transpose(Image.open(io.BytesIO(image_data)))
+            pixels = list(image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR).getdata())
+        except Exception:
+            return sha256, None
+
+        # one bit per pixel: whether it is brighter than its right-hand neighbour
+        bits = 0
+        for row in range(HASH_SIZE):
+            for column in range(HASH_SIZE):
+                offset = row * (HASH_SIZE + 1) + column
+                bits = (bits << 1) | (1 if pixels[offset] > pixels[offset + 1] else 0)
+
+        return sha256, f"{bits:0{HASH_SIZE * HASH_SIZE // 4}x}"
+
+    @staticmethod
+    def signature(entries, columns):
+        """Builds a signature of a receipt's contents from its entries: date, total and set of items
+
+        :param entries: entries extracted from the receipt, keyed by column name
+        :type entries: list of dictionaries
+        :param columns: columns of the database, structured as {'name': column_name, 'type': column_type}
+        :type columns: list of dictionaries
+
+        :return: hex digest of the signature, or None if the receipt has no date or items to go on
+        :rtype: str
+        """
+        title = next((column['name'] for column in columns if column['type'] == 'title'), None)
+        date = next((column['name'] for column in columns if column['type'] == 'date'), None)
+        number = next((column['name'] for column in columns if column['type'] == 'number'), None)
+        if title is None or date is None or len(entries) == 0:
+            return None
+
+        # the date every entry shares, with separators and time of day dropped
+        dates = sorted(set(re.sub(r'\D', '', str(entry.get(date) or ''))[:8] for entry in entries) - {''})
+        items = sorted(re.sub(r'[^a-z0-9]+', ' ', str(entry.get(title) or '').lower()).strip() for entry in entries)
+        if len(dates) == 0 or not any(items):
+            return None
+
+        total = 0.0
+        if number is not None:
+            for entry in entries:
+                try:
+                    total += float(entry.get(number) or 0)
+                except (TypeError, ValueError):
+                    pass
+
+        return hashlib.sha256(f"{dates[0]}|{total:.2f}|{'|'.join(items)}".encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def __bands(image_hash):
+        bits = int(image_hash, 16)
+        count = HASH_SIZE * HASH_SIZE // BAND_BITS
+        mask = (1 << BAND_BITS) - 1
+        return [(band, (bits >> (band * BAND_BITS)) & mask) for band in range(count)]
+
+    @staticmethod
+    def distance(first_hash, second_hash):
+        return bin(int(first_hash, 16) ^ int(second_hash, 16)).count('1')
+
+    def find_image(self, database_id, sha256, image_hash=None, filepath=None):
+        """Looks for an earlier receipt with the same image, or one that looks the same
+
+        :param database_id: ID of the Notion database
+        :type database_id: str
+        :param sha256: hex SHA-256 of the image
+        :type sha256: str
+        :param image_hash: hex difference hash of the image, defaults to None
+        :type image_hash: str, optional
+        :param filepath: path of the receipt being checked, so it doesn't match itself while in flight, defaults to None
+        :type filepath: str, optional
+
+        :return: the closest match, or None
+        :rtype: DuplicateMatch
+        """
+        with self._lock:
+            for other_path, (other_database, other_sha256, other_hash, other_name) in self.in_flight.items():
+                if other_path == filepath or other_database != database_id:
+                    continue
+                if other_sha256 == sha256:
+                    return DuplicateMatch('image', other_name, None)
+                if image_hash is not None and other_hash is not None and self.distance(image_hash, other_hash) <= MAX_HASH_DISTANCE:
+                    return DuplicateMatch('similar image', other_name, None, self.distance(image_hash, other_hash))
+
+            row = self._connection.execute(
+                "SELECT filepath, added_at FROM receipts WHERE database_id = ? AND sha256 = ? ORDER BY added_at LIMIT 1", (database_id, sha256)
+            ).fetchone()
+            if row is not None:
+                return DuplicateMatch('image', row[0], row[1])
+
+            if image_hash is None:
+                return None
+
+            candidates = set()
+            for band, value in self.__bands(image_hash):
+                # all-dark or all-bright bands (margins, blank paper) say nothing about which receipt it is
+                if value == 0 or value == (1 << BAND_BITS) - 1:
+                    continue
+                # re-sent photos are usually recent, so the newest receipts sharing the band are the ones compared
+                rows = self._connection.execute(
+                    "SELECT receipt FROM image_bands WHERE band = ? AND value = ? ORDER BY receipt DESC LIMIT ?", (band, value, MAX_BAND_CANDIDATES)
+                )
+                candidates.update(receipt for receipt, in rows)
+
+            best = None
+            for receipt in candidates:
+                other_path, other_hash, added_at = self._connection.execute(
+                    "SELECT filepath, image_hash, added_at FROM receipts WHERE id = ? AND database_id = ?", (receipt, database_id)
+                ).fetchone() or (None, None, None)
+                if other_hash is None:
+                    continue
+                distance = self.distance(image_hash, other_hash)
+                if distance <= MAX_HASH_DISTANCE and (best is None or distance < best.distance):
+                    best = DuplicateMatch('similar image', other_path, added_at, distance)
+
+        return best
+
+    def find_signature(self, database_id, signature):
+        """Looks for an earlier receipt with the same date, total and items
+
+        :param database_id: ID of the Notion database
+        :type database_id: str
+        :param signature: signature from DuplicateIndex.signature
+        :type signature: str
+
+        :return: the match, or None
+        :rtype: DuplicateMatch
+        """
+        if signature is None:
+            return None
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT filepath, added_at FROM receipts WHERE database_id = ? AND signature = ? ORDER BY added_at LIMIT 1", (database_id, signature)
+            ).fetchone()
+        return DuplicateMatch('contents', row[0], row[1]) if row is not None else None
+
+    def claim(self, database_id, filepath, sha256, image_hash=None, display_name=None):
+        """Marks a receipt as being processed, so copies of it in the same run are caught too"""
+        with self._lock:
+            self.in_flight[filepath] = (database_id, sha256, image_hash, display_name or filepath)
+
+    def release(self, filepath):
+        with self._lock:
+            self.in_flight.pop(filepath, None)
+
+    def record(self, database_id, filepath, sha256, image_hash=None, signature=None):
+        """Adds a receipt that was sent to the database
+
+        :param database_id: ID of the Notion database
+        :type database_id: str
+        :param filepath: path of the receipt image, or the name it was uploaded under
+        :type filepath: str
+        :param sha256: hex SHA-256 of the image
+        :type sha256: str
+        :param image_hash: hex difference hash of the image, defaults to None
+        :type image_hash: str, optional
+        :param signature: signature of the receipt's contents, defaults to None
+        :type signature: str, optional
+        """
+        with self._lock:
+            cursor = self._connection.execute(
+                "INSERT INTO receipts (database_id, filepath, sha256, image_hash, signature, added_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (database_id, filepath, sha256, image_hash, signature, time.time())
+            )
+            if image_hash is not None:
+                self._connection.executemany(
+                    "INSERT INTO image_bands (band, value, receipt) VALUES (?, ?, ?)",
+                    [(band, value, cursor.lastrowid) for band, value in self.__bands(image_hash)]
+                )
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
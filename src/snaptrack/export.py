@@ -0,0 +1,253 @@
+import csv
+import json
+import os
+import sqlite3
+import sys
+import time
+from snaptrack.cache import get_cache_dir
+
+# rows written to the SQLite mirror per transaction
+SQLITE_BATCH_SIZE = 500
+
+# fields every exported row starts with, ahead of the database's own columns
+ROW_FIELDS = ['page_id', 'last_edited_time']
+
+# SQLite column types for the Notion column types that aren't stored as text
+SQLITE_TYPES = {'number': 'REAL', 'checkbox': 'INTEGER'}
+
+class ExportError(Exception):
+    """Error class for the exporters
+    """
+
+    def __init__(self, error_msg):
+        self.message = error_msg
+        super().__init__(self.message)
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def _open_output(path):
+    # '-' writes to standard output, so exports can be piped into other tools
+    if path is None or path == '-':
+        return sys.stdout, False
+    return open(path, 'w', encoding='utf-8', newline=''), True
+
+class CSVWriter:
+    """Writes rows to a CSV file as they arrive, joining multi_select values with '; '
+    """
+
+    def __init__(self, path, columns):
+        self.columns = columns
+        self._file, self._owned = _open_output(path)
+
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(ROW_FIELDS + [column['name'] for column in columns])
+
+    def write(self, row):
+        values = [row.get(field) for field in ROW_FIELDS]
+        for column in self.columns:
+            value = row.get(column['name'])
+            values.append('; '.join(value) if isinstance(value, list) else value)
+        self._writer.writerow(['' if value is None else value for value in values])
+
+    def close(self):
+        if self._owned:
+            self._file.close()
+        else:
+            self._file.flush()
+
+class JSONLinesWriter:
+    """Writes one JSON object per row as rows arrive
+    """
+
+    def __init__(self, path, columns):
+        self.columns = columns
+        self._file, self._owned = _open_output(path)
+
+    def write(self, row):
+        self._file.write(json.dumps(row, ensure_ascii=False) + '\n')
+
+    def close(self):
+        if self._owned:
+            self._file.close()
+        else:
+            self._file.flush()
+
+class SQLiteMirror:
+    """Local copy of a Notion database in SQLite, kept up to date by syncing only the rows edited since last time
+
+    Every row is stored in the 'rows' table with one column per database column (multi_select values
+    as JSON lists), so reports over years of expenses can be run as local SQL queries.
+    """
+
+    def __init__(self, path, database_id, columns):
+        self.path = str(path)
+        self.database_id = database_id
+        self.columns = columns
+        self._pending = 0
+
+        self._connection = sqlite3.connect(self.path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS sync (database_id TEXT PRIMARY KEY, synced_at TEXT, updated_at REAL NOT NULL)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS rows (page_id TEXT PRIMARY KEY, last_edited_time TEXT NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS rows_last_edited_time ON rows (last_edited_time)")
+
+        # columns added to the Notion database since the mirror was created are added here too
+        existing = [row[1] for row in self._connection.execute("PRAGMA table_info(rows)")]
+        for column in columns:
+            if column['name'] not in existing:
+                column_type = SQLITE_TYPES.get(column['type'], 'TEXT')
+                self._connection.execute(f"ALTER TABLE rows ADD COLUMN {_quote(column['name'])} {column_type}")
+        self._connection.commit()
+
+        names = ROW_FIELDS + [column['name'] for column in columns]
+        self._insert = (
+            f"INSERT OR REPLACE INTO rows ({', '.join(_quote(name) for name in names)}) "
+            f"VALUES ({', '.join('?' for _ in names)})"
+        )
+
+    @classmethod
+    def for_database(cls, database_id, columns):
+        """Opens the mirror kept for a database in SnapTrack's cache directory
+
+        :param database_id: ID of the Notion database
+        :type database_id: str
+        :param columns: columns of the database, structured as {'name': column_name, 'type': column_type}
+        :type columns: list of dictionaries
+
+        :return: the database's mirror
+        :rtype: SQLiteMirror
+        """
+        return cls(get_cache_dir('mirror') / f"{database_id}.sqlite3", database_id, columns)
+
+    @property
+    def synced_at(self):
+        row = self._connection.execute("SELECT synced_at FROM sync WHERE database_id = ?", (self.database_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def write(self, row):
+        values = [row.get(field) for field in ROW_FIELDS]
+        for column in self.columns:
+            value = row.get(column['name'])
+            values.append(json.dumps(value, ensure_ascii=False) if isinstance(value, list) else value)
+        self._connection.execute(self._insert, values)
+
+        # committed in batches, so memory stays flat and an interrupted sync keeps what it already fetched
+        self._pending += 1
+        if self._pending >= SQLITE_BATCH_SIZE:
+            self._connection.commit()
+            self._pending = 0
+
+    def mark_synced(self, synced_at):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO sync (database_id, synced_at, updated_at) VALUES (?, ?, ?)",
+            (self.database_id, synced_at, time.time())
+        )
+        self._connection.commit()
+
+    def remove_missing(self, page_ids):
+        """Deletes mirrored rows whose pages are no longer in the database
+
+        :param page_ids: IDs of every page currently in the database
+        :type page_ids: set of str
+
+        :return: number of rows deleted
+        :rtype: int
+        """
+        stale = [row[0] for row in self._connection.execute("SELECT page_id FROM rows") if row[0] not in page_ids]
+        self._connection.executemany("DELETE FROM rows WHERE page_id = ?", [(page_id,) for page_id in stale])
+        self._connection.commit()
+        return len(stale)
+
+    def rows(self):
+        """Iterates over the mirrored rows without loading them all into memory
+
+        :return: rows keyed by column name, with multi_select values as lists
+        :rtype: generator of dictionaries
+        """
+        multi_select = set(column['name'] for column in self.columns if column['type'] == 'multi_select')
+        cursor = self._connection.execute("SELECT * FROM rows ORDER BY last_edited_time")
+        names = [description[0] for description in cursor.description]
+
+        for values in cursor:
+            row = dict(zip(names, values))
+            for name in multi_select:
+                if row.get(name) is not None:
+                    row[name] = json.loads(row[name])
+            yield row
+
+    def close(self):
+        self._connection.commit()
+        self._connection.close()
+
+def open_writer(output_format, path, database):
+    """Creates the writer for an export format
+
+    :param output_format: 'csv', 'jsonl' or 'sqlite'
+    :type output_format: str
+    :param path: file to write to ('-' for standard output), or None for the default
+    :type path: str
+    :param database: database being exported
+    :type database: NotionDB
+
+    :return: the writer
+    :rtype: CSVWriter, JSONLinesWriter or SQLiteMirror
+    """
+    if output_format == 'csv':
+        return CSVWriter(path, database.columns)
+    if output_format == 'jsonl':
+        return JSONLinesWriter(path, database.columns)
+    if output_format == 'sqlite':
+        if path is None:
+            return SQLiteMirror.for_database(database.database_id, database.columns)
+        if path == '-':
+            raise ExportError(error_msg="A SQLite mirror can't be written to standard output")
+        return SQLiteMirror(os.path.abspath(path), database.database_id, database.columns)
+    raise ExportError(error_msg=f"Unsupported export format {output_format}")
+
+def export_rows(database, writer, edited_after: str = None, full: bool = False, on_row=None):
+    """Streams the database's rows into a writer, following Notion's pagination
+
+    A SQLiteMirror only fetches the rows edited since its last sync unless full is set; a full sync
+    also removes rows whose pages were deleted or archived, which incremental syncs can't see.
+
+    :param database: database to export
+    :type database: NotionDB
+    :param writer: where the rows go
+    :type writer: CSVWriter, JSONLinesWriter or SQLiteMirror
+    :param edited_after: only export rows last edited at or after this ISO 8601 time, defaults to None
+    :type edited_after: str, optional
+    :param full: re-export every row even if the writer was synced before, defaults to False
+    :type full: bool, optional
+    :param on_row: called with the number of rows written so far after each row, defaults to None
+    :type on_row: callable, optional
+
+    :return: number of rows written
+    :rtype: int
+    """
+    mirror = isinstance(writer, SQLiteMirror)
+    if mirror and not full and edited_after is None:
+        # Notion rounds last_edited_time to the minute, so the boundary is fetched again ('on or after')
+        # and simply replaced, rather than risk missing an edit made in the same minute
+        edited_after = writer.synced_at
+
+    count = 0
+    latest = edited_after
+    seen = set() if mirror and full and edited_after is None else None
+
+    for row in database.iter_rows(edited_after=edited_after):
+        writer.write(row)
+        count += 1
+        if latest is None or row['last_edited_time'] > latest:
+            latest = row['last_edited_time']
+        if seen is not None:
+            seen.add(row['page_id'])
+        if on_row is not None:
+            on_row(count)
+
+    if mirror:
+        if seen is not None:
+            writer.remove_missing(seen)
+        writer.mark_synced(latest)
+
+    return count
@@ -0,0 +1,177 @@
+import json
+import os
+import re
+import threading
+from snaptrack.cache import get_config_dir
+
+# text in a product's name that means the entry is really part of the receipt's header, summary or payment details
+DEFAULT_KEYWORDS = [
+    'tax', 'change', 'cash', 'card', 'amount', 'total', 'subtotal', 'discount', 'hst', 'gst', 'invoice', 'purchase',
+    'customer', 'receipt', 'round', 'balance', '.com', '.ca', 'feedback', 'swipe', 'sale', 'pay', 'shop', '*',
+    'approved', 'auth', 'record', 'important', 'you', 'copy'
+]
+
+DEFAULT_PATTERNS = {
+    'date': r'\d{1,2}/\d{1,2}/\d{2,4}',
+    'amount': r'^\d+(\.\d{2})?$',
+    'time': r'\b\d{1,2}:\d{2}(?::\d{2})?\b',
+    'phone_number': r'\d{10}',
+    'url': r'https?://\S+',
+    'credit_card': r'\b(?:\d[ -]*?){13,16}\b',
+    'masked_credit_card': r'\b(?:\d[ -]x?){13,16}\b'
+}
+
+class FilterEngine:
+    """Drops entries that aren't products, built once per database schema
+
+    Keywords and patterns are each compiled into a single regular expression, and the columns each check
+    looks at are worked out up front, so filtering an entry takes at most two scans per textual column.
+    """
+
+    def __init__(self, columns, keywords=None, patterns=None):
+        self.keywords = list(DEFAULT_KEYWORDS if keywords is None else keywords)
+        self.patterns = dict(DEFAULT_PATTERNS if patterns is None else patterns)
+
+        # columns whose text is checked for unwanted content, and columns that count towards the empty-column limit
+        self.textual_columns = [column['name'] for column in columns if column['type'] in ['title', 'text']]
+        self.non_select_columns = [column['name'] for column in columns if column['type'] not in ['select', 'multi_select']]
+        self.max_empty = int(len(columns) / 2)
+
+        # keywords are matched case-insensitively through a single trie-shaped expression, so each position
+        # in the text is checked against every keyword at once instead of one keyword at a time
+        lowered = sorted(set(keyword.lower() for keyword in self.keywords if keyword != ''))
+        self.keyword_matcher = re.compile(_trie_pattern(lowered)) if lowered else None
+
+        # patterns are checked together as well, and only looked at one by one to credit a hit to its rule
+        self.compiled_patterns = [(name, re.compile(pattern)) for name, pattern in self.patterns.items()]
+        self.pattern_matcher = re.compile('|'.join(f"(?:{pattern})" for pattern in self.patterns.values())) if self.patterns else None
+
+        # why the rules in the config file couldn't be used, when the defaults were used instead
+        self.config_error = None
+
+        # hits per rule (plus 'short_text' and 'too_many_empty'), for seeing which rules do the work
+        self.hits = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, columns, path=None):
+        """Builds an engine with the rule set from a JSON config file, if there is one
+
+        The file holds optional "keywords" (list) and "patterns" (name -> regular expression) keys.
+        With "extend": true the rules are added to the defaults instead of replacing them. The file
+        is read from path, $SNAPTRACK_FILTER_RULES, or filters.json in SnapTrack's config directory.
+        A file that isn't valid JSON or holds invalid rules is ignored in favour of the defaults, with
+        the reason in config_error.
+
+        :param columns: columns of the database, structured as {'name': column_name, 'type': column_type}
+        :type columns: list of dictionaries
+        :param path: path of the config file, defaults to None
+        :type path: str, optional
+
+        :return: the filter engine
+        :rtype: FilterEngine
+        """
+        path = path or os.environ.get('SNAPTRACK_FILTER_RULES') or (get_config_dir() / 'filters.json')
+
+        try:
+            with open(path, 'r', encoding='utf-8') as config_file:
+                config = json.load(config_file)
+        except OSError:
+            return cls(columns)
+        except ValueError as ex:
+            return cls.__defaults(columns, f"{path} is not valid JSON ({ex})")
+
+        # a broken rule set would otherwise fail every receipt until it is fixed
+        try:
+            keywords = config.get('keywords')
+            patterns = config.get('patterns')
+            if config.get('extend', False):
+                keywords = DEFAULT_KEYWORDS + (keywords or [])
+                patterns = dict(DEFAULT_PATTERNS, **(patterns or {}))
+
+            return cls(columns, keywords, patterns)
+        except re.error as ex:
+            return cls.__defaults(columns, f"{path} has an invalid pattern ({ex})")
+        except (AttributeError, TypeError) as ex:
+            return cls.__defaults(columns, f"{path} has invalid rules ({ex})")
+
+    @classmethod
+    def __defaults(cls, columns, config_error):
+        engine = cls(columns)
+        engine.config_error = config_error
+        return engine
+
+    def filter(self, entries):
+        """Keeps only entries that look like products
+
+        :param entries: entries keyed by column name
+        :type entries: list of dictionaries
+
+        :return: the entries that passed every check
+        :rtype: list of dictionaries
+        """
+        return [entry for entry in entries if self.keep(entry)]
+
+    def keep(self, entry):
+        """Checks whether a single entry looks like a product
+
+        :param entry: entry keyed by column name
+        :type entry: dictionary
+
+        :return: True if the entry should be kept
+        :rtype: bool
+        """
+        # entries missing most of their columns are usually stray text
+        num_empty = 0
+        for column_name in self.non_select_columns:
+            if entry.get(column_name, '') == '':
+                num_empty += 1
+        if num_empty > self.max_empty:
+            self.__hit('too_many_empty')
+            return False
+
+        for column_name in self.textual_columns:
+            text = str(entry.get(column_name, ''))
+
+            if len(text) != 0 and len(text) <= 2:
+                self.__hit('short_text')
+                return False
+
+            if self.keyword_matcher is not None:
+                match = self.keyword_matcher.search(text.lower())
+                if match is not None:
+                    self.__hit(f"keyword:{match.group(0)}")
+                    return False
+
+            if self.pattern_matcher is not None and self.pattern_matcher.search(text) is not None:
+                name = next((name for name, pattern in self.compiled_patterns if pattern.search(text)), 'pattern')
+                self.__hit(f"pattern:{name}")
+                return False
+
+        return True
+
+    def __hit(self, rule):
+        with self._lock:
+            self.hits[rule] = self.hits.get(rule, 0) + 1
+
+def _trie_pattern(words):
+    # builds an expression like 'ca(?:rd|sh)' that matches any of the words, sharing common prefixes
+    trie = {}
+    for word in words:
+        node = trie
+        for character in word:
+            node = node.setdefault(character, {})
+        node[''] = {}
+
+    def build(node):
+        branches = [re.escape(character) + build(child) for character, child in sorted(node.items()) if character != '']
+        if len(branches) == 0:
+            return ''
+
+        expression = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        # a word ending here means the rest is optional
+        if '' in node:
+            expression = '(?:' + expression + ')?'
+        return expression
+
+    return build(trie)
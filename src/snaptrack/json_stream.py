@@ -0,0 +1,86 @@
+import json
+
+class JSONArrayStreamParser:
+    """Incrementally parses a JSON array of objects as its text arrives, yielding each object once it is complete
+
+    Any text before the first '[' (e.g. a markdown code fence, or '{"entries": ' from a structured reply) is skipped.
+    """
+
+    def __init__(self):
+        self._buffer = ''
+        self._position = 0
+
+        # whether the opening '[' of the array has been seen
+        self._in_array = False
+
+        # nesting depth inside the current object, and where that object started in the buffer
+        self._depth = 0
+        self._object_start = None
+
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, text: str):
+        """Adds more text from the stream
+
+        :param text: the next chunk of the reply
+        :type text: str
+
+        :return: objects completed by this chunk
+        :rtype: list of dictionaries
+        """
+        self._buffer += text
+        completed = []
+
+        while self._position < len(self._buffer):
+            character = self._buffer[self._position]
+
+            if not self._in_array:
+                if character == '[':
+                    self._in_array = True
+            elif self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif character == '\\':
+                    self._escaped = True
+                elif character == '"':
+                    self._in_string = False
+            elif character == '"':
+                self._in_string = True
+            elif character == '{':
+                if self._depth == 0:
+                    self._object_start = self._position
+                self._depth += 1
+            elif character == '}' and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        completed.append(json.loads(self._buffer[self._object_start:self._position + 1]))
+                    except json.decoder.JSONDecodeError:
+                        pass
+                    self._object_start = None
+
+            self._position += 1
+
+        # drop text that can't be part of an object anymore, so the buffer stays small
+        keep_from = self._object_start if self._object_start is not None else self._position
+        self._buffer = self._buffer[keep_from:]
+        self._position -= keep_from
+        if self._object_start is not None:
+            self._object_start = 0
+
+        return completed
+
+def iter_json_array_objects(chunks):
+    """Yields the objects of a JSON array as soon as each one is complete
+
+    :param chunks: pieces of text making up the array
+    :type chunks: iterable of str
+
+    :return: the objects in the array, in order
+    :rtype: generator of dictionaries
+    """
+    parser = JSONArrayStreamParser()
+    for chunk in chunks:
+        for item in parser.feed(chunk):
+            yield item
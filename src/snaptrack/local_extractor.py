@@ -0,0 +1,208 @@
+from datetime import datetime
+import re
+from snaptrack.ocr_layout import group_rows
+
+# extractions scoring below this are handed to GPT instead
+CONFIDENCE_THRESHOLD = 0.8
+
+# a price at the end of a row, optionally followed by a tax flag such as 'H' or 'T'
+PRICE_PATTERN = re.compile(r'(-?)\$?\s?(\d{1,5}[.,]\d{2})\s*-?\s*[A-Za-z]{0,2}$')
+
+# text that marks a row as part of the receipt's summary rather than a product
+SUBTOTAL_PATTERN = re.compile(r'\bsub\s*-?\s*total\b', re.IGNORECASE)
+TOTAL_PATTERN = re.compile(r'\b(total|amount due|balance due)\b', re.IGNORECASE)
+NON_ITEM_PATTERN = re.compile(
+    r'\b(tax|hst|gst|pst|vat|change|cash|card|visa|mastercard|debit|credit|tender|tip|gratuity|discount|savings|'
+    r'balance|payment|paid|rounding|auth|approved|points|deposit|item count|items sold)\b',
+    re.IGNORECASE
+)
+QUANTITY_PATTERN = re.compile(r'^\d+(\.\d+)?\s*(@|x|kg|lb)\b', re.IGNORECASE)
+
+MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+DATE_PATTERNS = [
+    # 2024/01/31, 2024-01-31
+    (re.compile(r'\b(\d{4})[/.-](\d{1,2})[/.-](\d{1,2})\b'), 'ymd'),
+    # 01/31/2024, 31/01/24
+    (re.compile(r'\b(\d{1,2})[/.-](\d{1,2})[/.-](\d{2,4})\b'), 'mdy'),
+    # Jan 31, 2024 / 31 Jan 2024
+    (re.compile(r'\b(' + '|'.join(MONTHS) + r')[a-z]*\.?\s+(\d{1,2}),?\s+(\d{4})\b', re.IGNORECASE), 'bdy'),
+    (re.compile(r'\b(\d{1,2})\s+(' + '|'.join(MONTHS) + r')[a-z]*\.?,?\s+(\d{4})\b', re.IGNORECASE), 'dby'),
+]
+
+# names of number columns that most likely hold an item's price
+PRICE_COLUMN_HINTS = ['price', 'amount', 'cost', 'total', 'spent', 'value']
+
+class LocalExtraction:
+    """Entries found on a receipt without GPT, along with how much they can be trusted
+    """
+
+    def __init__(self, entries, confidence, date=None, subtotal=None, total=None, item_sum=0.0):
+        self.entries = entries
+        self.confidence = confidence
+        self.date = date
+        self.subtotal = subtotal
+        self.total = total
+        self.item_sum = item_sum
+
+    @property
+    def sum_matches(self):
+        """Whether the items add up to the receipt's subtotal (or total, if it has no subtotal)
+        """
+        expected = self.subtotal if self.subtotal is not None else self.total
+        return expected is not None and abs(expected - self.item_sum) < 0.01
+
+class LocalExtractor:
+    """Rule-based extractor for the common 'ITEM NAME ..... 4.99' receipt layout
+
+    Items are paired with the price printed on the same row using OCR geometry, and the receipt's
+    date, subtotal and total are found with regular expressions.
+    """
+
+    def __init__(self, threshold: float = CONFIDENCE_THRESHOLD):
+        self.threshold = threshold
+
+    def extract(self, text_detections, columns):
+        """Extracts entries from a receipt's OCR detections
+
+        :param text_detections: 'TextDetections' from a Rekognition detect_text response
+        :type text_detections: list of dictionaries
+        :param columns: columns of the database, structured as {'name': column_name, 'type': column_type}
+        :type columns: list of dictionaries
+
+        :return: the entries (keyed by column name, selection columns left out) and their confidence
+        :rtype: LocalExtraction
+        """
+        rows = [' '.join(detection['DetectedText'] for detection in row) for row in group_rows(text_detections)]
+
+        date = None
+        subtotal = None
+        total = None
+        items = []
+
+        for row in rows:
+            if date is None:
+                date = self.find_date(row)
+
+            match = PRICE_PATTERN.search(row)
+            if match is None:
+                continue
+
+            price = float(match.group(2).replace(',', '.')) * (-1 if match.group(1) else 1)
+            label = row[:match.start()].strip(' .:$-*')
+
+            if SUBTOTAL_PATTERN.search(label):
+                subtotal = price
+            elif TOTAL_PATTERN.search(label):
+                # the first total printed is the amount charged, later ones are usually payments
+                if total is None:
+                    total = price
+            elif NON_ITEM_PATTERN.search(label) or QUANTITY_PATTERN.search(label):
+                continue
+            elif len(re.findall(r'[A-Za-z]', label)) >= 3 and total is None:
+                items.append((label, price))
+
+        item_sum = round(sum(price for _, price in items), 2)
+        extraction = LocalExtraction([], 0.0, date, subtotal, total, item_sum)
+        extraction.entries = self.__build_entries(items, date, columns)
+        extraction.confidence = self.__score(extraction, columns)
+
+        return extraction
+
+    def find_date(self, text):
+        """Finds a date in a piece of text
+
+        :param text: text to search
+        :type text: str
+
+        :return: the date in %Y/%m/%d format, or None
+        :rtype: str
+        """
+        for pattern, order in DATE_PATTERNS:
+            match = pattern.search(text)
+            if match is None:
+                continue
+
+            first, second, third = match.groups()
+            try:
+                if order == 'ymd':
+                    year, month, day = int(first), int(second), int(third)
+                elif order == 'mdy':
+                    month, day, year = int(first), int(second), int(third)
+                    # day-first when the month can't be right
+                    if month > 12:
+                        month, day = day, month
+                    if year < 100:
+                        year += 2000
+                elif order == 'bdy':
+                    month, day, year = MONTHS.index(first[:3].lower()) + 1, int(second), int(third)
+                else:
+                    day, month, year = int(first), MONTHS.index(second[:3].lower()) + 1, int(third)
+
+                return datetime(year, month, day).strftime('%Y/%m/%d')
+            except ValueError:
+                continue
+
+        return None
+
+    def __build_entries(self, items, date, columns):
+        title_column = None
+        date_column = None
+        price_column = None
+        number_columns = []
+
+        for column in columns:
+            if column['type'] == 'title' and title_column is None:
+                title_column = column['name']
+            elif column['type'] == 'date' and date_column is None:
+                date_column = column['name']
+            elif column['type'] == 'number':
+                number_columns.append(column['name'])
+
+        for name in number_columns:
+            if any(hint in name.lower() for hint in PRICE_COLUMN_HINTS):
+                price_column = name
+                break
+        if price_column is None and len(number_columns) != 0:
+            price_column = number_columns[0]
+
+        entries = []
+        for label, price in items:
+            # same shape GPT produces: every non-selection column present, unknown ones left empty
+            entry = {column['name']: '' for column in columns if column['type'] not in ['select', 'multi_select']}
+            if title_column is not None:
+                entry[title_column] = label.title()
+            if price_column is not None:
+                entry[price_column] = '{:.2f}'.format(price)
+            if date_column is not None and date is not None:
+                entry[date_column] = date
+            entries.append(entry)
+
+        return entries
+
+    def __score(self, extraction, columns):
+        if len(extraction.entries) == 0:
+            return 0.0
+
+        if extraction.sum_matches:
+            confidence = 0.95
+        elif extraction.subtotal is None and extraction.total is None:
+            # nothing to check the items against
+            confidence = 0.5
+        else:
+            confidence = 0.2
+
+        if extraction.date is None and any(column['type'] == 'date' for column in columns):
+            confidence -= 0.1
+
+        return max(0.0, confidence)
+
+    def accept(self, extraction):
+        """Whether an extraction is good enough to skip GPT
+
+        :param extraction: result of extract
+        :type extraction: LocalExtraction
+
+        :return: True if confidence reaches the threshold and the items add up to the subtotal
+        :rtype: bool
+        """
+        return extraction.confidence >= self.threshold and extraction.sum_matches
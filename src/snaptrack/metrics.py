@@ -0,0 +1,304 @@
+from collections import deque
+from contextlib import contextmanager
+import functools
+import json
+import math
+import os
+import threading
+import time
+
+# number of recent durations kept per span for percentiles, so long-running processes use bounded memory
+RESERVOIR_SIZE = 1024
+
+# prefix of every metric in the Prometheus textfile
+PROMETHEUS_PREFIX = 'snaptrack'
+
+class Span:
+    """A timed operation, nested inside whichever span was open on the same thread when it started
+    """
+
+    __slots__ = ['name', 'path', 'attributes', 'start', 'started', 'seconds']
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.path = f"{parent.path}/{name}" if parent is not None else name
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self.seconds = None
+
+    @property
+    def duration(self):
+        return self.seconds if self.seconds is not None else time.perf_counter() - self.started
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+class SpanStats:
+    """Running totals for every span with the same path
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=RESERVOIR_SIZE)
+
+    def add(self, seconds, error):
+        self.calls += 1
+        self.errors += 1 if error else 0
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.recent.append(seconds)
+
+    def percentile(self, fraction):
+        if len(self.recent) == 0:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+class Metrics:
+    """Collects nested spans and labelled counters for a run (or for the lifetime of a daemon)
+
+    Spans are aggregated by path (e.g. 'stage.extract/gpt/openai.chat') as they finish, and can also
+    be streamed to sinks such as JSONLinesExporter. Counters cover API calls, tokens, bytes uploaded,
+    retries and cache lookups. Everything is safe to use from several threads at once.
+    """
+
+    def __init__(self, sinks=None):
+        self.sinks = list(sinks or [])
+        self.span_stats = {}
+        self.counters = {}
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def __stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def current_span(self):
+        stack = self.__stack()
+        return stack[-1] if len(stack) != 0 else None
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Times the block it wraps as a span nested in the current one
+
+        :param name: name of the operation
+        :type name: str
+
+        :return: the span, whose attributes can be added to while it is open
+        :rtype: Span
+        """
+        stack = self.__stack()
+        span = Span(name, stack[-1] if len(stack) != 0 else None, attributes)
+        stack.append(span)
+
+        error = None
+        try:
+            yield span
+        except BaseException as ex:
+            error = ex
+            raise
+        finally:
+            stack.pop()
+            span.seconds = time.perf_counter() - span.started
+            if error is not None:
+                span.attributes['error'] = type(error).__name__
+            self.__finish(span, error is not None)
+
+    def bind(self, function):
+        """Wraps a function so spans it opens on another thread nest under the span open right now
+
+        :param function: function that will be run on a worker thread
+        :type function: callable
+
+        :return: the wrapped function
+        :rtype: callable
+        """
+        parent = self.current_span()
+        if parent is None:
+            return function
+
+        @functools.wraps(function)
+        def bound(*args, **kwargs):
+            stack = self.__stack()
+            stack.append(parent)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stack.pop()
+
+        return bound
+
+    def increment(self, name, value=1, **labels):
+        """Adds to a counter
+
+        :param name: name of the counter, e.g. 'api_calls'
+        :type name: str
+        :param value: amount to add, defaults to 1
+        :type value: int or float, optional
+        """
+        # label values are kept as text, so counters whose labels mix types (status 429 and 'transport') still sort
+        key = (name, tuple(sorted((label, str(label_value)) for label, label_value in labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def counter(self, name, **labels):
+        """Gets a counter's value, summed over every label not given
+
+        :param name: name of the counter
+        :type name: str
+
+        :return: the counter's value
+        :rtype: int or float
+        """
+        with self._lock:
+            return sum(value for (counter_name, counter_labels), value in self.counters.items()
+                       if counter_name == name and all((label, str(label_value)) in counter_labels for label, label_value in labels.items()))
+
+    def __finish(self, span, error):
+        with self._lock:
+            if span.path not in self.span_stats:
+                self.span_stats[span.path] = SpanStats()
+            self.span_stats[span.path].add(span.seconds, error)
+
+        if len(self.sinks) != 0:
+            record = {
+                'type': 'span', 'name': span.name, 'path': span.path, 'start': span.start, 'seconds': span.seconds,
+                'thread': threading.current_thread().name, 'attributes': span.attributes
+            }
+            for sink in self.sinks:
+                sink(record)
+
+    def breakdown(self):
+        """Summarizes every span path, in tree order
+
+        :return: one row per span path with its calls, errors, total, mean, p50, p95 and max seconds
+        :rtype: list of dictionaries
+        """
+        with self._lock:
+            items = sorted(self.span_stats.items(), key=lambda item: item[0].split('/'))
+            return [{
+                'path': path, 'calls': stats.calls, 'errors': stats.errors, 'total': stats.total,
+                'mean': stats.total / stats.calls, 'p50': stats.percentile(0.5), 'p95': stats.percentile(0.95), 'max': stats.max
+            } for path, stats in items]
+
+    def format_breakdown(self):
+        """Formats the span breakdown and counters as a table for the terminal
+
+        :return: the table
+        :rtype: str
+        """
+        rows = self.breakdown()
+        root_total = sum(row['total'] for row in rows if '/' not in row['path']) or 1.0
+
+        lines = [f"{'stage':<44} {'calls':>6} {'total s':>9} {'mean s':>9} {'p95 s':>9} {'share':>7}"]
+        for row in rows:
+            depth = row['path'].count('/')
+            label = '  ' * depth + row['path'].rsplit('/', 1)[-1]
+            if row['errors'] != 0:
+                label += f" ({row['errors']} failed)"
+            lines.append(f"{label:<44} {row['calls']:>6} {row['total']:>9.3f} {row['mean']:>9.3f} {row['p95']:>9.3f} {row['total'] / root_total:>7.1%}")
+
+        with self._lock:
+            counters = sorted(self.counters.items())
+        if len(counters) != 0:
+            lines.append('')
+            for (name, labels), value in counters:
+                label = ', '.join(f"{key}={label_value}" for key, label_value in labels)
+                lines.append(f"{name}{{{label}}}: {value:g}")
+
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        """Renders every counter and span summary in Prometheus' text exposition format
+
+        :return: the metrics
+        :rtype: str
+        """
+        def labels_text(labels):
+            if len(labels) == 0:
+                return ''
+            escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels]
+            return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+
+        seen = set()
+        for (name, labels), value in counters:
+            metric = f"{PROMETHEUS_PREFIX}_{name}_total"
+            if metric not in seen:
+                lines.append(f"# TYPE {metric} counter")
+                seen.add(metric)
+            lines.append(f"{metric}{labels_text(labels)} {value}")
+
+        metric = f"{PROMETHEUS_PREFIX}_span_seconds"
+        lines.append(f"# TYPE {metric} summary")
+        for row in self.breakdown():
+            span = [('span', row['path'])]
+            lines.append(f"{metric}{labels_text(span + [('quantile', '0.5')])} {row['p50']}")
+            lines.append(f"{metric}{labels_text(span + [('quantile', '0.95')])} {row['p95']}")
+            lines.append(f"{metric}_sum{labels_text(span)} {row['total']}")
+            lines.append(f"{metric}_count{labels_text(span)} {row['calls']}")
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """Writes the metrics to a Prometheus textfile (e.g. for node_exporter's textfile collector)
+
+        :param path: path of the .prom file
+        :type path: str
+        """
+        # collectors may read the file at any moment, so it is replaced in one step
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, 'w', encoding='utf-8') as prometheus_file:
+            prometheus_file.write(self.prometheus())
+        os.replace(temporary_path, path)
+
+    def counter_records(self):
+        with self._lock:
+            return [{'type': 'counter', 'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())]
+
+class JSONLinesExporter:
+    """Sink that appends every finished span to a JSON-lines file, followed by the counters on close
+    """
+
+    def __init__(self, path, metrics: Metrics = None):
+        self.metrics = metrics
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+        if metrics is not None:
+            metrics.sinks.append(self)
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def close(self):
+        if self.metrics is not None:
+            for record in self.metrics.counter_records():
+                self(dict(record, time=time.time()))
+        with self._lock:
+            self._file.close()
+
+def traced(name):
+    """Decorator that runs a method inside a span of its instance's metrics
+
+    :param name: name of the span
+    :type name: str
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.span(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,5 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from notion_client import Client
+import json
+import os
+import threading
+import time
+from snaptrack.cache import get_cache_dir
+from snaptrack.metrics import Metrics, traced
+from snaptrack.retry import TokenBucket, backoff_delay
+
+# Notion allows an average of 3 requests per second per integration
+NOTION_REQUESTS_PER_SECOND = 3
+
+# status codes that mean Notion turned a request away without acting on it; pages.create isn't idempotent, so
+# only these are retried (after a timeout, a dropped connection or another 5xx the page may already exist)
+REJECTED_STATUS_CODES = [409, 429, 503]
+
+# how long a cached database schema is trusted before it is fetched from Notion again (rows Notion rejects
+# as invalid also refresh it, so columns changed within the TTL are picked up on the next insert)
+SCHEMA_CACHE_TTL = 60 * 60
 
 class NotionDBError(Exception):
     """Error class for the NotionDB class
@@ -9,55 +27,308 @@ class NotionDBError(Exception):
         self.message = error_msg
         super().__init__(self.message)
 
+class RowResult:
+    """Outcome of inserting a single row into the database
+    """
+
+    def __init__(self, index, row, page_id=None, error=None, queued=False):
+        self.index = index
+        self.row = row
+        self.page_id = page_id
+        self.error = error
+
+        # journaled to the outbox, to be created in Notion by a flusher
+        self.queued = queued
+
+    @property
+    def ok(self):
+        return self.error is None
+
 class NotionDB:
     """Notion database manager
     """
 
-    def __init__(self, notion_token, database_id, spinner):
-        self.notion = Client(auth = notion_token)
+    def __init__(self, notion_token, database_id, spinner, max_retries: int = 5, refresh_schema: bool = False, schema_ttl: float = SCHEMA_CACHE_TTL, metrics: Metrics = None):
+        # notion_client (and httpx) is only imported once a database is actually opened
+        from notion_client import Client
+
+        # $SNAPTRACK_NOTION_BASE_URL points the client somewhere other than api.notion.com (e.g. a local stand-in)
+        base_url = os.environ.get('SNAPTRACK_NOTION_BASE_URL')
+        self.notion = Client(auth = notion_token, base_url = base_url) if base_url else Client(auth = notion_token)
         self.database_id = database_id
         self.spinner = spinner
 
-        # structure of database
-        self.structure = self.notion.databases.retrieve(self.database_id)
-        # print(self.structure)
+        # spans and counters for every Notion call (usually shared with the ReceiptParser)
+        self.metrics = metrics if metrics is not None else Metrics()
 
-        # TODO: get column headers using retrieve
-        # column headers by name
-        self.pages = self.notion.databases.query(self.database_id)
+        # shared between all threads creating pages so bulk inserts stay under Notion's rate limit
+        self.rate_limiter = TokenBucket(NOTION_REQUESTS_PER_SECOND)
+        self.max_retries = max_retries
 
-        try:
-            self._columns = list(self.pages['results'][0]['properties'].keys())
-        except Exception:
-            self.spinner.fail("❌ no existing entries in database")
-            raise NotionDBError(error_msg="There are no existing entries in database, unable to get column headers")
+        self.schema_ttl = schema_ttl
+        self.schema_cache_path = get_cache_dir('schema') / f"{self.database_id}.json"
 
         # saving options for the columns that are select or multi-select
         self.select_options = {}
 
         # column headers by name, and also includes types
-        self.columns = self.get_columns()
+        self.columns = self.load_schema(refresh=refresh_schema)
+        self.schema_loaded_at = time.time()
+        self._schema_lock = threading.Lock()
+
+        # column headers by name
+        self._columns = [column['name'] for column in self.columns]
+
+    def load_schema(self, refresh: bool = False):
+        """Loads the database's columns, using the local schema cache when it is still valid
+
+        The cache is used as-is within its TTL. Past the TTL the schema is rebuilt from a single
+        databases.retrieve, which returns every column anyway.
+
+        :param refresh: ignore the cache and rebuild the schema from Notion, defaults to False
+        :type refresh: bool, optional
+
+        :return: columns of the database, structured as {'name': column_name, 'type': column_type}
+        :rtype: list of dictionaries
+        """
+        cached = None if refresh else self.__read_schema_cache()
+
+        if cached is not None and time.time() - cached['cached_at'] < self.schema_ttl:
+            self.select_options = cached['select_options']
+            return cached['columns']
+
+        # structure of database
+        self.metrics.increment('api_calls', service='notion', operation='databases.retrieve')
+        with self.metrics.span('notion.retrieve_database'):
+            self.structure = self.notion.databases.retrieve(self.database_id)
+
+        columns = self.get_columns()
+        self.__write_schema_cache(columns)
+        return columns
+
+    def reload_schema_if_stale(self):
+        """Reloads the columns once the loaded schema is older than its TTL, for long-running processes
+
+        :return: True if the schema was reloaded
+        :rtype: bool
+        """
+        with self._schema_lock:
+            if time.time() - self.schema_loaded_at < self.schema_ttl:
+                return False
+
+            self.columns = self.load_schema()
+            self._columns = [column['name'] for column in self.columns]
+            self.schema_loaded_at = time.time()
+            return True
+
+    def refresh_schema(self, loaded_before: float = None):
+        """Fetches the columns from Notion again, ignoring the cache
+
+        :param loaded_before: skip the request if another thread already refreshed the schema after this time, defaults to None
+        :type loaded_before: float, optional
+
+        :return: True if the columns changed (or another thread already refreshed them)
+        :rtype: bool
+        """
+        with self._schema_lock:
+            if loaded_before is not None and self.schema_loaded_at > loaded_before:
+                return True
+
+            columns = self.load_schema(refresh=True)
+            changed = columns != self.columns
+            self.columns = columns
+            self._columns = [column['name'] for column in self.columns]
+            self.schema_loaded_at = time.time()
+            return changed
+
+    def __read_schema_cache(self):
+        try:
+            with open(self.schema_cache_path, 'r', encoding='utf-8') as cache_file:
+                cached = json.load(cache_file)
+            # make sure the cache has everything needed
+            for key in ['cached_at', 'columns', 'select_options']:
+                cached[key]
+            return cached
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def __write_schema_cache(self, columns):
+        cached = {
+            'database_id': self.database_id,
+            'cached_at': time.time(),
+            'columns': columns,
+            'select_options': self.select_options
+        }
+
+        # write to a temporary file first so an interrupted run can't leave a corrupt cache
+        temporary_path = self.schema_cache_path.with_suffix('.tmp')
+        try:
+            with open(temporary_path, 'w', encoding='utf-8') as cache_file:
+                json.dump(cached, cache_file)
+            temporary_path.replace(self.schema_cache_path)
+        except OSError:
+            pass
 
     def get_columns(self):
         # doesn't support checkbox, relation, rollup, formula, file (not relevant for finance tracking)
         properties = self.structure['properties']
-        columns = []        
+        columns = []
 
         for key in properties:
-            column_name = properties[key]['name'].title()
+            column = properties[key]
+
+            if column['type'] == 'select':
+                self.select_options[column['name']] = [option['name'] for option in column['select']['options']]
 
-            if properties[key]['type'] == 'select':
-                self.select_options[properties[key]['name']] = [option['name'] for option in self.structure['properties'][column_name]['select']['options']]
+            if column['type'] == 'multi_select':
+                self.select_options[column['name']] = [option['name'] for option in column['multi_select']['options']]
 
-            if properties[key]['type'] == 'multi_select':
-                self.select_options[properties[key]['name']] = [option['name'] for option in self.structure['properties'][column_name]['multi_select']['options']]
-                
-            value = {'name': properties[key]['name'], 'type': properties[key]['type']}
+            value = {'name': column['name'], 'type': column['type']}
             columns.append(value)
 
         return columns
 
+    @traced('notion.add_row')
     def add_row(self, row_content):
+        try:
+            return self.__create_row_page(row_content)
+        except Exception as ex:
+            self.spinner.fail("❌ unable to add row(s) to database")
+            raise NotionDBError(error_msg="Unable to add row to database") from ex
+
+    def add_rows(self, rows, max_workers: int = NOTION_REQUESTS_PER_SECOND, on_inserted=None):
+        """Inserts rows concurrently while staying under Notion's rate limit
+
+        :param rows: contents of each row, keyed by column name
+        :type rows: list of dictionaries
+        :param max_workers: number of pages created concurrently, defaults to NOTION_REQUESTS_PER_SECOND
+        :type max_workers: int, optional
+        :param on_inserted: called with (index, page_id) as soon as each row is created, defaults to None
+        :type on_inserted: callable, optional
+
+        :return: the outcome of each row, in the same order as rows
+        :rtype: list of RowResult
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            insert_row = self.metrics.bind(self.insert_row)
+            futures = [executor.submit(insert_row, row, index, on_inserted) for index, row in enumerate(rows)]
+            return [future.result() for future in futures]
+
+    @traced('notion.add_row')
+    def insert_row(self, row, index: int = 0, on_inserted=None):
+        """Inserts a single row with rate limiting and retries, reporting failure instead of raising
+
+        :param row: contents of the row, keyed by column name
+        :type row: dictionary
+        :param index: position of the row, used in the result and callback, defaults to 0
+        :type index: int, optional
+        :param on_inserted: called with (index, page_id) as soon as the row is created, defaults to None
+        :type on_inserted: callable, optional
+
+        :return: the outcome of the row
+        :rtype: RowResult
+        """
+        try:
+            page = self.__create_row_page(row)
+        except Exception as ex:
+            return RowResult(index, row, error=ex)
+
+        if on_inserted is not None:
+            on_inserted(index, page.get('id'))
+        return RowResult(index, row, page_id=page.get('id'))
+
+    def create_page(self, properties):
+        """Creates a page from an already built properties payload, with rate limiting and retries
+
+        :param properties: payload from build_properties
+        :type properties: dictionary
+
+        :return: the created page
+        :rtype: JSON dictionary
+        """
+        return self.__create_page(properties)
+
+    def __create_row_page(self, row):
+        loaded_at = self.schema_loaded_at
+        try:
+            return self.__create_page(self.build_properties(row))
+        except Exception as ex:
+            # a column was renamed, removed or retyped in Notion since the schema was loaded; Notion didn't create
+            # the page, so it is safe to build it again from the current columns
+            if getattr(ex, 'code', None) != 'validation_error' or not self.refresh_schema(loaded_before=loaded_at):
+                raise
+
+        return self.__create_page(self.build_properties(row))
+
+    def __create_page(self, properties):
+        import httpx
+        from notion_client.errors import HTTPResponseError, RequestTimeoutError
+
+        payload_bytes = len(json.dumps(properties, default=str))
+
+        attempt = 0
+        while True:
+            with self.metrics.span('notion.rate_limit'):
+                self.rate_limiter.acquire()
+            try:
+                self.metrics.increment('api_calls', service='notion', operation='pages.create')
+                self.metrics.increment('bytes_uploaded', payload_bytes, service='notion')
+                with self.metrics.span('notion.create_page', attempt=attempt):
+                    return self.notion.pages.create(
+                        parent = {'database_id': self.database_id},
+                        properties = properties
+                    )
+            except (HTTPResponseError, RequestTimeoutError, httpx.TransportError) as ex:
+                status = getattr(ex, 'status', None)
+                self.metrics.increment('api_errors', service='notion', status=status if status is not None else 'transport')
+                if not self.was_rejected(ex) or attempt >= self.max_retries:
+                    raise
+
+                self.metrics.increment('retries', stage='notion.create_page')
+
+                delay = backoff_delay(attempt)
+                if status == 429:
+                    # honor Retry-After for every thread, not just this one
+                    retry_after = self.__retry_after(ex)
+                    if retry_after is not None:
+                        self.rate_limiter.pause(retry_after)
+                        delay = max(delay, retry_after)
+
+                time.sleep(delay)
+                attempt += 1
+
+    @staticmethod
+    def was_rejected(ex):
+        """Checks whether a failed request certainly wasn't acted on, so sending it again can't create a second page
+
+        :param ex: error raised by the request
+        :type ex: Exception
+
+        :return: True if the connection was never made or Notion turned the request away
+        :rtype: bool
+        """
+        import httpx
+
+        return isinstance(ex, httpx.ConnectError) or getattr(ex, 'status', None) in REJECTED_STATUS_CODES
+
+    def __retry_after(self, ex):
+        headers = getattr(ex, 'headers', None)
+        if headers is None:
+            return None
+        try:
+            return float(headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            return None
+
+    def build_properties(self, row_content):
+        """Converts a row's content into the properties payload expected by pages.create
+
+        :param row_content: contents of the row, keyed by column name
+        :type row_content: dictionary
+
+        :return: Notion page properties
+        :rtype: JSON dictionary
+        """
         properties = {}
 
         for column in self.columns:
@@ -123,49 +394,88 @@ class NotionDB:
                     raise NotionDBError(error_msg=f"Value for multi_select column {column_name} must be a list (GPT)") from ex     
                 properties[column_name] = {'multi_select': [{'name': single_value} for single_value in value if single_value != '']}
 
-        try:
-            self.notion.pages.create(
-                parent = {'database_id': self.database_id},
-                properties = properties
-            )
-        except Exception as ex:
-            self.spinner.fail("❌ unable to add row(s) to database")
-            raise NotionDBError(error_msg="Unable to add row to database") from ex
+        return properties
+
+    def iter_pages(self, edited_after: str = None):
+        """Iterates over every page in the database, following pagination
+
+        :param edited_after: only include pages last edited at or after this ISO 8601 time, defaults to None
+        :type edited_after: str, optional
+
+        :return: pages as returned by databases.query
+        :rtype: generator of JSON dictionaries
+        """
+        query = {'database_id': self.database_id, 'page_size': 100}
+        if edited_after is not None:
+            query['filter'] = {'timestamp': 'last_edited_time', 'last_edited_time': {'on_or_after': edited_after}}
+
+        while True:
+            self.rate_limiter.acquire()
+            self.metrics.increment('api_calls', service='notion', operation='databases.query')
+            response = self.notion.databases.query(**query)
+
+            for page in response['results']:
+                yield page
+
+            if not response.get('has_more') or response.get('next_cursor') is None:
+                return
+            query['start_cursor'] = response['next_cursor']
+
+    def page_values(self, page):
+        """Reads the value of every column from a page
+
+        :param page: page as returned by databases.query
+        :type page: JSON dictionary
+
+        :return: values keyed by column name (multi_select values are lists, missing values are None)
+        :rtype: dictionary
+        """
+        values = {}
+
+        for column_name, curr_column in page['properties'].items():
+            column_type = curr_column['type']
+            content = curr_column.get(column_type)
+
+            if content is None:
+                value = [] if column_type == 'multi_select' else None
+            elif column_type in ['title', 'rich_text']:
+                value = ''.join(part.get('plain_text', part.get('text', {}).get('content', '')) for part in content)
+            elif column_type == 'text':
+                value = content.get('content')
+            elif column_type == 'select':
+                value = content.get('name')
+            elif column_type == 'multi_select':
+                value = [option['name'] for option in content]
+            elif column_type == 'date':
+                value = content.get('start')
+            elif column_type in ['number', 'url', 'email', 'phone_number', 'checkbox', 'created_time', 'last_edited_time']:
+                value = content
+            else:
+                # relations, rollups, formulas and files aren't used for finance tracking
+                continue
+
+            values[column_name] = value
+
+        return values
+
+    def iter_rows(self, edited_after: str = None):
+        """Iterates over every row in the database with typed values, one page at a time
+
+        :param edited_after: only include rows last edited at or after this ISO 8601 time, defaults to None
+        :type edited_after: str, optional
+
+        :return: rows with their page ID, last edited time and a value for every column (None if empty)
+        :rtype: generator of dictionaries
+        """
+        for page in self.iter_pages(edited_after=edited_after):
+            values = self.page_values(page)
+
+            row = {'page_id': page['id'], 'last_edited_time': page['last_edited_time']}
+            for column in self._columns:
+                row[column] = values.get(column)
+            yield row
 
     def print(self):
-        database_row = []
-
-        for page in self.pages['results']:
-            page_content = page['properties']
-            page_row = []
-
-            for column in self.columns:
-                curr_column = page_content[column]
-
-                value = None
-                if curr_column['type'] == 'text':
-                    value = curr_column['text']['content']
-                elif curr_column['type'] == 'number':
-                    value = curr_column['number']
-                elif curr_column['type'] == 'select':
-                    value = curr_column['select']['name']
-                elif curr_column['type'] == 'date':
-                    value = curr_column['date']['start']
-                elif curr_column['type'] == 'url':
-                    value = curr_column['url']
-                elif curr_column['type'] == 'email':
-                    value = curr_column['email']
-                elif curr_column['type'] == 'phone_number':
-                    value = curr_column['phone_number']
-                elif curr_column['type'] == 'title':
-                    value = curr_column['title'][0]['text']['content']
-                elif curr_column['type'] == 'multi_select':
-                    value = curr_column['multi_select'][0]['name']
-
-                value = {column: value}
-                page_row.append(value)
-
-            database_row.append(page_row)
-
-        for row in database_row:
-            print(row)
+        # rows are printed as they arrive instead of after the whole database is read
+        for row in self.iter_rows():
+            print([{column: row[column]} for column in self._columns])
@@ -0,0 +1,87 @@
+import math
+
+# detections below this confidence are mostly smudges, logos and fold lines
+MIN_CONFIDENCE = 80.0
+
+def estimate_tokens(text: str):
+    """Roughly estimates the number of GPT tokens in a piece of text (about 4 characters per token)
+
+    :param text: text to estimate for
+    :type text: str
+
+    :return: estimated number of tokens
+    :rtype: int
+    """
+    return math.ceil(len(text) / 4)
+
+def group_rows(text_detections, min_confidence: float = MIN_CONFIDENCE):
+    """Groups Rekognition LINE detections into the rows they were printed on
+
+    :param text_detections: 'TextDetections' from a Rekognition detect_text response
+    :type text_detections: list of dictionaries
+    :param min_confidence: detections below this confidence are dropped, defaults to MIN_CONFIDENCE
+    :type min_confidence: float, optional
+
+    :return: rows from top to bottom, each a list of detections from left to right
+    :rtype: list of lists of dictionaries
+    """
+    lines = []
+    for detection in text_detections:
+        if detection.get('Type') != 'LINE' or detection.get('Confidence', 100.0) < min_confidence:
+            continue
+        if 'BoundingBox' not in detection.get('Geometry', {}):
+            continue
+        lines.append(detection)
+
+    # sort by vertical centre so each line only needs comparing against the row being built
+    lines.sort(key=lambda detection: _center(detection))
+
+    rows = []
+    row_center = None
+    row_height = None
+
+    for line in lines:
+        box = line['Geometry']['BoundingBox']
+        center = _center(line)
+
+        # lines whose centres are within half a line height of the row's centre are on the same row
+        if rows and abs(center - row_center) <= 0.5 * max(box['Height'], row_height):
+            rows[-1].append(line)
+            size = len(rows[-1])
+            row_center += (center - row_center) / size
+            row_height += (box['Height'] - row_height) / size
+        else:
+            rows.append([line])
+            row_center = center
+            row_height = box['Height']
+
+    for row in rows:
+        row.sort(key=lambda detection: detection['Geometry']['BoundingBox']['Left'])
+
+    return rows
+
+def compact_detections(text_detections, min_confidence: float = MIN_CONFIDENCE):
+    """Rebuilds the rows of a receipt from Rekognition's detections
+
+    Only LINE detections are kept (WORD detections repeat the same text), low confidence noise is
+    dropped, and lines printed on the same row (e.g. an item and its price) are joined together.
+
+    :param text_detections: 'TextDetections' from a Rekognition detect_text response
+    :type text_detections: list of dictionaries
+    :param min_confidence: detections below this confidence are dropped, defaults to MIN_CONFIDENCE
+    :type min_confidence: float, optional
+
+    :return: text of each row, from top to bottom
+    :rtype: list of str
+    """
+    rows = group_rows(text_detections, min_confidence)
+
+    # responses without geometry (or without LINE detections) can't be compacted
+    if len(rows) == 0:
+        return [detection['DetectedText'] for detection in text_detections]
+
+    return [' '.join(detection['DetectedText'] for detection in row) for row in rows]
+
+def _center(detection):
+    box = detection['Geometry']['BoundingBox']
+    return box['Top'] + box['Height'] / 2
@@ -0,0 +1,317 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from snaptrack.cache import get_cache_dir
+from snaptrack.notion import NotionDB
+from snaptrack.retry import backoff_delay
+
+# times a row is sent before it is set aside for `snaptrack flush --retry-failed`
+OUTBOX_MAX_ATTEMPTS = 8
+
+# rows taken from the outbox per round of sending
+FLUSH_BATCH_SIZE = 50
+
+# seconds the background flusher sleeps when there is nothing to send
+FLUSH_INTERVAL = 2.0
+
+# seconds claimed rows are held by a flusher before another one may take them over
+CLAIM_LEASE = 300.0
+
+class Outbox:
+    """Durable journal of rows waiting to be created in Notion, kept in SQLite (WAL mode)
+
+    Each row is stored with its already-built properties payload under an idempotency key (the receipt
+    and the row's position on it), so journaling the same receipt twice doesn't queue its rows twice,
+    and rows survive Notion outages and interrupted runs until a flusher sends them. Flushers claim
+    rows before sending them, so several of them (in one process or many) never send a row twice.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+
+        # a single connection shared between threads, guarded by a lock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # WAL with synchronous=NORMAL is still durable across application crashes, without an fsync per row
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "key TEXT PRIMARY KEY, database_id TEXT NOT NULL, properties TEXT NOT NULL, created_at REAL NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, next_attempt_at REAL, last_error TEXT, page_id TEXT, sent_at REAL, claimed_by TEXT)"
+        )
+        # outboxes created before rows were claimed
+        if 'claimed_by' not in [row[1] for row in self._connection.execute("PRAGMA table_info(outbox)")]:
+            self._connection.execute("ALTER TABLE outbox ADD COLUMN claimed_by TEXT")
+        # only unsent rows are looked up by the flusher, so the index stays small as sent rows accumulate
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (database_id, next_attempt_at) WHERE page_id IS NULL"
+        )
+        self._connection.commit()
+
+    @classmethod
+    def default(cls):
+        """Opens the outbox in SnapTrack's cache directory
+
+        :return: the outbox
+        :rtype: Outbox
+        """
+        return cls(get_cache_dir() / 'outbox.sqlite3')
+
+    @staticmethod
+    def make_key(receipt_id, index):
+        return f"{receipt_id}:{index}"
+
+    def enqueue(self, database_id, rows):
+        """Journals rows for a database in one transaction
+
+        :param database_id: ID of the Notion database the rows go to
+        :type database_id: str
+        :param rows: (idempotency key, properties payload) of each row
+        :type rows: list of tuples
+
+        :return: rows that were already in the outbox and so weren't journaled again, as key -> page ID (None if not sent yet)
+        :rtype: dictionary
+        """
+        now = time.time()
+        ignored = {}
+        with self._lock:
+            for key, properties in rows:
+                cursor = self._connection.execute(
+                    "INSERT OR IGNORE INTO outbox (key, database_id, properties, created_at, next_attempt_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, database_id, json.dumps(properties, default=str), now, now)
+                )
+                if cursor.rowcount == 0:
+                    ignored[key] = self._connection.execute("SELECT page_id FROM outbox WHERE key = ?", (key,)).fetchone()[0]
+            self._connection.commit()
+        return ignored
+
+    def claim(self, database_id, limit: int = FLUSH_BATCH_SIZE, lease: float = CLAIM_LEASE):
+        """Takes unsent rows whose next attempt is due, oldest first, so no other flusher sends them too
+
+        Claimed rows aren't due again until the lease runs out, which only matters if the flusher that
+        claimed them stops before marking them sent or failed.
+
+        :param database_id: ID of the Notion database
+        :type database_id: str
+        :param limit: most rows claimed, defaults to FLUSH_BATCH_SIZE
+        :type limit: int, optional
+        :param lease: seconds the rows are held for, defaults to CLAIM_LEASE
+        :type lease: float, optional
+
+        :return: (key, properties payload, attempts) of each claimed row
+        :rtype: list of tuples
+        """
+        claim_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            # a single UPDATE holds SQLite's write lock, so flushers in other processes can't claim the same rows
+            self._connection.execute(
+                "UPDATE outbox SET next_attempt_at = ?, claimed_by = ? WHERE key IN ("
+                "SELECT key FROM outbox WHERE page_id IS NULL AND database_id = ? AND next_attempt_at <= ? "
+                "ORDER BY next_attempt_at, created_at LIMIT ?)",
+                (now + lease, claim_id, database_id, now, limit)
+            )
+            self._connection.commit()
+            rows = self._connection.execute(
+                "SELECT key, properties, attempts FROM outbox WHERE claimed_by = ? AND page_id IS NULL ORDER BY created_at", (claim_id,)
+            ).fetchall()
+        return [(key, json.loads(properties), attempts) for key, properties, attempts in rows]
+
+    def has_due(self, database_id):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM outbox WHERE page_id IS NULL AND database_id = ? AND next_attempt_at <= ? LIMIT 1", (database_id, time.time())
+            ).fetchone()
+        return row is not None
+
+    def mark_sent(self, key, page_id):
+        with self._lock:
+            self._connection.execute(
+                "UPDATE outbox SET page_id = ?, sent_at = ?, attempts = attempts + 1, last_error = NULL, claimed_by = NULL WHERE key = ?",
+                (page_id, time.time(), key)
+            )
+            self._connection.commit()
+
+    def mark_failed(self, key, error, retry_at=None):
+        """Records a failed send
+
+        :param key: idempotency key of the row
+        :type key: str
+        :param error: why the row couldn't be sent
+        :type error: str
+        :param retry_at: when to try again, or None to set the row aside until failed rows are retried
+        :type retry_at: float, optional
+        """
+        with self._lock:
+            self._connection.execute(
+                "UPDATE outbox SET attempts = attempts + 1, last_error = ?, next_attempt_at = ?, claimed_by = NULL WHERE key = ?",
+                (error, retry_at, key)
+            )
+            self._connection.commit()
+
+    def retry_failed(self, database_id):
+        """Makes rows that were set aside due again
+
+        :param database_id: ID of the Notion database
+        :type database_id: str
+
+        :return: number of rows made due
+        :rtype: int
+        """
+        with self._lock:
+            cursor = self._connection.execute(
+                "UPDATE outbox SET next_attempt_at = ?, attempts = 0 WHERE page_id IS NULL AND database_id = ? AND next_attempt_at IS NULL",
+                (time.time(), database_id)
+            )
+            self._connection.commit()
+            return cursor.rowcount
+
+    def prune(self, older_than: float):
+        """Deletes sent rows, keeping recent ones so re-journaled receipts still find their pages
+
+        :param older_than: seconds since a row was sent before it is deleted
+        :type older_than: float
+
+        :return: number of rows deleted
+        :rtype: int
+        """
+        with self._lock:
+            cursor = self._connection.execute("DELETE FROM outbox WHERE page_id IS NOT NULL AND sent_at < ?", (time.time() - older_than,))
+            self._connection.commit()
+            return cursor.rowcount
+
+    def stats(self, database_id):
+        """Counts the rows for a database by state
+
+        :param database_id: ID of the Notion database
+        :type database_id: str
+
+        :return: number of 'pending' (waiting to be sent), 'failed' (set aside) and 'sent' rows
+        :rtype: dictionary
+        """
+        with self._lock:
+            pending, failed, sent = self._connection.execute(
+                "SELECT COALESCE(SUM(page_id IS NULL AND next_attempt_at IS NOT NULL), 0), "
+                "COALESCE(SUM(page_id IS NULL AND next_attempt_at IS NULL), 0), COALESCE(SUM(page_id IS NOT NULL), 0) "
+                "FROM outbox WHERE database_id = ?",
+                (database_id,)
+            ).fetchone()
+        return {'pending': pending, 'failed': failed, 'sent': sent}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+class OutboxFlusher:
+    """Sends journaled rows to Notion at a controlled rate, either once or on a background thread
+
+    Pages are created through the database's rate limiter and retries. Rows that still fail are
+    retried later with backoff (requests Notion turned away, like rate limits) or set aside (anything else,
+    including timeouts that may have created the page, or too many attempts).
+    """
+
+    def __init__(self, database: NotionDB, outbox: Outbox, workers: int = 2, interval: float = FLUSH_INTERVAL, on_sent=None):
+        self.database = database
+        self.outbox = outbox
+        self.workers = workers
+        self.interval = interval
+
+        # called with (key, page_id or None, error or None) after every attempt
+        self.on_sent = on_sent
+
+        self.metrics = database.metrics
+        self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+        self.thread = None
+
+        self.sent = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def flush(self):
+        """Sends every row that is due, leaving rows that failed to be retried later
+
+        :return: number of rows sent
+        :rtype: int
+        """
+        sent = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while not self.stop_event.is_set():
+                claimed = self.outbox.claim(self.database.database_id)
+                if len(claimed) == 0:
+                    break
+
+                send = self.metrics.bind(self.__send)
+                sent += sum(executor.map(lambda item: send(*item), claimed))
+        return sent
+
+    def __send(self, key, properties, attempts):
+        try:
+            with self.metrics.span('outbox.send'):
+                page = self.database.create_page(properties)
+        except Exception as ex:
+            # same rule as the database's own retries: only requests Notion turned away are sent again, as
+            # after a timeout or a server error the page may already exist
+            transient = NotionDB.was_rejected(ex)
+
+            # invalid payloads and rows that may have been created wait for a person to look at them
+            retry_at = time.time() + backoff_delay(attempts, base_delay=2.0, max_delay=300.0) if transient and attempts + 1 < OUTBOX_MAX_ATTEMPTS else None
+            self.outbox.mark_failed(key, str(ex), retry_at)
+            self.metrics.increment('outbox_rows', result='retrying' if retry_at is not None else 'failed')
+            with self._lock:
+                self.failed += 1
+            if self.on_sent is not None:
+                self.on_sent(key, None, ex)
+            return 0
+
+        self.outbox.mark_sent(key, page.get('id'))
+        self.metrics.increment('outbox_rows', result='sent')
+        with self._lock:
+            self.sent += 1
+        if self.on_sent is not None:
+            self.on_sent(key, page.get('id'), None)
+        return 1
+
+    def start(self):
+        """Starts sending rows in the background as they are journaled"""
+        self.thread = threading.Thread(target=self.__run, name='snaptrack-outbox', daemon=True)
+        self.thread.start()
+
+    def notify(self):
+        """Wakes the background flusher after rows were journaled"""
+        self.wake_event.set()
+
+    def __run(self):
+        while not self.stop_event.is_set():
+            self.wake_event.clear()
+            self.flush()
+            self.wake_event.wait(self.interval)
+
+    def stop(self, drain: bool = True, timeout: float = None):
+        """Stops the background flusher
+
+        :param drain: send the rows that are due first, defaults to True
+        :type drain: bool, optional
+        :param timeout: most seconds to wait for the flusher, defaults to waiting until it is done
+        :type timeout: float, optional
+        """
+        if self.thread is None:
+            return
+
+        if drain:
+            # one more pass after everything journaled so far, then stop
+            self.wake_event.set()
+            deadline = time.time() + timeout if timeout is not None else None
+            while self.outbox.has_due(self.database.database_id):
+                # a flusher that died (e.g. on a database error) will never send the rest
+                if not self.thread.is_alive() or (deadline is not None and time.time() >= deadline):
+                    break
+                time.sleep(0.1)
+
+        self.stop_event.set()
+        self.wake_event.set()
+        self.thread.join(timeout)
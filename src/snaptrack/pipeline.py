@@ -0,0 +1,584 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import json
+import time
+from colorama import Fore
+from snaptrack.cache import DiskCache
+from snaptrack.checkpoint import ReceiptCheckpoint
+from snaptrack.duplicates import DuplicateIndex, DuplicateReceiptError
+from snaptrack.metrics import traced
+from snaptrack.notion import NotionDB, NotionDBError, RowResult
+from snaptrack.receipt_parser import ReceiptParser, ReceiptParserError
+from snaptrack.retry import backoff_delay, retry_call
+
+# number of attempts each stage gets before the receipt is given up on; every row insert is already
+# retried by NotionDB, so the 'inserted' stage makes a single pass over the rows
+STAGE_ATTEMPTS = {'ocr': 3, 'entries': 4, 'classified': 3, 'inserted': 1}
+
+# streamed entries are classified in groups of this size, trading GPT calls for time to first row
+STREAM_CLASSIFY_BATCH = 5
+
+class ReceiptResult:
+    """Outcome of processing a single receipt
+    """
+
+    def __init__(self, filepath, display_name=None):
+        self.filepath = filepath
+        # how the receipt is named in messages and in the duplicate index, when filepath is only a temporary copy
+        self.display_name = display_name or filepath
+        self.checkpoint = None
+        self.rows = []
+        self.error = None
+        self.stage = None
+        self.start = time.time()
+        self.end = None
+
+        # the earlier receipt this one was skipped as a duplicate of
+        self.duplicate = None
+        # image hashes and contents signature, recorded once the receipt is sent
+        self.fingerprint = None
+        self.signature = None
+
+    @property
+    def ok(self):
+        return self.error is None and all(row.ok for row in self.rows)
+
+    @property
+    def skipped(self):
+        return self.duplicate is not None
+
+    @property
+    def seconds(self):
+        return (self.end or time.time()) - self.start
+
+class ReceiptPipeline:
+    """Processes receipts stage by stage (OCR, extraction, classification, insertion)
+
+    The output of every stage is checkpointed per receipt, each stage retries with its own bounded
+    budget, and a receipt that failed or was interrupted resumes at the stage it stopped in. Many
+    receipts can be run at once, with separately bounded worker pools for OCR, GPT and Notion.
+    """
+
+    def __init__(self, receipt_parser: ReceiptParser, database: NotionDB, spinner, ocr_workers: int = 4, llm_workers: int = 4, notion_workers: int = 2,
+                 attempts: dict = None, checkpoints: bool = True, flusher=None, duplicates: DuplicateIndex = None, allow_duplicates: bool = False):
+        self.receipt_parser = receipt_parser
+        self.database = database
+        self.spinner = spinner
+
+        self.ocr_workers = ocr_workers
+        self.llm_workers = llm_workers
+        self.notion_workers = notion_workers
+
+        self.attempts = dict(STAGE_ATTEMPTS, **(attempts or {}))
+
+        # the 'entries' stage owns the retry budget for extraction, so the parser only tries once per call
+        receipt_parser.extraction_attempts = 1
+        self.checkpoints = checkpoints
+
+        # with an OutboxFlusher, rows are journaled to its outbox and the receipt is done once they are durable
+        self.flusher = flusher
+
+        # receipts matching one already sent are skipped before OCR (or before GPT classifies them), unless allowed
+        self.duplicates = duplicates
+        self.allow_duplicates = allow_duplicates
+
+        # stage spans nest the parser's and database's own spans, so they share its metrics
+        self.metrics = receipt_parser.metrics
+
+    def process(self, filepath, display_name: str = None):
+        """Runs a single receipt through every stage
+
+        :param filepath: path of the receipt image
+        :type filepath: str
+        :param display_name: name to show and record for the receipt instead of filepath, defaults to None
+        :type display_name: str, optional
+
+        :return: the outcome for the receipt
+        :rtype: ReceiptResult
+        """
+        result = ReceiptResult(filepath, display_name)
+
+        try:
+            rekognition_response = self.ocr(result)
+            products = self.extract(result, rekognition_response)
+            result.rows = self.insert(result, products)
+        except Exception as ex:
+            self.__fail(result, ex)
+
+        self.__finish(result)
+        return result
+
+    def stream(self, filepath, classify_batch: int = STREAM_CLASSIFY_BATCH, display_name: str = None):
+        """Runs a single receipt with GPT's reply streamed, so rows reach Notion while later ones are still being generated
+
+        Each entry is filtered as soon as it is complete, classified in small groups, and inserted right
+        after. A receipt that already has extraction checkpoints, or can be read without GPT, goes through
+        the regular stages instead. Only the image is checked for duplicates, as rows are inserted before
+        the whole reply is known.
+
+        :param filepath: path of the receipt image
+        :type filepath: str
+        :param classify_batch: number of entries classified per GPT call, defaults to STREAM_CLASSIFY_BATCH
+        :type classify_batch: int, optional
+        :param display_name: name to show and record for the receipt instead of filepath, defaults to None
+        :type display_name: str, optional
+
+        :return: the outcome for the receipt
+        :rtype: ReceiptResult
+        """
+        result = ReceiptResult(filepath, display_name)
+
+        try:
+            rekognition_response = self.ocr(result)
+            checkpoint = result.checkpoint
+
+            # nothing to stream when the receipt can be read without GPT
+            local_entries = None
+            if not (checkpoint.has('streamed') or checkpoint.has('entries') or checkpoint.has('classified')):
+                local_entries = self.receipt_parser.extract_entries_locally(rekognition_response, self.database.columns)
+
+            if checkpoint.has('entries') or checkpoint.has('classified') or local_entries is not None:
+                # carries on from the OCR (and local extraction) already done rather than starting over
+                products = self.extract(result, rekognition_response, local_entries)
+                result.rows = self.insert(result, products)
+            else:
+                with self.metrics.span('stage.stream'):
+                    result.rows = self.__stream_rows(result, rekognition_response, classify_batch)
+        except Exception as ex:
+            self.__fail(result, ex)
+
+        self.__finish(result)
+        return result
+
+    def __fail(self, result, ex):
+        if isinstance(ex, DuplicateReceiptError):
+            result.duplicate = ex.match
+        else:
+            result.error = ex
+
+    def __finish(self, result):
+        result.end = time.time()
+        self.metrics.increment('receipts', result='skipped' if result.skipped else 'ok' if result.ok else 'failed')
+
+        if self.duplicates is not None and result.fingerprint is not None:
+            if result.ok and not result.skipped:
+                sha256, image_hash = result.fingerprint
+                self.duplicates.record(self.database.database_id, result.display_name, sha256, image_hash, result.signature)
+            self.duplicates.release(result.filepath)
+
+        if result.ok and not result.skipped:
+            self.__learn(result)
+
+    def __learn(self, result):
+        # the receipt is already in the database, so a classifier that can't learn from it is only worth a warning
+        try:
+            rows = [row for row in result.rows if row.ok]
+            self.receipt_parser.learn_classifications([row.row for row in rows], self.database.columns, [row.page_id for row in rows])
+        except Exception as ex:
+            self.spinner.write(Fore.YELLOW + f"[Local classifier couldn't learn from {result.display_name}: {ex}]" + Fore.RESET)
+
+    def __check_image(self, result):
+        with open(result.filepath, 'rb') as image_file:
+            sha256, image_hash = DuplicateIndex.fingerprint_image(image_file.read())
+        result.fingerprint = (sha256, image_hash)
+
+        if not self.allow_duplicates:
+            match = self.duplicates.find_image(self.database.database_id, sha256, image_hash, result.filepath)
+            if match is not None:
+                raise DuplicateReceiptError(error_msg=f"Receipt is a {match.describe()}", match=match)
+        self.duplicates.claim(self.database.database_id, result.filepath, sha256, image_hash, result.display_name)
+
+    def __check_contents(self, result, entries):
+        result.signature = DuplicateIndex.signature(entries, self.database.columns)
+        if not self.allow_duplicates:
+            match = self.duplicates.find_signature(self.database.database_id, result.signature)
+            if match is not None:
+                raise DuplicateReceiptError(error_msg=f"Receipt is a {match.describe()}", match=match)
+
+    def __on_retry(self, stage):
+        return lambda attempt, ex: self.metrics.increment('retries', stage=stage)
+
+    def __stream_rows(self, result, rekognition_response, classify_batch):
+        checkpoint = result.checkpoint
+        columns = self.database.columns
+        select_options = self.database.select_options
+        receipt_list = self.receipt_parser.build_receipt_list(rekognition_response)
+
+        # entries streamed before an interruption are kept, and inserted rows are positions in this list
+        entries = checkpoint.get('streamed') or []
+        already_inserted = checkpoint.inserted_rows()
+
+        classified = []
+        insert_futures = []
+
+        with ThreadPoolExecutor(max_workers=self.llm_workers) as classify_pool, \
+             ThreadPoolExecutor(max_workers=self.notion_workers) as notion_pool:
+
+            insert_row = self.metrics.bind(self.database.insert_row if self.flusher is None else self.__journal_row(result))
+
+            def classify_and_insert(batch, first_index):
+                batch = retry_call(lambda: self.receipt_parser.classify_entries([dict(entry) for entry in batch], columns, select_options), self.attempts['classified'],
+                                   on_retry=self.__on_retry('classified'))
+                for offset, row in enumerate(batch):
+                    index = first_index + offset
+                    classified.append((index, row))
+                    if index in already_inserted:
+                        insert_futures.append(RowResult(index, row, page_id=already_inserted[index]))
+                    else:
+                        insert_futures.append(notion_pool.submit(insert_row, row, index, checkpoint.mark_inserted))
+
+            result.stage = 'entries'
+            classify_futures = []
+            for first_index in range(0, len(entries), classify_batch):
+                classify_futures.append(classify_pool.submit(self.metrics.bind(classify_and_insert), entries[first_index:first_index + classify_batch], first_index))
+
+            # how often each entry is already in entries, so a regenerated reply only adds the ones that are new
+            streamed = {}
+            for entry in entries:
+                streamed[self.__entry_key(entry)] = streamed.get(self.__entry_key(entry), 0) + 1
+
+            def stream_entries():
+                seen = {}
+                pending = []
+                try:
+                    for entry in self.receipt_parser.stream_entries(receipt_list, columns, select_options):
+                        if len(self.receipt_parser.filter_content([entry], columns)) == 0:
+                            continue
+
+                        # entries are matched by their contents, as a new reply may not list them in the same order
+                        key = self.__entry_key(entry)
+                        seen[key] = seen.get(key, 0) + 1
+                        if seen[key] <= streamed.get(key, 0):
+                            continue
+                        streamed[key] = seen[key]
+
+                        entries.append(entry)
+                        checkpoint.save('streamed', entries)
+                        pending.append(entry)
+                        if len(pending) == classify_batch:
+                            classify_futures.append(classify_pool.submit(self.metrics.bind(classify_and_insert), pending, len(entries) - len(pending)))
+                            pending = []
+                finally:
+                    # entries streamed before a failure are complete, so they go ahead rather than wait for the retry
+                    if len(pending) != 0:
+                        classify_futures.append(classify_pool.submit(self.metrics.bind(classify_and_insert), pending, len(entries) - len(pending)))
+
+                if len(entries) == 0:
+                    raise ReceiptParserError(error_msg="no products found on receipt")
+
+            retry_call(stream_entries, self.attempts['entries'], on_retry=self.__on_retry('entries'))
+            checkpoint.save('entries', entries)
+
+            # rows are already on their way to Notion, so the signature is only recorded for later receipts
+            result.signature = DuplicateIndex.signature(entries, columns)
+
+            result.stage = 'classified'
+            for future in classify_futures:
+                future.result()
+            classified.sort(key=lambda item: item[0])
+            checkpoint.save('classified', [row for _, row in classified])
+
+            result.stage = 'inserted'
+            rows = [future if isinstance(future, RowResult) else future.result() for future in insert_futures]
+
+        # rows that still failed after NotionDB's retries are left in the checkpoint for the next run
+        rows.sort(key=lambda row: row.index)
+        if all(row.ok for row in rows):
+            checkpoint.clear()
+        return rows
+
+    @staticmethod
+    def __entry_key(entry):
+        return json.dumps(entry, sort_keys=True, default=str)
+
+    def __merge_entries(self, streamed, entries):
+        # streamed entries keep their positions and a new reply only adds the ones they don't already have
+        remaining = {}
+        for entry in streamed:
+            remaining[self.__entry_key(entry)] = remaining.get(self.__entry_key(entry), 0) + 1
+
+        merged = list(streamed)
+        for entry in entries:
+            key = self.__entry_key(entry)
+            if remaining.get(key, 0) > 0:
+                remaining[key] -= 1
+            else:
+                merged.append(entry)
+        return merged
+
+    def run(self, filepaths):
+        """Runs every receipt through every stage
+
+        A receipt moves on to the next stage as soon as its previous stage finishes, so OCR for later
+        receipts overlaps with extraction and insertion for earlier ones.
+
+        :param filepaths: paths of the receipt images
+        :type filepaths: list of str
+
+        :return: the outcome for each receipt, in the same order as filepaths
+        :rtype: list of ReceiptResult
+        """
+        results = [ReceiptResult(filepath) for filepath in filepaths]
+        finished = 0
+
+        with ThreadPoolExecutor(max_workers=self.ocr_workers) as ocr_pool, \
+             ThreadPoolExecutor(max_workers=self.llm_workers) as llm_pool, \
+             ThreadPoolExecutor(max_workers=self.notion_workers) as notion_pool:
+
+            # every in-flight future, mapped to its pool and the receipt it belongs to
+            pending = {ocr_pool.submit(self.ocr, result): ('ocr', index) for index, result in enumerate(results)}
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    pool, index = pending.pop(future)
+                    result = results[index]
+
+                    try:
+                        value = future.result()
+                    except Exception as ex:
+                        self.__fail(result, ex)
+                        value = None
+                    failed = result.error is not None or result.skipped
+
+                    if not failed and pool == 'ocr':
+                        pending[llm_pool.submit(self.extract, result, value)] = ('llm', index)
+                    elif not failed and pool == 'llm':
+                        pending[notion_pool.submit(self.insert, result, value)] = ('notion', index)
+                    else:
+                        if not failed:
+                            result.rows = value
+                        self.__finish(result)
+                        finished += 1
+                        self.spinner.text = f"Processing receipts ({finished}/{len(filepaths)} done)..."
+
+        return results
+
+    @traced('stage.ocr')
+    def ocr(self, result: ReceiptResult):
+        """Runs OCR on a receipt, unless a checkpoint already has its result
+
+        :param result: the receipt being processed
+        :type result: ReceiptResult
+
+        :return: a AWS Rekognition result
+        :rtype: JSON dictionary
+        """
+        result.stage = 'ocr'
+        if self.duplicates is not None:
+            with self.metrics.span('duplicates.image'):
+                self.__check_image(result)
+
+        if self.checkpoints:
+            result.checkpoint = ReceiptCheckpoint.for_receipt(result.filepath, self.database.database_id)
+        else:
+            result.checkpoint = ReceiptCheckpoint()
+
+        if result.checkpoint.has('ocr'):
+            return result.checkpoint.get('ocr')
+
+        def detect_text():
+            rekognition_response = self.receipt_parser.get_rekognition_response(result.filepath)
+            if 'Error' in rekognition_response:
+                raise ReceiptParserError(error_msg=f"invalid AWS response: {rekognition_response['Error']}")
+            return rekognition_response
+
+        # a missing or unreadable file won't fix itself
+        rekognition_response = retry_call(detect_text, self.attempts['ocr'], should_retry=lambda ex: not isinstance(ex, OSError), on_retry=self.__on_retry('ocr'))
+
+        # only the detections are needed later on, not the HTTP metadata
+        rekognition_response = {
+            'TextDetections': rekognition_response.get('TextDetections', []),
+            'TextModelVersion': rekognition_response.get('TextModelVersion')
+        }
+        result.checkpoint.save('ocr', rekognition_response)
+        return rekognition_response
+
+    @traced('stage.extract')
+    def extract(self, result: ReceiptResult, rekognition_response, local_entries=None):
+        """Extracts and filters a receipt's entries, then classifies them, resuming from checkpoints
+
+        :param result: the receipt being processed
+        :type result: ReceiptResult
+        :param rekognition_response: a AWS Rekognition result
+        :type rekognition_response: JSON dictionary
+        :param local_entries: entries the local extractor already found, defaults to None (it is run here)
+        :type local_entries: list of dictionaries, optional
+
+        :return: products on the receipt, keyed by column name
+        :rtype: list of dictionaries
+        """
+        checkpoint = result.checkpoint
+        columns = self.database.columns
+        select_options = self.database.select_options
+
+        result.stage = 'entries'
+        if checkpoint.has('classified'):
+            if self.duplicates is not None:
+                result.signature = DuplicateIndex.signature(checkpoint.get('classified'), columns)
+            return checkpoint.get('classified')
+
+        if checkpoint.has('entries'):
+            entries = checkpoint.get('entries')
+        else:
+            # entries of an interrupted stream, which the rows it already inserted are positions in
+            streamed = checkpoint.get('streamed') or []
+
+            # locally extracted entries skip GPT, but still go through the same filters
+            entries = local_entries if local_entries is not None else self.receipt_parser.extract_entries_locally(rekognition_response, columns)
+            if entries is not None:
+                entries = self.__merge_entries(streamed, self.receipt_parser.filter_content(entries, columns))
+
+            if not entries:
+                receipt_list = self.receipt_parser.build_receipt_list(rekognition_response)
+
+                # filtering only looks at non-selection columns, so junk entries are dropped before classifying them
+                def extract_entries():
+                    entries = self.receipt_parser.extract_entries(receipt_list, columns, select_options)
+                    entries = self.__merge_entries(streamed, self.receipt_parser.filter_content(entries, columns))
+                    if len(entries) == 0:
+                        raise ReceiptParserError(error_msg="no products found on receipt")
+                    return entries
+
+                entries = retry_call(extract_entries, self.attempts['entries'], on_retry=self.__on_retry('entries'))
+
+            checkpoint.save('entries', entries)
+
+        # a receipt photographed twice only shows up once its contents are known, but before it is classified
+        if self.duplicates is not None:
+            with self.metrics.span('duplicates.contents'):
+                self.__check_contents(result, entries)
+
+        result.stage = 'classified'
+        classified = retry_call(lambda: self.receipt_parser.classify_entries([dict(entry) for entry in entries], columns, select_options), self.attempts['classified'],
+                                on_retry=self.__on_retry('classified'))
+        checkpoint.save('classified', classified)
+
+        return classified
+
+    def __receipt_id(self, result):
+        if result.checkpoint.receipt_id is not None:
+            return result.checkpoint.receipt_id
+        with open(result.filepath, 'rb') as image_file:
+            return DiskCache.make_key(self.database.database_id, image_file.read())
+
+    def __journal(self, result, products, indices):
+        receipt_id = self.__receipt_id(result)
+        keys = {index: self.flusher.outbox.make_key(receipt_id, index) for index in indices}
+        with self.metrics.span('outbox.journal', rows=len(indices)):
+            ignored = self.flusher.outbox.enqueue(self.database.database_id, [
+                (keys[index], self.database.build_properties(products[index])) for index in indices
+            ])
+        self.metrics.increment('outbox_rows', len(indices) - len(ignored), result='queued')
+        self.flusher.notify()
+
+        rows = []
+        for index in indices:
+            page_id = ignored.get(keys[index])
+            if page_id is None:
+                # new rows, and rows an interrupted run already journaled, are both waiting in the outbox
+                rows.append(RowResult(index, products[index], queued=True))
+            elif not self.allow_duplicates:
+                rows.append(RowResult(index, products[index], page_id=page_id))
+            else:
+                # the outbox never sends the same row twice, so a deliberate re-send can't go through it
+                error = NotionDBError(error_msg=f"Row was already sent through the outbox as page {page_id}, send the receipt without --outbox to add it again")
+                rows.append(RowResult(index, products[index], error=error))
+        return rows
+
+    def __journal_row(self, result):
+        def journal_row(row, index, on_inserted=None):
+            try:
+                return self.__journal(result, {index: row}, [index])[0]
+            except Exception as ex:
+                return RowResult(index, row, error=ex)
+        return journal_row
+
+    @traced('stage.insert')
+    def insert(self, result: ReceiptResult, products):
+        """Writes a receipt's products to Notion, skipping rows a previous run already wrote
+
+        :param result: the receipt being processed
+        :type result: ReceiptResult
+        :param products: products on the receipt, keyed by column name
+        :type products: list of dictionaries
+
+        :return: the outcome of each row
+        :rtype: list of RowResult
+        """
+        checkpoint = result.checkpoint
+        result.stage = 'inserted'
+
+        inserted = checkpoint.inserted_rows()
+        rows = [RowResult(index, products[index], page_id=inserted[index]) for index in inserted if index < len(products)]
+        remaining = [index for index in range(len(products)) if index not in inserted]
+
+        if self.flusher is not None and len(remaining) != 0:
+            # one local transaction instead of a Notion call per row; the flusher sends them from here on
+            rows += self.__journal(result, products, remaining)
+            remaining = []
+
+        for attempt in range(self.attempts['inserted']):
+            if len(remaining) == 0:
+                break
+            if attempt != 0:
+                self.metrics.increment('retries', len(remaining), stage='inserted')
+                time.sleep(backoff_delay(attempt - 1))
+
+            # indices from add_rows are relative to the rows passed in
+            batch = remaining
+            batch_results = self.database.add_rows(
+                [products[index] for index in batch],
+                on_inserted=lambda position, page_id: checkpoint.mark_inserted(batch[position], page_id)
+            )
+
+            remaining = []
+            for row in batch_results:
+                if row.ok:
+                    rows.append(RowResult(batch[row.index], row.row, page_id=row.page_id))
+                elif attempt == self.attempts['inserted'] - 1:
+                    rows.append(RowResult(batch[row.index], row.row, error=row.error))
+                else:
+                    remaining.append(batch[row.index])
+
+        rows.sort(key=lambda row: row.index)
+
+        # a fully written receipt has nothing left to resume
+        if all(row.ok for row in rows):
+            checkpoint.clear()
+
+        return rows
+
+    def print_result(self, result: ReceiptResult, filepath: str = None):
+        """Prints a single line describing how a receipt went
+
+        :param result: outcome of the receipt
+        :type result: ReceiptResult
+        :param filepath: path to show instead of the one the receipt was processed from, defaults to None
+        :type filepath: str, optional
+        """
+        filepath = filepath or result.display_name
+        if result.skipped:
+            self.spinner.write(Fore.YELLOW + f"↷ {filepath}: skipped, {result.duplicate.describe()}" + Fore.RESET)
+        elif result.ok:
+            queued = len([row for row in result.rows if row.queued])
+            added = f"{len(result.rows) - queued} row(s) added" + (f", {queued} queued" if queued != 0 else '')
+            self.spinner.write(Fore.GREEN + f"✔ {filepath}: {added} in {'{:.3f}'.format(result.seconds)} seconds" + Fore.RESET)
+        elif result.error is not None:
+            self.spinner.write(Fore.RED + f"✘ {filepath}: failed during {result.stage} ({result.error})" + Fore.RESET)
+        else:
+            failed = [row for row in result.rows if not row.ok]
+            self.spinner.write(Fore.RED + f"✘ {filepath}: {len(failed)} of {len(result.rows)} row(s) not added ({failed[0].error})" + Fore.RESET)
+
+    def print_summary(self, results):
+        """Prints one line per receipt, followed by totals
+
+        :param results: outcomes returned by run
+        :type results: list of ReceiptResult
+        """
+        for result in results:
+            self.print_result(result)
+
+        succeeded = len([result for result in results if result.ok and not result.skipped])
+        skipped = len([result for result in results if result.skipped])
+        self.spinner.write(f"{succeeded} of {len(results)} receipt(s) sent to database" + (f", {skipped} skipped as duplicates" if skipped != 0 else ''))
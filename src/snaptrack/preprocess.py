@@ -0,0 +1,167 @@
+import io
+import time
+
+# Rekognition rejects image bytes over 5 MB, so leave some headroom
+MAX_IMAGE_BYTES = 4 * 1024 * 1024
+
+# long edge images are downscaled to; small receipt print is still legible at this size
+TARGET_LONG_EDGE = 2000
+
+class ImagePreprocessorError(Exception):
+    """Error class for the ImagePreprocessor class
+    """
+
+    def __init__(self, error_msg):
+        self.message = error_msg
+        super().__init__(self.message)
+
+class ImagePreprocessor:
+    """Shrinks receipt photos before they are uploaded for OCR
+
+    Stages run in order: EXIF orientation fix, grayscale, contrast normalization, auto-crop to the
+    receipt, downscale to a target long edge (only the width for images that are tiled), and a JPEG
+    re-encode that fits a byte budget.
+    """
+
+    def __init__(self, fix_orientation: bool = True, grayscale: bool = True, normalize_contrast: bool = True,
+                 auto_crop: bool = True, target_long_edge: int = TARGET_LONG_EDGE, max_bytes: int = MAX_IMAGE_BYTES):
+        self.fix_orientation = fix_orientation
+        self.grayscale = grayscale
+        self.normalize_contrast = normalize_contrast
+        self.auto_crop = auto_crop
+        self.target_long_edge = target_long_edge
+        self.max_bytes = max_bytes
+
+    def signature(self):
+        """Describes the configuration, so cached results from other configurations aren't reused
+
+        :return: description of every setting
+        :rtype: str
+        """
+        return (f"orient={self.fix_orientation};gray={self.grayscale};contrast={self.normalize_contrast};"
+                f"crop={self.auto_crop};edge={self.target_long_edge};bytes={self.max_bytes}")
+
+    def process(self, image_data: bytes, measure: bool = False, tiled: bool = False):
+        """Runs every enabled stage on an image
+
+        :param image_data: contents of the image file
+        :type image_data: bytes
+        :param measure: encode after every stage to report its effect on size (slower), defaults to False
+        :type measure: bool, optional
+        :param tiled: the image will be split into strips for OCR, so only its width is limited, defaults to False
+        :type tiled: bool, optional
+
+        :return: the re-encoded JPEG, and for every stage its name, seconds taken, pixel size and (if measured) encoded bytes
+        :rtype: tuple of bytes and list of dictionaries
+        """
+        try:
+            from PIL import Image, ImageOps
+        except ImportError as ex:
+            raise ImagePreprocessorError(error_msg="Pillow is required for image preprocessing") from ex
+
+        stats = []
+
+        def record(stage, image, start):
+            stats.append({
+                'stage': stage,
+                'seconds': time.perf_counter() - start,
+                'size': image.size,
+                'bytes': len(self.__encode(image, 90)) if measure else None
+            })
+
+        start = time.perf_counter()
+        try:
+            image = Image.open(io.BytesIO(image_data))
+            image.load()
+        except Exception as ex:
+            raise ImagePreprocessorError(error_msg="Unable to read image") from ex
+        stats.append({'stage': 'original', 'seconds': time.perf_counter() - start, 'size': image.size, 'bytes': len(image_data)})
+
+        if self.fix_orientation:
+            start = time.perf_counter()
+            image = ImageOps.exif_transpose(image)
+            record('orientation', image, start)
+
+        # JPEG can't store alpha or palette images, and later stages work on one or three channels
+        if self.grayscale:
+            start = time.perf_counter()
+            image = image.convert('L')
+            record('grayscale', image, start)
+        elif image.mode not in ['RGB', 'L']:
+            image = image.convert('RGB')
+
+        if self.normalize_contrast:
+            start = time.perf_counter()
+            image = ImageOps.autocontrast(image, cutoff=1)
+            record('contrast', image, start)
+
+        if self.auto_crop:
+            start = time.perf_counter()
+            image = self.__crop_to_receipt(image)
+            record('crop', image, start)
+
+        # strips are about as tall as the receipt is wide, so a long receipt keeps its full height when tiled
+        edge = image.width if tiled else max(image.size)
+        if self.target_long_edge is not None and edge > self.target_long_edge:
+            start = time.perf_counter()
+            if tiled:
+                image = image.resize((self.target_long_edge, max(1, round(image.height * self.target_long_edge / image.width))), Image.LANCZOS)
+            else:
+                image.thumbnail((self.target_long_edge, self.target_long_edge), Image.LANCZOS)
+            record('downscale', image, start)
+
+        # each strip is uploaded on its own, so a tiled image gets a budget per strip-sized section
+        start = time.perf_counter()
+        encoded = self.__encode_within_budget(image, self.max_bytes * max(1, image.height // image.width) if tiled else self.max_bytes)
+        stats.append({'stage': 'encode', 'seconds': time.perf_counter() - start, 'size': image.size, 'bytes': len(encoded)})
+
+        return encoded, stats
+
+    def __crop_to_receipt(self, image):
+        from PIL import ImageFilter, ImageStat
+
+        # find the bright paper on a small copy, smoothing away specks of glare in the background
+        small = image.convert('L')
+        scale = max(small.size) / 400
+        if scale > 1:
+            small = small.resize((max(1, int(small.width / scale)), max(1, int(small.height / scale))))
+        else:
+            scale = 1
+
+        threshold = ImageStat.Stat(small).mean[0]
+        mask = small.point(lambda pixel: 255 if pixel > threshold else 0).filter(ImageFilter.MedianFilter(5))
+        box = mask.getbbox()
+        if box is None:
+            return image
+
+        # skip crops that would keep almost everything or cut away most of the photo
+        left, top, right, bottom = box
+        area_kept = ((right - left) * (bottom - top)) / (small.width * small.height)
+        if area_kept > 0.95 or area_kept < 0.1:
+            return image
+
+        # scale back up with a small margin so text on the paper's edge isn't clipped
+        margin = 4
+        return image.crop((
+            max(0, int((left - margin) * scale)),
+            max(0, int((top - margin) * scale)),
+            min(image.width, int((right + margin) * scale)),
+            min(image.height, int((bottom + margin) * scale))
+        ))
+
+    def __encode_within_budget(self, image, max_bytes):
+        from PIL import Image
+
+        while True:
+            for quality in [90, 80, 70, 60, 50, 40]:
+                encoded = self.__encode(image, quality)
+                if len(encoded) <= max_bytes:
+                    return encoded
+
+            # even low quality is too large, so shrink the image and try again
+            image = image.resize((max(1, int(image.width * 0.8)), max(1, int(image.height * 0.8))), Image.LANCZOS)
+
+    def __encode(self, image, quality):
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=quality, optimize=True)
+        return buffer.getvalue()
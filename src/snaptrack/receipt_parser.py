@@ -1,17 +1,32 @@
-import re
 import ast
 import json
-import boto3
+import threading
 import time
-from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 import colorama
 from colorama import Fore
-from dotenv import load_dotenv
-from openai import OpenAI
 import yaspin
-
-# loading api key
-load_dotenv()
+from snaptrack.cache import DiskCache, get_cache_dir
+from snaptrack.json_stream import iter_json_array_objects
+from snaptrack.local_extractor import LocalExtractor
+from snaptrack.metrics import Metrics, traced
+from snaptrack.classifier import CategoryClassifier
+from snaptrack.filters import FilterEngine
+from snaptrack.ocr_layout import MIN_CONFIDENCE, compact_detections, estimate_tokens
+from snaptrack.preprocess import ImagePreprocessor, ImagePreprocessorError
+from snaptrack.retry import backoff_delay
+from snaptrack.tiling import TILE_ASPECT, TILE_OVERLAP, merge_tile_detections, split_into_tiles
+
+# bump whenever the way OCR results are produced changes, so stale cache entries aren't reused
+OCR_BACKEND = "rekognition:detect_text"
+OCR_VERSION = "1"
+
+# upper bound on the size of the OCR result cache
+OCR_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+# defaults for the (opt-in) GPT response cache
+LLM_CACHE_MAX_BYTES = 50 * 1024 * 1024
+LLM_CACHE_MAX_AGE = 30 * 24 * 60 * 60
 
 class ReceiptParserError(Exception):
     """Error class for the ReceiptParser class
@@ -25,13 +40,94 @@ class ReceiptParser:
     """Parses receipts
     """
 
-    def __init__(self, openai_api_key, spinner: yaspin, verbose: bool = False):
-        # initializing OpenAI client
-        self.openai_client = OpenAI(api_key = openai_api_key)
+    def __init__(self, openai_api_key, spinner: yaspin, verbose: bool = False, batch_select: bool = True, structured: bool = False, structured_model: str = "gpt-4o-mini", ocr_cache: bool = True, llm_cache: bool = False, llm_cache_max_bytes: int = LLM_CACHE_MAX_BYTES, llm_cache_max_age: float = LLM_CACHE_MAX_AGE, bypass_llm_cache: bool = False, compact_ocr: bool = True, min_ocr_confidence: float = MIN_CONFIDENCE, preprocessor: ImagePreprocessor = None, tile_ocr: bool = False, tile_aspect: float = TILE_ASPECT, tile_overlap: float = TILE_OVERLAP, max_tile_workers: int = 4, extraction_attempts: int = 3, local_extractor: LocalExtractor = None, classifier: CategoryClassifier = None, filter_rules: str = None, metrics: Metrics = None):
+        # the OpenAI client (and the openai package) is only loaded once GPT is actually needed
+        self.openai_api_key = openai_api_key
+        self._openai_client = None
+        self._client_lock = threading.Lock()
+
+        # one Rekognition client is kept for the parser's lifetime, so its connections are reused between receipts
+        self._rekognition_client = None
 
         self.spinner = spinner
         self.verbose = verbose
 
+        # whether to classify all selection columns for all entries in a single GPT call
+        self.batch_select = batch_select
+
+        # whether to extract every column in a single schema-constrained GPT call (needs a model with structured output support)
+        self.structured = structured
+        self.structured_model = structured_model
+
+        # OCR results keyed by a hash of the image, so retries and re-runs don't call Rekognition again
+        self.ocr_cache = DiskCache(get_cache_dir() / 'ocr.sqlite3', OCR_CACHE_MAX_BYTES) if ocr_cache else None
+
+        # raw GPT replies keyed by a hash of the whole request; bypassing skips lookups but still stores fresh replies
+        self.llm_cache = DiskCache(get_cache_dir() / 'llm.sqlite3', llm_cache_max_bytes, llm_cache_max_age) if llm_cache else None
+        self.bypass_llm_cache = bypass_llm_cache
+
+        # whether to rebuild receipt rows from OCR geometry instead of sending every detection to GPT
+        self.compact_ocr = compact_ocr
+        self.min_ocr_confidence = min_ocr_confidence
+
+        # shrinks images before they are uploaded to Rekognition (None sends the file as-is)
+        self.preprocessor = preprocessor
+
+        # whether to OCR tall receipts as overlapping strips, since Rekognition only returns about 100 words per image
+        self.tile_ocr = tile_ocr
+        self.tile_aspect = tile_aspect
+        self.tile_overlap = tile_overlap
+        self.max_tile_workers = max_tile_workers
+
+        # number of times GPT is re-prompted when it doesn't reply with valid JSON
+        self.extraction_attempts = extraction_attempts
+
+        # rule-based extractor tried before GPT (None always uses GPT)
+        self.local_extractor = local_extractor
+
+        # local model answering selection columns for familiar items (None always uses GPT)
+        self.classifier = classifier
+
+        # filter engines are built once per database schema, from the rule set at filter_rules (or the default config)
+        self.filter_rules = filter_rules
+        self._filter_engines = {}
+        self._filter_lock = threading.Lock()
+
+        # spans and counters for every API call and stage (shared with NotionDB to see a whole receipt)
+        self.metrics = metrics if metrics is not None else Metrics()
+
+    @property
+    def openai_client(self):
+        if self._openai_client is None:
+            with self._client_lock:
+                if self._openai_client is None:
+                    from openai import OpenAI
+                    self._openai_client = OpenAI(api_key = self.openai_api_key)
+        return self._openai_client
+
+    @openai_client.setter
+    def openai_client(self, client):
+        self._openai_client = client
+
+    @property
+    def rekognition_client(self):
+        if self._rekognition_client is None:
+            with self._client_lock:
+                if self._rekognition_client is None:
+                    # boto3 takes a few hundred milliseconds to import, so it is only loaded when OCR actually runs
+                    import boto3
+                    from botocore.config import Config
+
+                    session = boto3.Session(profile_name='default')
+                    # enough pooled connections for every tile of a receipt to be sent at once
+                    self._rekognition_client = session.client('rekognition', config=Config(max_pool_connections=max(10, self.max_tile_workers)))
+        return self._rekognition_client
+
+    @rekognition_client.setter
+    def rekognition_client(self, client):
+        self._rekognition_client = client
+
+    @traced('ocr')
     def get_rekognition_response(self, filepath):
         """Gets AWS Rekognition response for a specified image
 
@@ -41,21 +137,98 @@ class ReceiptParser:
         :return: a AWS Rekognition result
         :rtype: JSON dictionary
         """
+        with open(filepath, 'rb') as image_file:
+            image_data = image_file.read()
+
+        cache_key = None
+        if self.ocr_cache is not None:
+            # keyed on the original bytes, so cache hits skip preprocessing too
+            preprocessing = self.preprocessor.signature() if self.preprocessor is not None else 'none'
+            tiling = f"aspect={self.tile_aspect};overlap={self.tile_overlap}" if self.tile_ocr else 'none'
+            cache_key = DiskCache.make_key(OCR_BACKEND, OCR_VERSION, preprocessing, tiling, image_data)
+            cached = self.ocr_cache.get(cache_key)
+            self.metrics.increment('cache_lookups', cache='ocr', result='miss' if cached is None else 'hit')
+            if cached is not None:
+                return json.loads(cached)
+
+        if self.preprocessor is not None:
+            image_data = self.__preprocess_image(image_data)
+
+        from botocore.exceptions import ClientError
+
         try:
-            session = boto3.Session(profile_name='default')
-            aws_client = session.client('rekognition')
+            aws_client = self.rekognition_client
 
-            with open(filepath, 'rb') as image_file:
-                image_data = image_file.read()
+            tiles, page_height = self.__split_into_tiles(image_data) if self.tile_ocr else ([], None)
 
-            # call Amazon Rekognition API
-            response = aws_client.detect_text(Image={'Bytes': image_data})
+            if len(tiles) == 0:
+                # call Amazon Rekognition API
+                response = self.__detect_text(aws_client, image_data)
+            else:
+                response = self.__detect_text_tiled(aws_client, tiles, page_height)
 
         except ClientError as e:
             response = {'Error': str(e)}
 
+        if cache_key is not None and 'Error' not in response:
+            # only the detections are needed later on, not the HTTP metadata
+            self.ocr_cache.set(cache_key, json.dumps({
+                'TextDetections': response.get('TextDetections', []),
+                'TextModelVersion': response.get('TextModelVersion')
+            }))
+
         return response
 
+    def __split_into_tiles(self, image_data):
+        try:
+            return split_into_tiles(image_data, self.tile_aspect, self.tile_overlap)
+        except Exception as ex:
+            # without Pillow (or with an unreadable image) the whole image is sent in one request
+            if self.verbose:
+                self.spinner.write(Fore.YELLOW + f"[Skipping tiled OCR: {ex}]" + Fore.RESET)
+            return [], None
+
+    def __detect_text(self, aws_client, image_data):
+        with self.metrics.span('rekognition.detect_text', bytes=len(image_data)):
+            self.metrics.increment('api_calls', service='rekognition', operation='detect_text')
+            self.metrics.increment('bytes_uploaded', len(image_data), service='rekognition')
+            return aws_client.detect_text(Image={'Bytes': image_data})
+
+    def __detect_text_tiled(self, aws_client, tiles, page_height):
+        with self.metrics.span('tiled_ocr', tiles=len(tiles)) as span:
+            # boto3 clients are thread-safe, so every strip is sent at once
+            with ThreadPoolExecutor(max_workers=self.max_tile_workers) as executor:
+                responses = list(executor.map(self.metrics.bind(lambda tile: self.__detect_text(aws_client, tile.image_data)), tiles))
+
+            detections = merge_tile_detections(tiles, [response.get('TextDetections', []) for response in responses], page_height)
+
+        if self.verbose:
+            self.spinner.write(Fore.YELLOW + f"[Tiled OCR: {len(tiles)} strips, {len(detections)} detections in {'{:.3f}'.format(span.duration)} seconds]" + Fore.RESET)
+
+        return {'TextDetections': detections, 'TextModelVersion': responses[0].get('TextModelVersion')}
+
+    def __preprocess_image(self, image_data):
+        try:
+            with self.metrics.span('preprocess'):
+                # downscaling a long receipt's long edge before tiling would throw away the detail tiling keeps
+                processed, stats = self.preprocessor.process(image_data, measure=self.verbose, tiled=self.tile_ocr)
+        except ImagePreprocessorError as ex:
+            # OCR can still be attempted on the original image
+            if self.verbose:
+                self.spinner.write(Fore.YELLOW + f"[Skipping image preprocessing: {ex.message}]" + Fore.RESET)
+            return image_data
+
+        if self.verbose:
+            previous = stats[0]
+            for stage in stats[1:]:
+                saved = f", {previous['bytes'] - stage['bytes']} bytes saved" if stage['bytes'] is not None and previous['bytes'] is not None else ''
+                self.spinner.write(Fore.YELLOW + f"[Preprocessing {stage['stage']}: {'{:.3f}'.format(stage['seconds'])} seconds, {stage['size'][0]}x{stage['size'][1]}{saved}]" + Fore.RESET)
+                if stage['bytes'] is not None:
+                    previous = stage
+            self.spinner.write(Fore.YELLOW + f"[Image size: {len(image_data)} bytes -> {len(processed)} bytes]" + Fore.RESET)
+
+        return processed
+
     def parse_rekognition_response(self, aws_response, columns, select_options = None):
         """Parses receipt and returns JSON dictionary 
 
@@ -68,71 +241,188 @@ class ReceiptParser:
         :rtype: JSON dictionary
         """
 
-        # clean up response to only include text content
-        aws_text = [elem['DetectedText'] for elem in aws_response['TextDetections']]
-
-        # building a list of all of the text items on the receipt
-        receipt_list = "["
-        for item in aws_text[:-1]:
-            receipt_list += f"{item}, "
-        receipt_list += f"{aws_text[-1]}]"
-
-        # getting entries
-        entries = self.assemble_columns(receipt_list, columns, select_options)
+        # getting entries, without GPT when the receipt is simple enough
+        entries = self.extract_entries_locally(aws_response, columns)
+        if entries is not None:
+            entries = self.classify_entries(entries, columns, select_options)
+        else:
+            receipt_list = self.build_receipt_list(aws_response)
+            entries = self.assemble_columns(receipt_list, columns, select_options)
 
         # filtering entries
         self.spinner.text = "Filtering pages to get the best results..." 
 
-        filtration_time_start = time.time()
-        filtered_entries = self.filter_content(entries, columns)
-        filtration_time_end = time.time()
+        with self.metrics.span('filtration') as span:
+            filtered_entries = self.filter_content(entries, columns)
 
         if self.verbose:
-            self.spinner.write(Fore.YELLOW + "[Time elapsed for filtration: " f"{'{:.3f}'.format(filtration_time_end - filtration_time_start)}" + " seconds]" + Fore.RESET)
+            self.spinner.write(Fore.YELLOW + "[Time elapsed for filtration: " f"{'{:.3f}'.format(span.duration)}" + " seconds]" + Fore.RESET)
 
         return filtered_entries
 
-    def get_gpt_response(self, prompt, as_json=True):
+    def build_receipt_list(self, aws_response):
+        """Builds the text of a receipt that is given to GPT from its OCR result
+
+        :param aws_response: a AWS Rekognition result
+        :type aws_response: JSON dictionary
+
+        :return: text extracted from image of receipt
+        :rtype: str
+        """
+
+        # clean up response to only include text content
+        aws_text = [elem['DetectedText'] for elem in aws_response['TextDetections']]
+        if len(aws_text) == 0:
+            self.spinner.fail(Fore.RED + "❌ no text detected in receipt" + Fore.RESET)
+            raise ReceiptParserError(error_msg="no text detected in receipt")
+
+        # building a list of all of the text items on the receipt
+        receipt_list = "[" + ", ".join(aws_text) + "]"
+
+        if self.compact_ocr:
+            # one line of text per row on the receipt, without duplicated words or noise
+            rows = compact_detections(aws_response['TextDetections'], self.min_ocr_confidence)
+            compacted_list = "[\n" + "\n".join(rows) + "\n]"
+
+            if self.verbose:
+                self.spinner.write(Fore.YELLOW + f"[OCR compaction: ~{estimate_tokens(receipt_list)} tokens -> ~{estimate_tokens(compacted_list)} tokens, {len(aws_text)} detections -> {len(rows)} rows]" + Fore.RESET)
+
+            receipt_list = compacted_list
+
+        return receipt_list
+
+    @traced('gpt')
+    def get_gpt_response(self, prompt, as_json=True, limit_tokens=True, json_mode=False, schema=None):
         """Gets GPT response for a prompt
 
         :param prompt: GPT prompt
         :type prompt: str
         :param as_json: whether or not to convert GPT response to JSON, defaults to True
         :type as_json: bool, optional
+        :param limit_tokens: whether or not to ask GPT to keep its response short, defaults to True
+        :type limit_tokens: bool, optional
+        :param json_mode: whether or not to force GPT to reply with a JSON object, defaults to False
+        :type json_mode: bool, optional
+        :param schema: JSON schema GPT's reply must conform to (uses the structured output model), defaults to None
+        :type schema: JSON dictionary, optional
 
         :return: GPT response
         :rtype: either JSON dictionary or str
         """
+        request = self.__build_request(prompt, limit_tokens, json_mode, schema)
+        content = self.__create_chat_completion(request)
 
+        if as_json:
+            # converting the message to JSON to return
+            try:
+                details = json.loads(content)
+            except (json.decoder.JSONDecodeError, TypeError) as e:
+                details = {'Error': e}
+            
+            return details
+        else:
+            # returning string content directly
+            return content
+
+    def stream_gpt_response(self, prompt, limit_tokens=True, schema=None):
+        """Streams GPT's reply to a prompt as it is generated
+
+        :param prompt: GPT prompt
+        :type prompt: str
+        :param limit_tokens: whether or not to ask GPT to keep its response short, defaults to True
+        :type limit_tokens: bool, optional
+        :param schema: JSON schema GPT's reply must conform to (uses the structured output model), defaults to None
+        :type schema: JSON dictionary, optional
+
+        :return: pieces of the reply, in order
+        :rtype: generator of str
+        """
+        request = self.__build_request(prompt, limit_tokens, False, schema)
+        self.metrics.increment('api_calls', service='openai', operation='chat.completions.stream')
+        self.metrics.increment('bytes_uploaded', len(json.dumps(request['messages'])), service='openai')
+
+        # token usage only arrives, in a final chunk without choices, when asked for
+        request['extra_body'] = {'stream_options': {'include_usage': True}}
+
+        for chunk in self.openai_client.chat.completions.create(stream=True, **request):
+            if getattr(chunk, 'usage', None) is not None:
+                self.__count_tokens(request['model'], chunk.usage)
+            if len(chunk.choices) != 0 and chunk.choices[0].delta.content is not None:
+                yield chunk.choices[0].delta.content
+
+    def __build_request(self, prompt, limit_tokens, json_mode, schema):
         # add prefix in front of prompt to specify config
-        prompt = "Limit your response to under 80 tokens for times' sake AND 15 sceonds response time. " + prompt
+        if limit_tokens:
+            prompt = "Limit your response to under 80 tokens for times' sake AND 15 sceonds response time. " + prompt
 
-        gpt_response = self.openai_client.chat.completions.create(
-            messages = [
+        request = {
+            'messages': [
                 {
                     "role": "user",
                     "content": prompt,
                 }
             ],
-            model = "gpt-3.5-turbo",
-            temperature = 0.0
-        )
+            'model': "gpt-3.5-turbo",
+            'temperature': 0.0
+        }
+
+        if schema is not None:
+            request['model'] = self.structured_model
+            request['response_format'] = {
+                'type': 'json_schema',
+                'json_schema': {'name': 'receipt', 'strict': True, 'schema': schema}
+            }
+        elif json_mode:
+            request['response_format'] = {'type': 'json_object'}
+
+        return request
+
+    def __create_chat_completion(self, request):
+        # model, temperature, messages and response format together fully determine the reply at temperature 0
+        cache_key = None
+        if self.llm_cache is not None:
+            cache_key = DiskCache.make_key(json.dumps(request, sort_keys=True, default=str))
+            if not self.bypass_llm_cache:
+                cached = self.llm_cache.get(cache_key)
+                self.metrics.increment('cache_lookups', cache='llm', result='miss' if cached is None else 'hit')
+                if cached is not None:
+                    return cached
+
+        with self.metrics.span('openai.chat', model=request['model']) as span:
+            self.metrics.increment('api_calls', service='openai', operation='chat.completions')
+            self.metrics.increment('bytes_uploaded', len(json.dumps(request['messages'])), service='openai')
+            gpt_response = self.openai_client.chat.completions.create(**request)
+
+            if getattr(gpt_response, 'usage', None) is not None:
+                span.set(prompt_tokens=gpt_response.usage.prompt_tokens, completion_tokens=gpt_response.usage.completion_tokens)
+                self.__count_tokens(request['model'], gpt_response.usage)
 
         # accessing GPT's actual reply
-        message = gpt_response.choices[0].message
+        content = gpt_response.choices[0].message.content
 
-        if as_json:
-            # converting the message to JSON to return
-            try:
-                details = json.loads(message.content)
-            except json.decoder.JSONDecodeError as e:
-                details = {'Error': e}
-            
-            return details
-        else:
-            # returning string content directly
-            return message.content
+        if cache_key is not None and content is not None:
+            self.llm_cache.set(cache_key, content)
 
+        return content
+
+    def __count_tokens(self, model, usage):
+        self.metrics.increment('tokens', usage.prompt_tokens or 0, model=model, kind='prompt')
+        self.metrics.increment('tokens', usage.completion_tokens or 0, model=model, kind='completion')
+
+    def cache_stats(self):
+        """Gets statistics for the OCR and GPT response caches that are enabled
+
+        :return: statistics keyed by cache name ('ocr', 'llm')
+        :rtype: dictionary
+        """
+        stats = {}
+        if self.ocr_cache is not None:
+            stats['ocr'] = self.ocr_cache.stats()
+        if self.llm_cache is not None:
+            stats['llm'] = self.llm_cache.stats()
+        return stats
+
+    @traced('assemble_columns')
     def assemble_columns(self, receipt_list, columns, select_options):
         """Assembles both selection and non-selection columns
 
@@ -146,49 +436,198 @@ class ReceiptParser:
         :return: 
         :rtype: 
         """
+        entries = self.extract_entries(receipt_list, columns, select_options)
+        return self.classify_entries(entries, columns, select_options)
+
+    def extract_entries_locally(self, aws_response, columns):
+        """Extracts the entries on a receipt with the local rule-based extractor, if it is confident enough
+
+        :param aws_response: a AWS Rekognition result
+        :type aws_response: JSON dictionary
+        :param columns: columns of the database, structured as {'name': column_name, 'type': column_type}
+        :type columns: list of dictionaries
+
+        :return: entries keyed by column name (without selection columns), or None if GPT is needed
+        :rtype: list of dictionaries
+        """
+        if self.local_extractor is None:
+            return None
+
+        with self.metrics.span('local_extraction') as span:
+            extraction = self.local_extractor.extract(aws_response['TextDetections'], columns)
+            accepted = self.local_extractor.accept(extraction)
+            span.set(entries=len(extraction.entries), confidence=extraction.confidence, accepted=accepted)
+
+        if self.verbose:
+            outcome = "using local entries" if accepted else "falling back to GPT"
+            self.spinner.write(Fore.YELLOW + f"[Local extraction: {len(extraction.entries)} entries, confidence {'{:.2f}'.format(extraction.confidence)}, items sum {'{:.2f}'.format(extraction.item_sum)} vs subtotal {extraction.subtotal}, {outcome} ({'{:.3f}'.format(span.duration)} seconds)]" + Fore.RESET)
+
+        return extraction.entries if accepted else None
+
+    def extract_entries(self, receipt_list, columns, select_options = None):
+        """Extracts the entries on a receipt, filling in non-selection columns (or every column in structured mode)
+
+        :param receipt_list: extracted text from image of receipt
+        :type receipt_list: str
+        :param columns: columns of the database, structured as {'name': column_name, 'type': column_type}
+        :type columns: list of dictionaries
+        :param select_options: options for selection columns, only used in structured mode
+        :type select_options: dictionary where str (column name) -> lists (options)
+
+        :return: entries keyed by column name
+        :rtype: list of dictionaries
+        """
+        if self.structured:
+            self.spinner.text = "Working on extracting page features for all columns..."
+
+            with self.metrics.span('structured_extraction') as span:
+                entries = self.__add_all_columns_structured(receipt_list, columns, select_options)
+
+            if self.verbose:
+                self.spinner.write(Fore.YELLOW + "[Time elapsed for structured extraction: " + f"{'{:.3f}'.format(span.duration)}" + " seconds]" + Fore.RESET)
+
+            return entries
+
+        self.spinner.text = "Working on extracting page features for non-selection columns..."
+
+        # add non-select-columns while a valid response is not received, up to a bounded number of attempts
+        with self.metrics.span('non_select_columns') as span:
+            entries = None
+            for attempt in range(self.extraction_attempts):
+                response = self.__add_non_select_columns(receipt_list, columns)
+                if isinstance(response, list):
+                    entries = response
+                    break
+                if attempt != self.extraction_attempts - 1:
+                    self.metrics.increment('retries', stage='non_select_columns')
+                    time.sleep(backoff_delay(attempt))
+
+            if entries is None:
+                raise ReceiptParserError(error_msg=f"invalid GPT response after {self.extraction_attempts} attempts")
+
+        if self.verbose:
+            self.spinner.write(Fore.YELLOW + "[Time elapsed for non-selection columns: " + f"{'{:.3f}'.format(span.duration)}" + " seconds]" + Fore.RESET)
+
+        return entries
+
+    def stream_entries(self, receipt_list, columns, select_options = None):
+        """Extracts the entries on a receipt like extract_entries, yielding each one as soon as GPT has finished writing it
+
+        :param receipt_list: extracted text from image of receipt
+        :type receipt_list: str
+        :param columns: columns of the database, structured as {'name': column_name, 'type': column_type}
+        :type columns: list of dictionaries
+        :param select_options: options for selection columns, only used in structured mode
+        :type select_options: dictionary where str (column name) -> lists (options)
+
+        :return: entries keyed by column name
+        :rtype: generator of dictionaries
+        """
+        if self.structured:
+            chunks = self.stream_gpt_response(self.__structured_prompt(receipt_list), limit_tokens=False, schema=self.build_extraction_schema(columns, select_options))
+        else:
+            chunks = self.stream_gpt_response(self.__non_select_prompt(receipt_list, columns))
+
+        for entry in iter_json_array_objects(chunks):
+            # null numbers are treated the same way as labels GPT left empty
+            yield {key: ('' if value is None else value) for key, value in entry.items()}
+
+    def classify_entries(self, entries, columns, select_options):
+        """Fills in the selection columns of extracted entries
 
+        :param entries: entries keyed by column name
+        :type entries: list of dictionaries
+        :param columns: columns of the database, structured as {'name': column_name, 'type': column_type}
+        :type columns: list of dictionaries
+        :param select_options: options for selection columns
+        :type select_options: dictionary where str (column name) -> lists (options)
+
+        :return: the same entries, with selection columns filled in
+        :rtype: list of dictionaries
+        """
         def get_target_column(target):
             for item in columns:
                 if item['name'] == target:
                     return item
             return -1
 
-        self.spinner.text = "Working on extracting page features for non-selection columns..."
-
-        # add non-select-columns while a valid response is not received
-        non_select_time_start = time.time()
-
-        valid_gpt_response = False
-        while not valid_gpt_response:
-            entries = self.__add_non_select_columns(receipt_list, columns)
-            if 'Error' not in entries:
-                valid_gpt_response = True
-        
-        non_select_time_end = time.time()
-        if self.verbose:
-            self.spinner.write(Fore.YELLOW + "[Time elapsed for non-selection columns: " + f"{'{:.3f}'.format(non_select_time_end - non_select_time_start)}" + " seconds]" + Fore.RESET)
+        # structured extraction already chose options for every selection column (locally extracted entries still need them)
+        select_column_names = [column['name'] for column in columns if column['type'] in ['select', 'multi_select']]
+        if self.structured and all(name in entry for entry in entries for name in select_column_names):
+            return entries
 
         self.spinner.text = "Working on extracting page features for selection columns..."
 
         # add select-columns while a valid response is not received
-        select_time_start = time.time()
-        select_column_names = list(select_options.keys())
-        
-        # add all selection columns to the entries column one-by-one
-        for column_name in list(select_column_names):
-            target = get_target_column(column_name)
-            if target['type'] == 'select':
-                self.__add_select_column(entries, column_name, 'select', select_options[column_name])
+        with self.metrics.span('select_columns', entries=len(entries)) as span:
+            # entries the local classifier is confident about don't need GPT
+            gpt_entries = self.__classify_locally(entries, columns, select_options) if self.classifier is not None else entries
+            span.set(gpt_entries=len(gpt_entries))
+
+            if len(gpt_entries) == 0:
+                pass
+            elif self.batch_select:
+                # classify every selection column for every entry in one request
+                self.__add_select_columns_batched(gpt_entries, columns, select_options)
             else:
-                self.__add_select_column(entries, column_name, 'multi_select', select_options[column_name])
-        
-        select_time_end = time.time()
+                select_column_names = list(select_options.keys())
+
+                # add all selection columns to the entries column one-by-one
+                for column_name in list(select_column_names):
+                    target = get_target_column(column_name)
+                    if target['type'] == 'select':
+                        self.__add_select_column(gpt_entries, column_name, 'select', select_options[column_name])
+                    else:
+                        self.__add_select_column(gpt_entries, column_name, 'multi_select', select_options[column_name])
+
         if self.verbose:
-            self.spinner.write(Fore.YELLOW + "[Time elapsed for selection columns: " + f"{'{:.3f}'.format(select_time_end - select_time_start)}" + " seconds]" + Fore.RESET)
+            self.spinner.write(Fore.YELLOW + "[Time elapsed for selection columns: " + f"{'{:.3f}'.format(span.duration)}" + " seconds]" + Fore.RESET)
 
         return entries
 
+    def __classify_locally(self, entries, columns, select_options):
+        text_column = next((column['name'] for column in columns if column['type'] == 'title'), None)
+        select_columns = [
+            (column['name'], column['type'], (select_options or {}).get(column['name'], []))
+            for column in columns if column['type'] in ['select', 'multi_select']
+        ]
+        if text_column is None or len(select_columns) == 0:
+            return entries
+
+        remaining = self.classifier.classify(entries, text_column, select_columns)
+
+        if self.verbose:
+            self.spinner.write(Fore.YELLOW + f"[Local classifier: {len(entries) - len(remaining)} of {len(entries)} entries classified without GPT]" + Fore.RESET)
+
+        return remaining
+
+    def learn_classifications(self, entries, columns, page_ids=None):
+        """Teaches the local classifier the selection columns of entries that were accepted into the database
+
+        :param entries: entries keyed by column name
+        :type entries: list of dictionaries
+        :param columns: columns of the database, structured as {'name': column_name, 'type': column_type}
+        :type columns: list of dictionaries
+        :param page_ids: ID of each entry's page (None for rows still queued), defaults to None
+        :type page_ids: list of str, optional
+        """
+        if self.classifier is None:
+            return
+
+        text_column = next((column['name'] for column in columns if column['type'] == 'title'), None)
+        if text_column is None:
+            return
+
+        self.classifier.learn_entries(entries, text_column, columns, page_ids)
+        self.classifier.save()
+
     def __add_non_select_columns(self, receipt_list, columns):
+        response = self.get_gpt_response(self.__non_select_prompt(receipt_list, columns))
+        # print(response)
+
+        return response
+
+    def __non_select_prompt(self, receipt_list, columns):
         # created a detailed prompt for task
         prompt = "There are labels that represent columns in a Notion database. Scrutinize all extracted text for each entry in the receipt and assign them to appropriate labels (don't create your own labels, only create keys for given labels). For a particular product, assign a label an empty string if you are unsure what value should be assigned, but make sure to ALWAYS include every label for a particular entry. Please include dates in %Y/%m/%d format excluding time, and correct the content in a title word format. Make sure each entry has the same date (receipt will have a single date on it somewhere). Your output should ONLY be a list of JSON objects and nothing else. Don't list payment details, vendor details as separate purchases. This list is text extracted from a paper receipt: "
 
@@ -203,10 +642,72 @@ class ReceiptParser:
 
         prompt += column_details
 
-        response = self.get_gpt_response(prompt)
-        # print(response)
+        return prompt
 
-        return response
+    def build_extraction_schema(self, columns, select_options):
+        """Builds a JSON schema describing a receipt's entries from the database's columns
+
+        :param columns: columns of the database, structured as {'name': column_name, 'type': column_type}
+        :type columns: list of dictionaries
+        :param select_options: options for selection columns
+        :type select_options: dictionary where str (column name) -> lists (options)
+
+        :return: a strict JSON schema with an 'entries' array of objects keyed by column name
+        :rtype: JSON dictionary
+        """
+        select_options = select_options or {}
+        properties = {}
+
+        for column in columns:
+            column_name = column['name']
+            column_type = column['type']
+            options = select_options.get(column_name, [])
+
+            if column_type == 'number':
+                properties[column_name] = {'type': ['number', 'null']}
+            elif column_type == 'date':
+                properties[column_name] = {'type': 'string', 'description': "date in %Y/%m/%d format excluding time, or an empty string"}
+            elif column_type == 'select':
+                properties[column_name] = {'type': 'string', 'enum': options + ['']}
+            elif column_type == 'multi_select':
+                properties[column_name] = {'type': 'array', 'items': {'type': 'string', 'enum': options}} if len(options) != 0 else {'type': 'array', 'items': {'type': 'string', 'enum': ['']}}
+            else:
+                properties[column_name] = {'type': 'string'}
+
+        entry_schema = {
+            'type': 'object',
+            'properties': properties,
+            'required': list(properties.keys()),
+            'additionalProperties': False
+        }
+
+        return {
+            'type': 'object',
+            'properties': {'entries': {'type': 'array', 'items': entry_schema}},
+            'required': ['entries'],
+            'additionalProperties': False
+        }
+
+    def __add_all_columns_structured(self, receipt_list, columns, select_options):
+        schema = self.build_extraction_schema(columns, select_options)
+        response = self.get_gpt_response(self.__structured_prompt(receipt_list), limit_tokens=False, schema=schema)
+
+        if 'Error' in response or not isinstance(response.get('entries'), list):
+            self.spinner.fail(Fore.RED + "❌ invalid GPT response" + Fore.RESET)
+            raise ReceiptParserError(error_msg="invalid structured GPT response")
+
+        entries = []
+        for entry in response['entries']:
+            # null numbers are treated the same way as labels GPT left empty
+            entries.append({key: ('' if value is None else value) for key, value in entry.items()})
+
+        return entries
+
+    def __structured_prompt(self, receipt_list):
+        prompt = "There are labels that represent columns in a Notion database. Scrutinize all extracted text for each purchased product in the receipt and fill in every label for it. Use an empty string (or null for numbers, an empty list for multi-select labels) if you are unsure what value should be assigned. For selection labels only choose from the allowed options. Please include dates in %Y/%m/%d format excluding time, and correct the content in a title word format. Make sure each entry has the same date (receipt will have a single date on it somewhere). Don't list payment details, vendor details, taxes or totals as separate purchases. This list is text extracted from a paper receipt: "
+        prompt += receipt_list
+
+        return prompt
 
     def __add_select_column(self, entries, column_name, column_type, options):
         if column_type not in ['select', 'multi_select']:
@@ -244,75 +745,101 @@ class ReceiptParser:
 
         return modified_entries
 
-    def filter_content(self, entries, columns):
-        filtered_entries = self.__filter_select_cols(entries, columns)
-        return self.__filter_non_select_cols(filtered_entries, columns)
-
-    def __filter_non_select_cols(self, entries, columns):        
-        def contains_unwanted_content(entry_column):
-            lower_input = entry_column.lower()
-
-            unwanted = ['tax', 'change', 'cash', 'card', 'amount', 'total', 'subtotal', 'discount', 'hst', 'gst', 'invoice', 'purchase', 'customer', 'receipt', 'round', 'balance', '.com', '.ca', 'feedback', 'swipe', 'sale', 'pay', 'shop', '*', 'approved', 'auth', 'record', 'important', 'you', 'copy']
-            for word in unwanted:
-                if word in lower_input:
-                    return True
-
-            unwanted_patterns = [
-                # date
-                r'\d{1,2}/\d{1,2}/\d{2,4}',
-                # amount
-                r'^\d+(\.\d{2})?$',
-                # time
-                r'\b\d{1,2}:\d{2}(?::\d{2})?\b',
-                # phone number
-                r'\d{10}',
-                # URL
-                r'https?://\S+',
-                # credit card
-                r'\b(?:\d[ -]*?){13,16}\b',
-                r'\b(?:\d[ -]x?){13,16}\b'
-            ]
-            for pattern in unwanted_patterns:
-                if re.search(pattern, entry_column):
-                    return True
-
-            return False
-        
-        textual_columns = []
+    def __add_select_columns_batched(self, entries, columns, select_options):
+        # only classify selection columns that actually have options to choose from
+        select_columns = []
         for column in columns:
-            if column['type'] in ['title', 'text']:
-                textual_columns.append(column['name'])
-            
-        modified_entries = []
-        for entry in entries:
-            keep_entry = True
-            for column_name in textual_columns:
-                if len(entry[column_name]) != 0 and len(entry[column_name]) <= 2:
-                    keep_entry = False
-                if contains_unwanted_content(entry[column_name]):
-                    keep_entry = False
-            if keep_entry:
-                modified_entries.append(entry)
+            if column['type'] not in ['select', 'multi_select']:
+                continue
+            options = (select_options or {}).get(column['name'], [])
+            if len(options) == 0:
+                continue
+            select_columns.append((column['name'], column['type'], options))
 
-        return modified_entries
+        if len(select_columns) == 0 or len(entries) == 0:
+            return entries
 
-    def __filter_select_cols(self, entries, columns):
-        non_select_columns = []
-        for column in columns:
-            if not column['type'] in ['select', 'multi_select']:
-                non_select_columns.append(column['name'])
- 
-        # change this filtering to check for non-text content
-        modified_entries = []
-        for entry in entries:
-            num_empty = 0
-            for column in non_select_columns:
-                if entry[column] == '':
-                    num_empty += 1
-            if num_empty <= int(len(columns)/2):
-                modified_entries.append(entry)
-        
-        return modified_entries
+        prompt = "We are working with a Notion database that has columns of type 'Select' and 'Multi-select'. For EVERY numbered purchase entry below, choose options for EVERY column listed. For a 'Select' column choose upto one option (use an empty string if none apply). For a 'Multi-select' column choose a list of any number of options (use an empty list if none apply). Do not create your own options, only choose from the ones provided for that column. Respond with ONLY a JSON object whose keys are the entry numbers and whose values are JSON objects mapping each column name to your choice, e.g. {\"0\": {\"Column\": \"Option\"}}. Please don't say anything else."
+
+        prompt += "\n\nThe columns are:"
+        for column_name, column_type, options in select_columns:
+            column_label = 'Select' if column_type == 'select' else 'Multi-select'
+            prompt += f"\n- {column_name} ({column_label}), options: {json.dumps(options)}"
+
+        prompt += "\n\nThe entries are:"
+        for index, entry in enumerate(entries):
+            prompt += f"\n{index}: {json.dumps(entry, default=str)}"
+
+        response = self.get_gpt_response(prompt, limit_tokens=False, json_mode=True)
+        if not isinstance(response, dict):
+            response = {'Error': 'batched classification response is not a JSON object'}
+
+        # map answers back onto entries, keeping track of the ones that need a second attempt
+        for column_name, column_type, options in select_columns:
+            canonical_options = {option.lower(): option for option in options}
+            fallback_entries = []
+
+            for index, entry in enumerate(entries):
+                answer = response.get(str(index))
+                value = answer.get(column_name) if isinstance(answer, dict) else None
+                value = self.__validate_select_value(value, column_type, canonical_options)
+
+                if value is None:
+                    fallback_entries.append(entry)
+                else:
+                    entry[column_name] = value
+
+            # fall back to the per-entry prompts for missing or malformed answers
+            if len(fallback_entries) != 0:
+                if self.verbose:
+                    self.spinner.write(Fore.YELLOW + f"[Falling back to per-entry classification for {len(fallback_entries)} entries in column {column_name}]" + Fore.RESET)
+                self.__add_select_column(fallback_entries, column_name, column_type, options)
+
+        return entries
+
+    def __validate_select_value(self, value, column_type, canonical_options):
+        # returns the value using the option's original spelling, or None if the value is unusable
+        if column_type == 'select':
+            if not isinstance(value, str):
+                return None
+            if value.strip() == '':
+                return ''
+            return canonical_options.get(value.strip().lower())
+
+        if not isinstance(value, list):
+            return None
+
+        chosen = []
+        for single_value in value:
+            if not isinstance(single_value, str) or single_value.strip().lower() not in canonical_options:
+                return None
+            option = canonical_options[single_value.strip().lower()]
+            if option not in chosen:
+                chosen.append(option)
+        return chosen
+
+    @traced('filter_content')
+    def filter_content(self, entries, columns):
+        return self.get_filter_engine(columns).filter(entries)
+
+    def get_filter_engine(self, columns):
+        """Gets the filter engine for a database schema, building it the first time the schema is seen
+
+        :param columns: columns of the database, structured as {'name': column_name, 'type': column_type}
+        :type columns: list of dictionaries
+
+        :return: the filter engine for these columns
+        :rtype: FilterEngine
+        """
+        key = tuple((column['name'], column['type']) for column in columns)
+
+        with self._filter_lock:
+            if key not in self._filter_engines:
+                engine = FilterEngine.from_config(columns, self.filter_rules)
+                if engine.config_error is not None:
+                    self.spinner.write(Fore.YELLOW + f"[Using the default filters: {engine.config_error}]" + Fore.RESET)
+                self._filter_engines[key] = engine
+            return self._filter_engines[key]
 
     def parse(self, filepath, columns, select_options = None):
         self.spinner.start()
@@ -322,9 +849,17 @@ class ReceiptParser:
             self.spinner.fail(Fore.RED + "❌ invalid AWS response" + Fore.RESET)
             raise ReceiptParserError(error_msg="invalid AWS response")
 
+        if self.verbose and self.ocr_cache is not None:
+            stats = self.ocr_cache.stats()
+            self.spinner.write(Fore.YELLOW + f"[OCR cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries]" + Fore.RESET)
+
         parsed_response = self.parse_rekognition_response(rekognition_response, columns, select_options)
         if 'Error' in parsed_response:
             self.spinner.fail(Fore.RED + "❌ invalid GPT response" + Fore.RESET)
             raise ReceiptParserError(error_msg="invalid GPT response")
 
+        if self.verbose and self.llm_cache is not None:
+            stats = self.llm_cache.stats()
+            self.spinner.write(Fore.YELLOW + f"[GPT cache: {stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions, {stats['entries']} entries]" + Fore.RESET)
+
         return parsed_response
@@ -0,0 +1,91 @@
+import random
+import threading
+import time
+
+class TokenBucket:
+    """Thread-safe token bucket used to keep requests under an API's sustained rate limit
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        # tokens added per second, and the largest burst allowed
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available and consumes it
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+                    self._last_refill = now
+
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+
+                    wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Stops handing out tokens for a number of seconds (e.g. when the API sends Retry-After)
+
+        :param seconds: how long to pause for
+        :type seconds: float
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+def backoff_delay(attempt: int, base_delay: float = 0.5, max_delay: float = 30.0):
+    """Exponential backoff with full jitter
+
+    :param attempt: zero-based number of the retry
+    :type attempt: int
+    :param base_delay: delay before jitter for the first retry, defaults to 0.5
+    :type base_delay: float, optional
+    :param max_delay: upper bound for the delay before jitter, defaults to 30.0
+    :type max_delay: float, optional
+
+    :return: number of seconds to wait
+    :rtype: float
+    """
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+def retry_call(function, attempts: int = 3, base_delay: float = 1.0, max_delay: float = 30.0, should_retry=None, on_retry=None):
+    """Calls a function, retrying it with exponential backoff and jitter when it raises
+
+    :param function: function to call, without arguments
+    :type function: callable
+    :param attempts: total number of calls allowed, defaults to 3
+    :type attempts: int, optional
+    :param base_delay: delay before jitter for the first retry, defaults to 1.0
+    :type base_delay: float, optional
+    :param max_delay: upper bound for the delay before jitter, defaults to 30.0
+    :type max_delay: float, optional
+    :param should_retry: decides whether an exception is worth retrying, defaults to retrying everything
+    :type should_retry: callable, optional
+    :param on_retry: called with (attempt, exception) before each retry, defaults to None
+    :type on_retry: callable, optional
+
+    :return: whatever the function returns
+    """
+    for attempt in range(attempts):
+        try:
+            return function()
+        except Exception as ex:
+            if attempt == attempts - 1 or (should_retry is not None and not should_retry(ex)):
+                raise
+            if on_retry is not None:
+                on_retry(attempt, ex)
+            time.sleep(backoff_delay(attempt, base_delay, max_delay))
@@ -0,0 +1,330 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hmac
+import http.client
+import json
+import os
+import secrets
+import socket
+import socketserver
+import tempfile
+import threading
+from urllib.parse import parse_qs, urlparse
+from colorama import Fore
+from snaptrack.cache import get_cache_dir
+
+# largest receipt image the daemon accepts
+MAX_RECEIPT_BYTES = 25 * 1024 * 1024
+
+# size of the pieces receipts are read and sent in
+CHUNK_SIZE = 64 * 1024
+
+class ReceiptServerError(Exception):
+    """Error class for the ReceiptServer class and the submit client
+    """
+
+    def __init__(self, error_msg):
+        self.message = error_msg
+        super().__init__(self.message)
+
+def default_token_path():
+    """Path of the file holding the token clients need to reach a daemon listening on a port
+
+    :return: path of the token file
+    :rtype: str
+    """
+    return str(get_cache_dir() / 'snaptrack.token')
+
+def read_token(token_path: str = None):
+    """Reads the token of the daemon listening on a port
+
+    :param token_path: path of the token file, defaults to default_token_path()
+    :type token_path: str, optional
+
+    :return: the token, or None if no daemon has written one
+    :rtype: str
+    """
+    try:
+        with open(token_path or default_token_path(), 'r', encoding='utf-8') as token_file:
+            return token_file.read().strip()
+    except OSError:
+        return None
+
+def default_socket_path():
+    """Path of the Unix socket the daemon listens on when no other address is given
+
+    :return: path of the socket, or None where Unix sockets aren't available
+    :rtype: str
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    return str(get_cache_dir() / 'snaptrack.sock')
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+class ReceiptServer:
+    """Long-running daemon that processes receipts submitted over a Unix socket or localhost HTTP
+
+    The receipt parser, Notion database (and its schema) and every API client are created once and kept
+    warm, so a submitted receipt only pays for the OCR, GPT and Notion calls it actually needs.
+    """
+
+    def __init__(self, pipeline, socket_path: str = None, port: int = None, host: str = '127.0.0.1', max_concurrent: int = 4, token_path: str = None):
+        self.pipeline = pipeline
+        self.spinner = pipeline.spinner
+        self.verbose = pipeline.receipt_parser.verbose
+
+        # receipts beyond this many wait for a slot instead of competing for the same rate limits
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+
+        self.socket_path = None
+        # a port can be reached by every local user and by web pages in a browser, so requests must carry this token
+        self.token = None
+        self.token_path = None
+        if port is not None:
+            self.token = secrets.token_urlsafe(32)
+            self.token_path = token_path or default_token_path()
+            self.__write_token()
+
+            self.httpd = ThreadingHTTPServer((host, port), self.__handler())
+            self.httpd.daemon_threads = True
+            self.address = f"http://{host}:{self.httpd.server_address[1]}"
+        else:
+            self.socket_path = socket_path or default_socket_path()
+            if self.socket_path is None:
+                raise ReceiptServerError(error_msg="Unix sockets aren't available here, use a port instead")
+
+            self.__remove_stale_socket()
+            self.httpd = _UnixHTTPServer(self.socket_path, self.__handler())
+            # only the user running the daemon may submit receipts to it
+            os.chmod(self.socket_path, 0o600)
+            self.address = self.socket_path
+
+    def __write_token(self):
+        # readable only by the user running the daemon, like the socket
+        descriptor = os.open(self.token_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(descriptor, 0o600)
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as token_file:
+            token_file.write(self.token)
+
+    def __remove_stale_socket(self):
+        if not os.path.exists(self.socket_path):
+            return
+
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except OSError:
+            # left behind by a daemon that didn't shut down cleanly
+            os.remove(self.socket_path)
+            return
+        finally:
+            probe.close()
+
+        raise ReceiptServerError(error_msg=f"A SnapTrack daemon is already listening on {self.socket_path}")
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def close(self):
+        self.httpd.server_close()
+        if self.socket_path is not None and os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        if self.token_path is not None and read_token(self.token_path) == self.token:
+            os.remove(self.token_path)
+
+    def process(self, filepath, stream: bool = False, display_name: str = None):
+        """Runs a receipt through the pipeline with the daemon's warm clients
+
+        :param filepath: path of the receipt image
+        :type filepath: str
+        :param stream: stream GPT's reply while inserting rows, defaults to False
+        :type stream: bool, optional
+        :param display_name: name the client sent the receipt under, shown and recorded instead of filepath, defaults to None
+        :type display_name: str, optional
+
+        :return: the outcome for the receipt
+        :rtype: ReceiptResult
+        """
+        with self.slots:
+            # the schema is held in memory, so it is only checked against Notion once it goes stale
+            self.pipeline.database.reload_schema_if_stale()
+            return self.pipeline.stream(filepath, display_name=display_name) if stream else self.pipeline.process(filepath, display_name)
+
+    def __handler(self):
+        server = self
+
+        class ReceiptRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                error = self.__reject()
+                if error is not None:
+                    return self.__send_json(*error)
+
+                if urlparse(self.path).path == '/metrics':
+                    data = server.pipeline.metrics.prometheus().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    return self.wfile.write(data)
+
+                if urlparse(self.path).path != '/health':
+                    return self.__send_json(404, {'error': 'not found'})
+
+                database = server.pipeline.database
+                self.__send_json(200, {'ok': True, 'database_id': database.database_id, 'columns': len(database.columns)})
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                if url.path != '/receipts':
+                    return self.__send_json(404, {'error': 'not found'})
+
+                error = self.__reject()
+                if error is not None:
+                    return self.__send_json(*error)
+
+                # browsers can only send these cross-origin after a preflight the daemon never answers
+                content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+                if content_type != 'application/octet-stream' or self.headers.get('X-Snaptrack-Filename') is None:
+                    return self.__send_json(415, {'error': 'receipts must be sent as application/octet-stream with an X-Snaptrack-Filename header'})
+
+                length = int(self.headers.get('Content-Length', 0))
+                if length <= 0:
+                    return self.__send_json(411, {'error': 'a receipt image is required'})
+                if length > MAX_RECEIPT_BYTES:
+                    return self.__send_json(413, {'error': f"receipts are limited to {MAX_RECEIPT_BYTES // (1024 * 1024)} MB"})
+
+                # the pipeline works on files, so the upload is spooled to disk (keeping its extension)
+                filename = os.path.basename(self.headers.get('X-Snaptrack-Filename', 'receipt'))
+                extension = os.path.splitext(filename)[1][:10]
+                descriptor, filepath = tempfile.mkstemp(prefix='snaptrack-', suffix=extension)
+
+                try:
+                    with os.fdopen(descriptor, 'wb') as receipt_file:
+                        remaining = length
+                        while remaining > 0:
+                            chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+                            if not chunk:
+                                return self.__send_json(400, {'error': 'receipt upload was cut short'})
+                            receipt_file.write(chunk)
+                            remaining -= len(chunk)
+
+                    # results are sent as JSON lines: one as soon as the receipt is accepted, then one per row
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/x-ndjson')
+                    self.end_headers()
+                    self.__send_event({'event': 'accepted', 'filename': filename})
+
+                    stream = parse_qs(url.query).get('stream', ['0'])[0] == '1'
+                    # the spooled copy is deleted afterwards, so duplicates are recorded under the client's name for it
+                    result = server.process(filepath, stream=stream, display_name=filename)
+                    for row in result.rows:
+                        self.__send_event({'event': 'row', 'index': row.index, 'page_id': row.page_id, 'queued': row.queued, 'error': None if row.ok else str(row.error)})
+                    self.__send_event({
+                        'event': 'done', 'ok': result.ok, 'rows': len(result.rows), 'seconds': result.seconds,
+                        'stage': result.stage, 'error': None if result.error is None else str(result.error),
+                        'duplicate': result.duplicate.describe() if result.skipped else None
+                    })
+                finally:
+                    os.remove(filepath)
+
+            def __reject(self):
+                # requests from web pages always carry an Origin, while `snaptrack submit` and scripts don't
+                if self.headers.get('Origin') is not None:
+                    return 403, {'error': 'requests from web pages are not accepted'}
+
+                if server.token is not None:
+                    scheme, _, token = self.headers.get('Authorization', '').partition(' ')
+                    if scheme.lower() != 'bearer' or not hmac.compare_digest(token.strip().encode('utf-8'), server.token.encode('utf-8')):
+                        return 401, {'error': f"a valid token is required (Authorization: Bearer, from {server.token_path})"}
+                return None
+
+            def __send_json(self, status, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def __send_event(self, event):
+                self.wfile.write((json.dumps(event) + '\n').encode('utf-8'))
+                self.wfile.flush()
+
+            def address_string(self):
+                # Unix socket clients don't have an address
+                return self.client_address[0] if self.client_address else 'local'
+
+            def log_message(self, format, *args):
+                if server.verbose:
+                    server.spinner.write(Fore.YELLOW + f"[{self.address_string()} {format % args}]" + Fore.RESET)
+
+        return ReceiptRequestHandler
+
+def submit_receipt(filepath, socket_path: str = None, port: int = None, host: str = '127.0.0.1', stream: bool = False, timeout: float = 600, token: str = None):
+    """Sends a receipt to a running daemon and yields its results as they arrive
+
+    :param filepath: path of the receipt image
+    :type filepath: str
+    :param socket_path: Unix socket the daemon listens on, defaults to default_socket_path()
+    :type socket_path: str, optional
+    :param port: localhost port the daemon listens on instead of a socket, defaults to None
+    :type port: int, optional
+    :param host: host the daemon listens on with a port, defaults to '127.0.0.1'
+    :type host: str, optional
+    :param stream: have the daemon stream GPT's reply, defaults to False
+    :type stream: bool, optional
+    :param timeout: seconds to wait on the daemon, defaults to 600
+    :type timeout: float, optional
+    :param token: token of a daemon listening on a port, defaults to the one it wrote to default_token_path()
+    :type token: str, optional
+
+    :return: events sent by the daemon ('accepted', one 'row' per row, then 'done')
+    :rtype: generator of dictionaries
+    """
+    headers = {
+        'Content-Type': 'application/octet-stream',
+        'Content-Length': str(os.path.getsize(filepath)),
+        'X-Snaptrack-Filename': os.path.basename(filepath)
+    }
+
+    if port is not None:
+        connection = http.client.HTTPConnection(host, port, timeout=timeout)
+        address = f"http://{host}:{port}"
+        token = token or read_token()
+        if token is not None:
+            headers['Authorization'] = f"Bearer {token}"
+    else:
+        socket_path = socket_path or default_socket_path()
+        connection = _UnixHTTPConnection(socket_path, timeout=timeout)
+        address = socket_path
+
+    # the file object is sent in blocks rather than read into memory first
+    with open(filepath, 'rb') as receipt_file:
+        try:
+            connection.request('POST', '/receipts?stream=1' if stream else '/receipts', body=receipt_file, headers=headers)
+            response = connection.getresponse()
+        except OSError as ex:
+            connection.close()
+            raise ReceiptServerError(error_msg=f"No SnapTrack daemon is listening on {address} (start one with `snaptrack serve`)") from ex
+
+    try:
+        if response.status != 200:
+            raise ReceiptServerError(error_msg=json.loads(response.read() or b'{}').get('error', f"daemon replied with status {response.status}"))
+
+        for line in response:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        connection.close()
@@ -0,0 +1,133 @@
+import io
+import math
+
+# strips are about as tall as the receipt is wide, which keeps each one well under Rekognition's word limit
+TILE_ASPECT = 1.0
+
+# fraction of a strip's height shared with its neighbours, so lines on a boundary are read whole at least once
+TILE_OVERLAP = 0.15
+
+class Tile:
+    """A horizontal strip of a receipt image
+    """
+
+    def __init__(self, image_data, top, height, owned_top, owned_bottom):
+        self.image_data = image_data
+
+        # position of the strip on the page, in pixels
+        self.top = top
+        self.height = height
+
+        # detections centred within this band belong to this strip, the rest are left to its neighbours
+        self.owned_top = owned_top
+        self.owned_bottom = owned_bottom
+
+def split_into_tiles(image_data: bytes, tile_aspect: float = TILE_ASPECT, overlap: float = TILE_OVERLAP):
+    """Splits a tall image into overlapping horizontal strips
+
+    :param image_data: contents of the image file
+    :type image_data: bytes
+    :param tile_aspect: height of each strip relative to the image's width, defaults to TILE_ASPECT
+    :type tile_aspect: float, optional
+    :param overlap: fraction of each strip's height shared with the next, defaults to TILE_OVERLAP
+    :type overlap: float, optional
+
+    :return: the strips from top to bottom and the height of the whole image in pixels (an image short enough for one strip gives no strips)
+    :rtype: tuple of list of Tile and int
+    """
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(image_data))
+    image.load()
+    width, height = image.size
+
+    tile_height = max(1, int(width * tile_aspect))
+    overlap_height = int(tile_height * overlap)
+    if height <= tile_height * 1.5:
+        return [], height
+
+    # spread the strips evenly so the last one isn't a sliver
+    count = math.ceil((height - overlap_height) / (tile_height - overlap_height))
+    step = (height - tile_height) / (count - 1)
+
+    if image.mode not in ['RGB', 'L']:
+        image = image.convert('RGB')
+
+    tiles = []
+    for index in range(count):
+        top = int(round(index * step))
+        bottom = min(height, top + tile_height)
+
+        # each strip owns up to the middle of its overlaps
+        owned_top = 0 if index == 0 else (top + int(round((index - 1) * step)) + tile_height) / 2
+        owned_bottom = height if index == count - 1 else (bottom + int(round((index + 1) * step))) / 2
+
+        buffer = io.BytesIO()
+        image.crop((0, top, width, bottom)).save(buffer, format='JPEG', quality=90)
+        tiles.append(Tile(buffer.getvalue(), top, bottom - top, owned_top, owned_bottom))
+
+    return tiles, height
+
+def merge_tile_detections(tiles, tile_detections, page_height: int):
+    """Merges detections from every strip into one list in page coordinates, without duplicates from the overlaps
+
+    :param tiles: the strips the image was split into
+    :type tiles: list of Tile
+    :param tile_detections: 'TextDetections' from Rekognition for each strip
+    :type tile_detections: list of lists of dictionaries
+    :param page_height: height of the whole image in pixels
+    :type page_height: int
+
+    :return: 'TextDetections' for the whole image
+    :rtype: list of dictionaries
+    """
+    merged = []
+
+    for index, (tile, detections) in enumerate(zip(tiles, tile_detections)):
+        # ids are only unique within a strip
+        id_offset = index * 100000
+        kept_lines = set()
+
+        for detection in detections:
+            box = detection.get('Geometry', {}).get('BoundingBox')
+            if box is None:
+                continue
+
+            if detection.get('Type') == 'WORD' and 'ParentId' in detection:
+                # words follow their line, so a line and its words are never split between strips
+                if detection['ParentId'] not in kept_lines:
+                    continue
+            else:
+                center = tile.top + (box['Top'] + box['Height'] / 2) * tile.height
+                if not tile.owned_top <= center < tile.owned_bottom:
+                    continue
+                if 'Id' in detection:
+                    kept_lines.add(detection['Id'])
+
+            merged.append(_to_page_coordinates(detection, tile, page_height, id_offset))
+
+    return merged
+
+def _to_page_coordinates(detection, tile, page_height, id_offset):
+    def to_page_y(y):
+        return (tile.top + y * tile.height) / page_height
+
+    detection = dict(detection)
+    geometry = dict(detection['Geometry'])
+
+    box = dict(geometry['BoundingBox'])
+    box['Top'] = to_page_y(box['Top'])
+    box['Height'] = box['Height'] * tile.height / page_height
+    geometry['BoundingBox'] = box
+
+    if 'Polygon' in geometry:
+        geometry['Polygon'] = [{'X': point['X'], 'Y': to_page_y(point['Y'])} for point in geometry['Polygon']]
+
+    detection['Geometry'] = geometry
+
+    if 'Id' in detection:
+        detection['Id'] += id_offset
+    if 'ParentId' in detection:
+        detection['ParentId'] += id_offset
+
+    return detection
@@ -0,0 +1,301 @@
+import ctypes
+import ctypes.util
+import os
+import queue
+import select
+import struct
+import threading
+import time
+from colorama import Fore
+from snaptrack.retry import backoff_delay
+
+# subfolders of the watched folder receipts are moved into once processed
+DONE_FOLDER = 'done'
+FAILED_FOLDER = 'failed'
+
+# seconds a file's size and modification time must stay the same before it is treated as fully written
+SETTLE_SECONDS = 2.0
+
+# seconds between directory scans when inotify isn't available
+POLL_INTERVAL = 1.0
+
+# upper bound on how long dispatching waits for room in a saturated queue
+MAX_SATURATION_DELAY = 30.0
+
+# files that are still being written by common sync tools and browsers
+PARTIAL_SUFFIXES = ['.part', '.partial', '.tmp', '.crdownload', '.download']
+
+class _Inotify:
+    # from <sys/inotify.h>
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError("inotify isn't available on this platform")
+
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE | self.IN_MODIFY
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f"inotify_add_watch failed for {directory}")
+
+    def read(self, timeout):
+        """Waits for events, returning the names of files that changed, or None if the folder has to be rescanned"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        names = []
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            # the kernel dropped events, so only a full scan can tell what arrived
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            if name:
+                names.append(os.fsdecode(name))
+
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+class _Polling:
+    def __init__(self, interval, stop_event):
+        self.interval = interval
+        self.stop_event = stop_event
+
+    def read(self, timeout):
+        self.stop_event.wait(min(timeout, self.interval))
+        return None
+
+    def close(self):
+        pass
+
+class FolderWatcher:
+    """Feeds receipts dropped into a folder through a ReceiptPipeline as they arrive
+
+    New files are found with inotify (or by polling where it isn't available) and only handed on once
+    their size and modification time stop changing, so files still being copied or synced aren't read
+    half-written. Ready receipts go through a bounded queue to a fixed pool of workers sharing one
+    pipeline, and are moved to the done or failed subfolder afterwards. When the queue is full,
+    dispatching backs off instead of piling up work, so bursts of uploads use a predictable amount
+    of memory and API concurrency.
+    """
+
+    def __init__(self, directory, pipeline, workers: int = 2, queue_size: int = 16, settle: float = SETTLE_SECONDS,
+                 poll_interval: float = POLL_INTERVAL, use_inotify: bool = True, extensions: list = None, on_result=None):
+        self.directory = os.path.abspath(directory)
+        self.pipeline = pipeline
+        self.spinner = pipeline.spinner
+        self.workers = workers
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.extensions = [extension.lower() for extension in extensions] if extensions is not None else None
+
+        # called with (result, new path) after each receipt is moved
+        self.on_result = on_result
+
+        self.done_directory = os.path.join(self.directory, DONE_FOLDER)
+        self.failed_directory = os.path.join(self.directory, FAILED_FOLDER)
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+
+        # files seen but not yet settled, as path -> (size, modification time, time they were last seen changing)
+        self.pending = {}
+
+        # files queued or being processed, so they aren't dispatched twice
+        self.claimed = set()
+        self._lock = threading.Lock()
+
+        # how many times in a row the queue was found full
+        self.saturation = 0
+        self.processed = 0
+        self.failed = 0
+
+    def run(self):
+        """Watches the folder until stop is called (or it is interrupted), then finishes the receipts already queued"""
+        os.makedirs(self.done_directory, exist_ok=True)
+        os.makedirs(self.failed_directory, exist_ok=True)
+
+        source = self.__open_source()
+        threads = [threading.Thread(target=self.__work, name=f"snaptrack-watch-{index}", daemon=True) for index in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            # receipts dropped in while nothing was watching are picked up first
+            names = None
+            wake_at = 0
+            while not self.stop_event.is_set():
+                self.__discover(os.listdir(self.directory) if names is None else names)
+
+                if time.time() >= wake_at:
+                    delay = self.__dispatch()
+                    wake_at = time.time() + delay
+
+                # settling files are re-checked often, otherwise only new events (or the stop) wake the loop
+                timeout = self.settle / 4 if self.pending else self.poll_interval
+                if wake_at > time.time():
+                    timeout = min(timeout, wake_at - time.time())
+                names = source.read(max(0.05, timeout))
+        finally:
+            source.close()
+            for _ in threads:
+                self.queue.put(None)
+            for thread in threads:
+                thread.join()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def __open_source(self):
+        if self.use_inotify:
+            try:
+                return _Inotify(self.directory)
+            except (OSError, AttributeError, TypeError):
+                pass
+        return _Polling(self.poll_interval, self.stop_event)
+
+    def __eligible(self, name):
+        path = os.path.join(self.directory, name)
+        lowered = name.lower()
+        if name.startswith('.') or any(lowered.endswith(suffix) for suffix in PARTIAL_SUFFIXES):
+            return False
+        if self.extensions is not None and os.path.splitext(lowered)[1] not in self.extensions:
+            return False
+        return os.path.isfile(path)
+
+    def __discover(self, names):
+        now = time.time()
+        for name in names:
+            path = os.path.join(self.directory, name)
+            with self._lock:
+                claimed = path in self.claimed
+            if claimed or path in self.pending or not self.__eligible(name):
+                continue
+            self.pending[path] = (None, None, now)
+
+    def __dispatch(self):
+        """Queues every settled file, returning how long to wait before dispatching again"""
+        now = time.time()
+        ready = []
+
+        for path, (size, modified, changed_at) in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # moved away or deleted before it settled
+                del self.pending[path]
+                continue
+
+            if (stat.st_size, stat.st_mtime) != (size, modified):
+                self.pending[path] = (stat.st_size, stat.st_mtime, now)
+            elif stat.st_size != 0 and now - changed_at >= self.settle:
+                ready.append((changed_at, path))
+
+        for _, path in sorted(ready):
+            try:
+                self.queue.put_nowait(path)
+            except queue.Full:
+                # leave the rest pending and give the workers time to catch up
+                self.saturation += 1
+                return backoff_delay(self.saturation - 1, max_delay=MAX_SATURATION_DELAY)
+
+            self.saturation = 0
+            del self.pending[path]
+            with self._lock:
+                self.claimed.add(path)
+
+        return 0
+
+    def __work(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                return
+
+            # an error escaping here would end the worker and leave the path claimed for good
+            try:
+                self.__handle(path)
+            except Exception as ex:
+                self.spinner.write(Fore.RED + f"[Couldn't finish {os.path.basename(path)}: {ex}]" + Fore.RESET)
+
+                # otherwise the next scan would pick it up and fail the same way again
+                if os.path.exists(path):
+                    self.__write_error(self.__move(path, self.failed_directory), f"failed: {ex}")
+            finally:
+                with self._lock:
+                    self.claimed.discard(path)
+
+    def __handle(self, path):
+        result = self.pipeline.process(path)
+
+        # partly written receipts keep their checkpoints, so moving one back into the folder resumes it
+        destination = self.done_directory if result.ok else self.failed_directory
+        new_path = self.__move(path, destination)
+        if not result.ok:
+            self.__write_error(new_path, self.__describe_error(result))
+
+        with self._lock:
+            if result.ok:
+                self.processed += 1
+            else:
+                self.failed += 1
+
+        if self.on_result is not None:
+            self.on_result(result, new_path)
+
+    def __move(self, path, destination):
+        name, extension = os.path.splitext(os.path.basename(path))
+        new_path = os.path.join(destination, name + extension)
+
+        # never overwrite an earlier receipt with the same name
+        suffix = 1
+        while os.path.exists(new_path):
+            new_path = os.path.join(destination, f"{name}-{suffix}{extension}")
+            suffix += 1
+
+        try:
+            os.replace(path, new_path)
+        except OSError:
+            return path
+        return new_path
+
+    def __describe_error(self, result):
+        if result.error is not None:
+            return f"failed during {result.stage}: {result.error}"
+
+        failed = [row for row in result.rows if not row.ok]
+        return '\n'.join(f"row {row.index + 1} not added: {row.error}" for row in failed)
+
+    def __write_error(self, path, message):
+        try:
+            with open(path + '.error.txt', 'w', encoding='utf-8') as error_file:
+                error_file.write(message + '\n')
+        except OSError:
+            pass
@@ -0,0 +1,92 @@
+import json
+import threading
+from snaptrack.classifier import CategoryClassifier
+
+def test_concurrent_learn_predict_and_save(tmp_path):
+    path = tmp_path / 'classifier.json'
+    classifier = CategoryClassifier(path)
+    errors = []
+
+    # like the insert pool learning from receipts while other receipts are being classified
+    def learn(worker):
+        try:
+            for index in range(200):
+                classifier.learn(f"item {worker} {index}", 'Category', 'select', f"option {index % 7}")
+                if index % 20 == 0:
+                    classifier.save()
+        except Exception as ex:
+            errors.append(ex)
+
+    def predict():
+        try:
+            for index in range(500):
+                classifier.predict(f"item {index}", 'Category', [f"option {option}" for option in range(7)])
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=learn, args=(worker,)) for worker in range(4)] + [threading.Thread(target=predict) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    classifier.save()
+    assert len(json.loads(path.read_text())['columns']['Category']['memory']) == 800
+    assert list(tmp_path.glob('*.tmp')) == []
+
+def train(classifier, examples):
+    for label, items in examples.items():
+        for item in items:
+            classifier.learn(item, 'Category', 'select', label)
+
+def test_mixed_items_are_left_for_gpt():
+    classifier = CategoryClassifier()
+    train(classifier, {
+        'Transport': ['gas station fuel', 'shell gas', 'uber ride', 'parking meter', 'bus pass', 'esso fuel', 'petro canada gas', 'taxi fare'],
+        'Food': ['coffee', 'latte', 'bagel', 'banana', 'milk 2%', 'bread', 'eggs dozen', 'tim hortons coffee'],
+    })
+    options = ['Transport', 'Food']
+
+    assert classifier.predict('gas', 'Category', options)[1] >= classifier.threshold
+    # a name that belongs to both categories mustn't be auto-filled
+    assert classifier.predict('Gas Station Coffee', 'Category', options)[1] < classifier.threshold
+
+def test_options_need_enough_examples():
+    classifier = CategoryClassifier()
+    train(classifier, {'Transport': ['gas', 'fuel'], 'Food': ['coffee', 'latte']})
+
+    assert classifier.predict('gas station', 'Category', ['Transport', 'Food']) == (None, 0.0)
+
+class FakeDatabase:
+    columns = [{'name': 'Item', 'type': 'title'}, {'name': 'Category', 'type': 'select'}]
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def iter_pages(self, edited_after=None):
+        return iter(self.pages)
+
+    def page_values(self, page):
+        return dict(page['values'])
+
+def page(page_id, item, category, edited='2026-01-01T00:00:00.000Z'):
+    return {'id': page_id, 'last_edited_time': edited, 'values': {'Item': item, 'Category': category}}
+
+def test_training_skips_pages_already_learned():
+    classifier = CategoryClassifier()
+    columns = FakeDatabase.columns
+
+    # one row inserted directly, one still queued in the outbox when it was learned
+    classifier.learn_entries([{'Item': 'Coffee', 'Category': 'Food'}, {'Item': 'Bagel', 'Category': 'Food'}], 'Item', columns, ['page-1', None])
+    database = FakeDatabase([page('page-1', 'Coffee', 'Food'), page('page-2', 'Bagel', 'Food'), page('page-3', 'Bus pass', 'Transport')])
+
+    assert classifier.train_from_database(database) == 1
+    assert classifier.columns['Category']['doc_counts'] == {'Food': 2, 'Transport': 1}
+    assert classifier.train_from_database(database) == 0
+
+    # a row recategorized in Notion replaces what was learned from it
+    database.pages = [page('page-1', 'Coffee', 'Transport', edited='2026-01-02T00:00:00.000Z')]
+    assert classifier.train_from_database(database) == 1
+    assert classifier.columns['Category']['doc_counts'] == {'Food': 1, 'Transport': 2}
+    assert classifier.predict('Coffee', 'Category', ['Food', 'Transport']) == ('Transport', 1.0)
@@ -0,0 +1,30 @@
+from snaptrack import duplicates
+from snaptrack.duplicates import BAND_BITS, HASH_SIZE, DuplicateIndex
+
+QUERY = int('a5c3' * 16, 16)
+
+def image_hash(bits):
+    return f"{bits:064x}"
+
+def test_matches_are_reported_under_the_display_name(tmp_path):
+    index = DuplicateIndex(tmp_path / 'duplicates.sqlite3')
+
+    index.claim('database', '/tmp/snaptrack-upload.jpg', 'sha', image_hash(QUERY), 'IMG_0001.jpg')
+    assert index.find_image('database', 'sha', image_hash(QUERY), '/tmp/other.jpg').filepath == 'IMG_0001.jpg'
+
+    index.release('/tmp/snaptrack-upload.jpg')
+    index.record('database', 'IMG_0001.jpg', 'sha', image_hash(QUERY))
+    assert index.find_image('database', 'sha', image_hash(QUERY)).filepath == 'IMG_0001.jpg'
+
+def test_most_recent_band_candidates_are_compared(tmp_path, monkeypatch):
+    monkeypatch.setattr(duplicates, 'MAX_BAND_CANDIDATES', 1)
+    index = DuplicateIndex(tmp_path / 'duplicates.sqlite3')
+
+    # both share every band but the last with the query; only the newer one is close enough to match
+    last_band = HASH_SIZE * HASH_SIZE - BAND_BITS
+    index.record('database', 'far.jpg', 'far', image_hash(QUERY ^ (0xfff << last_band)))
+    index.record('database', 'near.jpg', 'near', image_hash(QUERY ^ (1 << last_band)))
+
+    match = index.find_image('database', 'query', image_hash(QUERY))
+    assert match.filepath == 'near.jpg'
+    assert match.distance == 1
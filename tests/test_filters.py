@@ -0,0 +1,32 @@
+from snaptrack.filters import DEFAULT_KEYWORDS, FilterEngine
+
+COLUMNS = [{'name': 'Item', 'type': 'title'}, {'name': 'Price', 'type': 'number'}]
+
+def test_malformed_config_falls_back_to_defaults(tmp_path):
+    path = tmp_path / 'filters.json'
+    path.write_text('{"keywords": ["coupon",')
+
+    engine = FilterEngine.from_config(COLUMNS, str(path))
+
+    assert 'not valid JSON' in engine.config_error
+    assert engine.keywords == DEFAULT_KEYWORDS
+    assert engine.filter([{'Item': 'Subtotal', 'Price': 9.99}, {'Item': 'Apples', 'Price': 2.49}]) == [{'Item': 'Apples', 'Price': 2.49}]
+
+def test_invalid_pattern_falls_back_to_defaults(tmp_path):
+    path = tmp_path / 'filters.json'
+    path.write_text('{"patterns": {"sku": "SKU-(\\\\d+"}, "extend": true}')
+
+    engine = FilterEngine.from_config(COLUMNS, str(path))
+
+    assert 'invalid pattern' in engine.config_error
+    assert 'sku' not in engine.patterns
+    assert engine.filter([{'Item': 'Total', 'Price': 9.99}, {'Item': 'Apples', 'Price': 2.49}]) == [{'Item': 'Apples', 'Price': 2.49}]
+
+def test_valid_config_is_used(tmp_path):
+    path = tmp_path / 'filters.json'
+    path.write_text('{"keywords": ["coupon"]}')
+
+    engine = FilterEngine.from_config(COLUMNS, str(path))
+
+    assert engine.config_error is None
+    assert engine.filter([{'Item': 'Coupon', 'Price': 1.0}, {'Item': 'Total', 'Price': 9.99}]) == [{'Item': 'Total', 'Price': 9.99}]
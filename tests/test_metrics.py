@@ -0,0 +1,14 @@
+from snaptrack.metrics import Metrics
+
+def test_counters_with_mixed_label_types():
+    metrics = Metrics()
+    # Notion errors are labelled with the HTTP status, or 'transport' when there was no response
+    metrics.increment('api_errors', service='notion', status=429)
+    metrics.increment('api_errors', service='notion', status='transport')
+    metrics.increment('api_errors', service='notion', status=429)
+
+    assert metrics.counter('api_errors', status=429) == 2
+    assert metrics.counter('api_errors', status='transport') == 1
+    assert 'api_errors{service=notion, status=429}: 2' in metrics.format_breakdown()
+    assert 'snaptrack_api_errors_total{service="notion",status="transport"} 1' in metrics.prometheus()
+    assert len(metrics.counter_records()) == 2
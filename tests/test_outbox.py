@@ -0,0 +1,69 @@
+import sqlite3
+import threading
+import time
+from snaptrack.metrics import Metrics
+from snaptrack.outbox import Outbox, OutboxFlusher
+
+class FakeDatabase:
+    database_id = 'database'
+
+    def __init__(self):
+        self.metrics = Metrics()
+        self.created = []
+        self._lock = threading.Lock()
+
+    def create_page(self, properties):
+        # slow enough that two flushers would overlap on the same rows without claims
+        time.sleep(0.01)
+        with self._lock:
+            self.created.append(properties['index'])
+            return {'id': f"page-{len(self.created)}"}
+
+def test_concurrent_flushers_send_each_row_once(tmp_path):
+    path = tmp_path / 'outbox.sqlite3'
+    Outbox(path).enqueue('database', [(Outbox.make_key('receipt', index), {'index': index}) for index in range(20)])
+
+    # separate connections, like a daemon and `snaptrack flush` running side by side
+    database = FakeDatabase()
+    flushers = [OutboxFlusher(database, Outbox(path), workers=4) for _ in range(2)]
+    threads = [threading.Thread(target=flusher.flush) for flusher in flushers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(database.created) == list(range(20))
+    assert sum(flusher.sent for flusher in flushers) == 20
+    assert Outbox(path).stats('database') == {'pending': 0, 'failed': 0, 'sent': 20}
+
+def test_enqueue_reports_rows_already_journaled(tmp_path):
+    outbox = Outbox(tmp_path / 'outbox.sqlite3')
+    rows = [(Outbox.make_key('receipt', index), {'index': index}) for index in range(3)]
+    assert outbox.enqueue('database', rows) == {}
+
+    OutboxFlusher(FakeDatabase(), outbox).flush()
+    outbox.enqueue('database', [(Outbox.make_key('receipt', 3), {'index': 3})])
+
+    ignored = outbox.enqueue('database', rows + [(Outbox.make_key('receipt', 3), {'index': 3})])
+    assert set(ignored) == {Outbox.make_key('receipt', index) for index in range(4)}
+    assert ignored[Outbox.make_key('receipt', 3)] is None
+    assert all(ignored[Outbox.make_key('receipt', index)] is not None for index in range(3))
+
+class BrokenOutbox(Outbox):
+    def claim(self, database_id):
+        raise sqlite3.OperationalError('disk I/O error')
+
+def test_drain_returns_once_the_flusher_died(tmp_path):
+    outbox = BrokenOutbox(tmp_path / 'outbox.sqlite3')
+    outbox.enqueue('database', [(Outbox.make_key('receipt', 0), {'index': 0})])
+
+    flusher = OutboxFlusher(FakeDatabase(), outbox)
+    flusher.start()
+    flusher.thread.join(5)
+
+    stopper = threading.Thread(target=flusher.stop, daemon=True)
+    stopper.start()
+    stopper.join(5)
+
+    assert not stopper.is_alive()
+    assert outbox.has_due('database')
@@ -0,0 +1,142 @@
+from snaptrack.checkpoint import ReceiptCheckpoint
+from snaptrack.metrics import Metrics
+from snaptrack.notion import RowResult
+from snaptrack.pipeline import ReceiptPipeline
+
+COLUMNS = [{'name': 'Item', 'type': 'title'}, {'name': 'Price', 'type': 'number'}]
+
+class FakeParser:
+    def __init__(self, replies, local_entries=None):
+        self.metrics = Metrics()
+        # one list of entries per streamed reply; an exception in a list breaks the stream there
+        self.replies = list(replies)
+        self.local_entries = local_entries
+        self.local_extractions = 0
+
+    def build_receipt_list(self, rekognition_response):
+        return ''
+
+    def extract_entries_locally(self, rekognition_response, columns):
+        self.local_extractions += 1
+        return self.local_entries
+
+    def extract_entries(self, receipt_list, columns, select_options=None):
+        return [dict(entry) for entry in self.replies.pop(0)]
+
+    def stream_entries(self, receipt_list, columns, select_options=None):
+        for entry in self.replies.pop(0):
+            if isinstance(entry, Exception):
+                raise entry
+            yield dict(entry)
+
+    def filter_content(self, entries, columns):
+        return entries
+
+    def classify_entries(self, entries, columns, select_options):
+        return entries
+
+    def learn_classifications(self, entries, columns, page_ids=None):
+        pass
+
+class FakeDatabase:
+    database_id = 'database'
+    columns = COLUMNS
+    select_options = {}
+
+    def __init__(self, failing=()):
+        self.inserted = []
+        # items whose page can't be created, even after the database's own retries
+        self.failing = set(failing)
+
+    def insert_row(self, row, index=0, on_inserted=None):
+        self.inserted.append(row['Item'])
+        if row['Item'] in self.failing:
+            return RowResult(index, row, error=RuntimeError('validation_error'))
+        page_id = f"page-{row['Item']}"
+        if on_inserted is not None:
+            on_inserted(index, page_id)
+        return RowResult(index, row, page_id=page_id)
+
+    def add_rows(self, rows, on_inserted=None):
+        return [self.insert_row(row, index, on_inserted) for index, row in enumerate(rows)]
+
+def entry(item):
+    return {'Item': item, 'Price': 1.0}
+
+def receipt(tmp_path, monkeypatch):
+    monkeypatch.setenv('SNAPTRACK_CACHE_DIR', str(tmp_path / 'cache'))
+    filepath = tmp_path / 'receipt.jpg'
+    filepath.write_bytes(b'receipt')
+    checkpoint = ReceiptCheckpoint.for_receipt(filepath, FakeDatabase.database_id)
+    checkpoint.save('ocr', {'TextDetections': []})
+    return str(filepath), checkpoint
+
+def test_stream_retries_without_inserting_rows_twice(tmp_path, monkeypatch):
+    filepath, _ = receipt(tmp_path, monkeypatch)
+    parser = FakeParser([
+        [entry('milk'), entry('bread'), ConnectionError('stream dropped')],
+        [entry('milk'), entry('bread'), entry('eggs')]
+    ])
+    database = FakeDatabase()
+
+    result = ReceiptPipeline(parser, database, None).stream(filepath, classify_batch=2)
+
+    assert result.ok
+    assert sorted(database.inserted) == ['bread', 'eggs', 'milk']
+    assert [row.row['Item'] for row in result.rows] == ['milk', 'bread', 'eggs']
+
+def test_stream_resumes_from_checkpointed_entries(tmp_path, monkeypatch):
+    filepath, checkpoint = receipt(tmp_path, monkeypatch)
+    # an interrupted run streamed two entries and inserted the first
+    checkpoint.save('streamed', [entry('milk'), entry('bread')])
+    checkpoint.mark_inserted(0, 'page-earlier')
+
+    # the regenerated reply lists the items in another order
+    parser = FakeParser([[entry('bread'), entry('milk'), entry('eggs')]])
+    database = FakeDatabase()
+
+    result = ReceiptPipeline(parser, database, None).stream(filepath)
+
+    assert result.ok
+    assert sorted(database.inserted) == ['bread', 'eggs']
+    assert [(row.row['Item'], row.page_id) for row in result.rows] == [('milk', 'page-earlier'), ('bread', 'page-bread'), ('eggs', 'page-eggs')]
+
+def test_stream_reuses_local_extraction(tmp_path, monkeypatch):
+    filepath, _ = receipt(tmp_path, monkeypatch)
+    parser = FakeParser([], local_entries=[entry('milk'), entry('bread')])
+    database = FakeDatabase()
+
+    result = ReceiptPipeline(parser, database, None).stream(filepath)
+
+    assert result.ok
+    assert database.inserted == ['milk', 'bread']
+    assert parser.local_extractions == 1
+
+def test_batch_resumes_from_streamed_entries(tmp_path, monkeypatch):
+    filepath, checkpoint = receipt(tmp_path, monkeypatch)
+    # `send --stream` was interrupted after inserting the first of two streamed entries
+    checkpoint.save('streamed', [entry('milk'), entry('bread')])
+    checkpoint.mark_inserted(0, 'page-earlier')
+
+    parser = FakeParser([[entry('bread'), entry('milk'), entry('eggs')]])
+    database = FakeDatabase()
+
+    result = ReceiptPipeline(parser, database, None).process(filepath)
+
+    assert result.ok
+    assert sorted(database.inserted) == ['bread', 'eggs']
+    assert [(row.row['Item'], row.page_id) for row in result.rows] == [('milk', 'page-earlier'), ('bread', 'page-bread'), ('eggs', 'page-eggs')]
+
+def test_failed_rows_are_not_retried_on_top_of_the_database(tmp_path, monkeypatch):
+    filepath, checkpoint = receipt(tmp_path, monkeypatch)
+    parser = FakeParser([[entry('milk'), entry('bread')]])
+    database = FakeDatabase(failing=['bread'])
+
+    pipeline = ReceiptPipeline(parser, database, None)
+    result = pipeline.stream(filepath)
+
+    assert not result.ok
+    assert parser.extraction_attempts == 1
+    assert sorted(database.inserted) == ['bread', 'milk']
+    # the row that was inserted is kept, so the next run only sends the other one
+    assert ReceiptCheckpoint.for_receipt(filepath, database.database_id).inserted_rows() == {0: 'page-milk'}
@@ -0,0 +1,50 @@
+import http.client
+import json
+import threading
+from snaptrack.server import ReceiptServer
+
+class FakeDatabase:
+    database_id = 'database'
+    columns = []
+
+class FakeParser:
+    verbose = False
+
+class FakePipeline:
+    spinner = None
+    receipt_parser = FakeParser()
+    database = FakeDatabase()
+
+def request(server, method, path, headers, body=None):
+    connection = http.client.HTTPConnection('127.0.0.1', server.httpd.server_address[1], timeout=5)
+    try:
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or b'{}')
+    finally:
+        connection.close()
+
+def test_port_requires_token_and_rejects_browser_requests(tmp_path):
+    server = ReceiptServer(FakePipeline(), port=0, token_path=str(tmp_path / 'snaptrack.token'))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        assert (tmp_path / 'snaptrack.token').stat().st_mode & 0o777 == 0o600
+        authorization = {'Authorization': f"Bearer {(tmp_path / 'snaptrack.token').read_text()}"}
+
+        assert request(server, 'GET', '/health', {})[0] == 401
+        assert request(server, 'GET', '/health', {'Authorization': 'Bearer wrong'})[0] == 401
+        assert request(server, 'GET', '/health', authorization) == (200, {'ok': True, 'database_id': 'database', 'columns': 0})
+
+        # a "simple" cross-origin POST a web page could send without a preflight
+        assert request(server, 'POST', '/receipts', {'Content-Type': 'text/plain', 'Origin': 'https://example.com'}, b'receipt')[0] == 403
+        assert request(server, 'POST', '/receipts', dict(authorization, Origin='https://example.com'), b'receipt')[0] == 403
+        assert request(server, 'POST', '/receipts', {'Content-Type': 'application/octet-stream', 'X-Snaptrack-Filename': 'receipt.jpg'}, b'receipt')[0] == 401
+        assert request(server, 'POST', '/receipts', dict(authorization, **{'Content-Type': 'text/plain'}), b'receipt')[0] == 415
+        assert request(server, 'POST', '/receipts', dict(authorization, **{'Content-Type': 'application/octet-stream'}), b'receipt')[0] == 415
+    finally:
+        server.httpd.shutdown()
+        server.close()
+
+    assert not (tmp_path / 'snaptrack.token').exists()
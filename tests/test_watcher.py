@@ -0,0 +1,52 @@
+import threading
+import time
+from snaptrack.watcher import FolderWatcher
+
+class FakeSpinner:
+    def __init__(self):
+        self.lines = []
+
+    def write(self, text):
+        self.lines.append(text)
+
+class FakeResult:
+    ok = True
+    error = None
+    rows = []
+
+class FakePipeline:
+    def __init__(self):
+        self.spinner = FakeSpinner()
+
+    def process(self, path):
+        if path.endswith('broken.jpg'):
+            raise RuntimeError('pipeline crashed')
+        return FakeResult()
+
+def test_errors_dont_kill_workers_or_leave_paths_claimed(tmp_path):
+    for name in ['broken.jpg', 'first.jpg', 'second.jpg']:
+        (tmp_path / name).write_bytes(b'receipt')
+
+    finished = []
+
+    def on_result(result, new_path):
+        finished.append(new_path)
+        raise ValueError('callback failed')
+
+    pipeline = FakePipeline()
+    watcher = FolderWatcher(tmp_path, pipeline, workers=1, settle=0.05, poll_interval=0.05, use_inotify=False, on_result=on_result)
+    thread = threading.Thread(target=watcher.run, daemon=True)
+    thread.start()
+
+    deadline = time.time() + 10
+    while len(finished) < 2 and time.time() < deadline:
+        time.sleep(0.05)
+    watcher.stop()
+    thread.join(5)
+
+    # the single worker survived both the crash and the failing callbacks
+    assert sorted(path.rsplit('/', 1)[1] for path in finished) == ['first.jpg', 'second.jpg']
+    assert watcher.claimed == set()
+    assert (tmp_path / 'failed' / 'broken.jpg').exists()
+    assert 'pipeline crashed' in (tmp_path / 'failed' / 'broken.jpg.error.txt').read_text()
+    assert len(pipeline.spinner.lines) == 3